@@ -0,0 +1,163 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Incident number allocation
+"""
+
+__all__ = [
+    "IncidentNumberAllocator",
+]
+
+import os
+import fcntl
+from threading import Lock
+
+from twisted.python import log
+
+
+
+class IncidentNumberAllocator(object):
+    """
+    Allocates incident numbers from a counter file which may be shared by
+    several processes.
+
+    The counter file holds the lowest number which has not been handed
+    to any process.  Processes reserve blocks of C{block_size} numbers at
+    a time, holding an exclusive lock on the file only while reserving
+    a block, and then allocate from their block without touching the
+    file.  Numbers remaining in a process's block when it exits are
+    never allocated.
+
+    If the counter file is missing or unreadable, it is initialized from
+    C{initial()}, which should return the lowest number not in use.
+
+    If incidents are created at C{sites} sites which synchronize with
+    each other (see L{ims.sync}), each site allocates only the numbers
+    which leave a remainder of C{site} when divided by C{sites}, so that
+    no two sites allocate the same number.
+
+    Numbers may be allocated and observed from any thread.
+    """
+
+    def __init__(self, fp, initial, block_size=10, site=0, sites=1):
+        if block_size < 1:
+            raise ValueError("Block size must be positive: {0}".format(block_size))
+        if not 0 <= site < sites:
+            raise ValueError("Invalid site {0} of {1}".format(site, sites))
+
+        self.fp = fp
+        self.initial = initial
+        self.block_size = block_size
+        self.site = site
+        self.sites = sites
+
+        self._lock = Lock()
+        self._next = 0
+        self._limit = 0
+
+        # The highest value read from or written to the counter file,
+        # which only ever grows.
+        self._counted = 0
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.fp}, block_size={self.block_size})"
+            .format(self=self)
+        )
+
+
+    def allocate(self):
+        """
+        Allocate an incident number.
+        """
+        with self._lock:
+            while True:
+                if self._next >= self._limit:
+                    start, end = self._update(
+                        lambda next: next + self.block_size
+                    )
+                    self._next = start
+                    self._limit = end
+
+                number = self._next
+                self._next += 1
+
+                if number % self.sites == self.site:
+                    return number
+
+
+    def observe(self, number):
+        """
+        Note that an incident number is in use, so that it is not
+        allocated.
+        """
+        with self._lock:
+            if number < self._limit:
+                # The counter file is already past our block, and thus
+                # past this number.
+                if number >= self._next:
+                    # Don't hand out this number from our block, either.
+                    self._next = number + 1
+                return
+
+            if number < self._counted:
+                # The counter file is already past this number.
+                return
+
+            self._update(lambda next: max(next, number + 1))
+
+
+    def _update(self, update):
+        """
+        Apply a function to the value in the counter file while holding
+        an exclusive lock on it.
+
+        @return: a tuple of the prior and new values.
+        """
+        fd = os.open(self.fp.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            try:
+                text = os.read(fd, 64)
+
+                try:
+                    current = int(text)
+                except ValueError:
+                    if text:
+                        log.err(
+                            "Invalid incident number counter in {0}: {1!r}"
+                            .format(self.fp.path, text)
+                        )
+                    current = self.initial()
+                    text = None
+
+                new = update(current)
+
+                if new != current or text is None:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.ftruncate(fd, 0)
+                    os.write(fd, "{0}\n".format(new))
+                    os.fsync(fd)
+
+                self._counted = max(self._counted, new)
+
+                return (current, new)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
@@ -0,0 +1,223 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Packed incident archive
+"""
+
+__all__ = [
+    "ArchiveError",
+    "IncidentArchive",
+]
+
+import os
+import mmap
+from struct import Struct
+
+from twisted.python import log
+
+from ims.journal import sync_path
+
+
+
+class ArchiveError(RuntimeError):
+    """
+    Archive error.
+    """
+
+
+
+class IncidentArchive(object):
+    """
+    Read-only segment file packing the text of many incidents, which is
+    memory-mapped so that reading an archived incident needs no system
+    calls.
+
+    The file holds the text of each incident, followed by an index of
+    C{<number> <offset> <length>} lines, followed by a footer giving the
+    offset of the index and a magic string.
+
+    Incidents which have been written since they were archived are
+    L{discard}ed, and are thereafter read from their live files; the
+    next archive run drops them from the segment.
+    """
+
+    magic = "IMSARCH1"
+    footer = Struct(">Q8s")
+
+
+    def __init__(self, fp):
+        self.fp = fp
+
+        self._file = None
+        self._map = None
+        self._index = {}
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.fp})".format(self=self)
+
+
+    def __len__(self):
+        return len(self._index)
+
+
+    def __contains__(self, number):
+        return number in self._index
+
+
+    def open(self):
+        """
+        Map the archive, if there is one.
+        """
+        if self._map is not None:
+            return
+
+        self._index = {}
+
+        if not self.fp.exists():
+            return
+
+        handle = self.fp.open("r")
+        try:
+            segment = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError) as e:
+            handle.close()
+            raise ArchiveError(
+                "Unable to map archive {0}: {1}".format(self.fp.path, e)
+            )
+
+        try:
+            size = len(segment)
+            if size < self.footer.size:
+                raise ValueError("File is too short")
+
+            index_offset, magic = self.footer.unpack(
+                segment[size - self.footer.size:]
+            )
+            if magic != self.magic:
+                raise ValueError("Bad magic: {0!r}".format(magic))
+
+            index = {}
+            for line in (
+                segment[index_offset:size - self.footer.size].splitlines()
+            ):
+                number, offset, length = [int(x) for x in line.split()]
+                if offset + length > index_offset:
+                    raise ValueError(
+                        "Incident {0} is out of bounds".format(number)
+                    )
+                index[number] = (offset, length)
+        except ValueError as e:
+            segment.close()
+            handle.close()
+            raise ArchiveError(
+                "Invalid archive {0}: {1}".format(self.fp.path, e)
+            )
+
+        self._file = handle
+        self._map = segment
+        self._index = index
+
+        log.msg(
+            "Mapped {0} archived incidents from {1}"
+            .format(len(index), self.fp.path)
+        )
+
+
+    def close(self):
+        """
+        Unmap the archive.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+        self._index = {}
+
+
+    def numbers(self):
+        """
+        @return: the numbers of the archived incidents.
+        """
+        return self._index.keys()
+
+
+    def get(self, number):
+        """
+        @return: the text of the archived incident with the given number,
+            or C{None} if it is not archived.
+        """
+        try:
+            offset, length = self._index[number]
+        except KeyError:
+            return None
+
+        return self._map[offset:offset + length]
+
+
+    def discard(self, number):
+        """
+        Stop serving an incident from the archive.
+        """
+        self._index.pop(number, None)
+
+
+    def replace(self, incidents):
+        """
+        Replace the archive with a new one.
+
+        @param incidents: an iterable of incident numbers and texts.  It
+            may read from this archive, which is not unmapped until the
+            new archive has been written.
+
+        @return: the number of incidents in the new archive.
+        """
+        temp_fp = self.fp.siblingExtension(".tmp")
+
+        index = []
+
+        try:
+            handle = temp_fp.open("w")
+            try:
+                offset = 0
+                for number, text in incidents:
+                    handle.write(text)
+                    index.append(
+                        "{0} {1} {2}\n".format(number, offset, len(text))
+                    )
+                    offset += len(text)
+
+                handle.write("".join(index))
+                handle.write(self.footer.pack(offset, self.magic))
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                handle.close()
+
+            self.close()
+            temp_fp.moveTo(self.fp)
+            sync_path(self.fp.dirname())
+        except EnvironmentError as e:
+            raise ArchiveError(
+                "Unable to write archive {0}: {1}".format(self.fp.path, e)
+            )
+
+        self.open()
+
+        return len(index)
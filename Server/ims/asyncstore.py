@@ -0,0 +1,443 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Asynchronous data store access
+"""
+
+__all__ = [
+    "AsyncStorage",
+]
+
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+from twisted.internet.defer import Deferred, DeferredLock, FirstError
+from twisted.internet.defer import succeed, fail, maybeDeferred, gatherResults
+from twisted.internet.threads import deferToThreadPool
+
+from ims.data import Incident
+from ims.store import incident_number
+from ims.search import incident_matches_terms
+
+
+
+class AsyncStorage(object):
+    """
+    Front end to a data store for use from the reactor thread, with
+    methods returning L{Deferred}s.
+
+    Everything which may block on the disk (reading and parsing
+    incidents, working out etags which the store doesn't know, applying
+    writes and allocating incident numbers) is done in a dedicated pool
+    of C{pool_size} threads, which is also given to the store, and its
+    journal, if it has one, to apply writes in.  Everything which
+    touches the store's in-memory state (its cache, etags, indexes and
+    journal) is done on the reactor thread; only the store's methods
+    which read incidents and etags, and allocate numbers, are called from
+    other threads, and must be safe to call alongside the reactor.  For
+    a shared store, they fill the shared cache while holding the
+    incident's lock, which threads of a process also exclude each other
+    from, and don't cache an incident which the reactor is writing.
+    If C{pool_size} is C{0}, everything is done on the reactor thread.
+
+    Writes to an incident, and edits made with L{edit_incident}, are
+    done one at a time, in the order in which they were requested.  If
+    the store is shared with other processes, they also hold the store's
+    lock on the incident, which is polled for every C{lock_interval}
+    seconds rather than waited for, so as not to block the reactor.
+    """
+
+    lock_interval = 0.01
+
+    def __init__(self, storage, pool_size=4, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.storage = storage
+        self.reactor = reactor
+        self.pool_size = pool_size
+
+        if pool_size > 0:
+            self.threadpool = ThreadPool(
+                minthreads=0, maxthreads=pool_size, name="storage"
+            )
+        else:
+            self.threadpool = None
+
+        self._locks = {}
+        self._generations = {}
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.storage}, "
+            "pool_size={self.pool_size})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Start the thread pool.
+        """
+        if self.threadpool is None:
+            return
+
+        log.msg("Starting {0}".format(self))
+        self.threadpool.start()
+
+        if hasattr(self.storage, "threadpool"):
+            self.storage.threadpool = self.threadpool
+
+        journal = getattr(self.storage, "journal", None)
+        if journal is not None:
+            journal.threadpool = self.threadpool
+
+
+    def stop(self):
+        """
+        Stop the thread pool, waiting for running work to finish.
+        """
+        if self.threadpool is None:
+            return
+
+        if hasattr(self.storage, "threadpool"):
+            self.storage.threadpool = None
+
+        journal = getattr(self.storage, "journal", None)
+        if journal is not None:
+            journal.threadpool = None
+
+        self.threadpool.stop()
+
+
+    def _in_thread(self, f, *args, **kwargs):
+        if self.threadpool is None:
+            return maybeDeferred(f, *args, **kwargs)
+        else:
+            return deferToThreadPool(
+                self.reactor, self.threadpool, f, *args, **kwargs
+            )
+
+
+    def _locked(self, number, f, *args, **kwargs):
+        """
+        Call C{f} once all earlier calls for the same incident have
+        finished, holding the store's lock on the incident.
+        """
+        lock = self._locks.get(number, None)
+        if lock is None:
+            lock = self._locks[number] = DeferredLock()
+
+        def release(result):
+            if not lock.locked and self._locks.get(number, None) is lock:
+                del self._locks[number]
+            return result
+
+        d = lock.run(self._store_locked, number, f, *args, **kwargs)
+        d.addBoth(release)
+        return d
+
+
+    def _store_locked(self, number, f, *args, **kwargs):
+        lock_incident = getattr(self.storage, "lock_incident", None)
+        if lock_incident is None:
+            return f(*args, **kwargs)
+
+        locked = Deferred()
+
+        def try_lock():
+            try:
+                if not lock_incident(number, blocking=False):
+                    self.reactor.callLater(self.lock_interval, try_lock)
+                    return
+            except Exception:
+                locked.errback()
+            else:
+                locked.callback(None)
+
+        def unlock(result):
+            self.storage.unlock_incident(number)
+            return result
+
+        def call(_):
+            d = maybeDeferred(f, *args, **kwargs)
+            d.addBoth(unlock)
+            return d
+
+        try_lock()
+        locked.addCallback(call)
+        return locked
+
+
+    def list_incidents(self):
+        """
+        @return: a L{Deferred} firing with a list of incident numbers and
+            etags.
+        """
+        etags = getattr(self.storage, "incident_etags", None)
+        if etags is None:
+            return self._in_thread(lambda: list(self.storage.list_incidents()))
+
+        try:
+            incidents = [
+                (number, etags.get(number))
+                for number in self.storage.list_incident_numbers()
+            ]
+        except Exception:
+            return fail()
+
+        unknown = [number for number, etag in incidents if etag is None]
+        if not unknown:
+            return succeed(incidents)
+
+        def known(read):
+            read = dict(zip(unknown, read))
+            return [
+                (number, read[number] if etag is None else etag)
+                for number, etag in incidents
+            ]
+
+        d = gatherResults(
+            [self.etag_for_incident_with_number(number) for number in unknown],
+            consumeErrors=True,
+        )
+        d.addCallbacks(known, _first_error)
+        return d
+
+
+    def search_incidents(self, terms=(), show_closed=False):
+        """
+        @return: a L{Deferred} firing with a list of the numbers and
+            etags of incidents matching the given terms.
+        """
+        log.msg("Searching for {0!r}, closed={1}".format(terms, show_closed))
+
+        try:
+            candidates, check_closed, check_terms = self.storage.plan_search(
+                terms, show_closed
+            )
+            candidates = list(candidates)
+        except Exception:
+            return fail()
+
+        if not (check_closed or check_terms):
+            return succeed(candidates)
+
+        def matching(incidents):
+            return [
+                (number, etag)
+                for (number, etag), incident in zip(candidates, incidents)
+                if not (check_closed and incident.closed)
+                and not (check_terms and not incident_matches_terms(incident, terms))
+            ]
+
+        d = self.read_incidents(number for number, etag in candidates)
+        d.addCallback(matching)
+        return d
+
+
+    def etag_for_incident_with_number(self, number):
+        """
+        @return: a L{Deferred} firing with the etag of an incident.
+        """
+        etags = getattr(self.storage, "incident_etags", None)
+        if etags is None:
+            return self._in_thread(
+                self.storage.etag_for_incident_with_number, number
+            )
+
+        try:
+            number = incident_number(number)
+        except Exception:
+            return fail()
+
+        etag = etags.get(number)
+        if etag is not None:
+            return succeed(etag)
+
+        generation = self._generations.get(number, 0)
+
+        def read(etag):
+            # Don't record what we read if the incident has since been
+            # written.
+            if (
+                self._generations.get(number, 0) == generation and
+                etags.get(number) is None
+            ):
+                etags.record(number, etag)
+            return etag
+
+        d = self._in_thread(
+            self.storage.read_etag_for_incident_with_number, number
+        )
+        d.addCallback(read)
+        return d
+
+
+    def read_incident_with_number_raw(self, number):
+        """
+        @return: a L{Deferred} firing with the stored text of an incident.
+        """
+        return self._in_thread(self.storage.read_incident_with_number_raw, number)
+
+
+    def read_incident_with_number_validated_raw(self, number):
+        """
+        @return: a L{Deferred} firing with the text of an incident: the
+            stored text, if it is stamped as current (see
+            L{IStorage.read_incident_with_number_stamped_raw}), otherwise
+            the incident's text parsed, validated and rendered again.
+        """
+        def load():
+            json, current = self.storage.read_incident_with_number_stamped_raw(
+                number
+            )
+            if current:
+                return json
+
+            incident = Incident.from_json_text(
+                json, number=incident_number(number)
+            )
+            return incident.validate().to_json_text()
+
+        return self._in_thread(load)
+
+
+    def incident_history(self, number):
+        """
+        @return: a L{Deferred} firing with the number, time of writing and
+            etag of each revision of an incident.
+        """
+        return self._in_thread(self.storage.incident_history, number)
+
+
+    def read_incident_as_of_raw(self, number, when):
+        """
+        @return: a L{Deferred} firing with the text of the revision of an
+            incident which was current at the given time.
+        """
+        return self._in_thread(self.storage.read_incident_as_of_raw, number, when)
+
+
+    def read_incident_with_number(self, number):
+        """
+        @return: a L{Deferred} firing with an incident.
+        """
+        try:
+            number = incident_number(number)
+        except Exception:
+            return fail()
+
+        cache = self.storage.incident_cache
+
+        incident = cache.get(number)
+        if incident is not None:
+            return succeed(incident)
+
+        generation = self._generations.get(number, 0)
+
+        def load():
+            json, current = self.storage.read_incident_with_number_stamped_raw(
+                number
+            )
+            return Incident.from_json_text(
+                json, number=number, validate=not current
+            )
+
+        def loaded(incident):
+            # Don't cache what we read if the incident has since been
+            # written.
+            if self._generations.get(number, 0) == generation:
+                cache.put(incident)
+            return incident
+
+        d = self._in_thread(load)
+        d.addCallback(loaded)
+        return d
+
+
+    def read_incidents(self, numbers):
+        """
+        @return: a L{Deferred} firing with a list of the incidents with
+            the given numbers.
+        """
+        d = gatherResults(
+            [self.read_incident_with_number(number) for number in numbers],
+            consumeErrors=True,
+        )
+        d.addErrback(_first_error)
+        return d
+
+
+    def write_incident(self, incident):
+        """
+        Write an incident, after any earlier writes to it.
+
+        @return: a L{Deferred} firing when the write is durable.
+        """
+        return self._locked(incident.number, self._write_incident, incident)
+
+
+    def edit_incident(self, number, edit):
+        """
+        Read an incident, pass it to C{edit}, and write it back, after any
+        earlier writes to it and before any later ones.
+
+        @param edit: a callable which modifies the incident it is given,
+            and may return a L{Deferred}.
+
+        @return: a L{Deferred} firing when the write is durable.
+        """
+        try:
+            number = incident_number(number)
+        except Exception:
+            return fail()
+
+        def read_edit_write():
+            d = self.read_incident_with_number(number)
+
+            def edited(incident):
+                d = maybeDeferred(edit, incident)
+                d.addCallback(lambda _: self._write_incident(incident))
+                return d
+
+            d.addCallback(edited)
+            return d
+
+        return self._locked(number, read_edit_write)
+
+
+    def _write_incident(self, incident):
+        number = incident.number
+        self._generations[number] = self._generations.get(number, 0) + 1
+        return maybeDeferred(self.storage.write_incident, incident)
+
+
+    def next_incident_number(self):
+        """
+        @return: a L{Deferred} firing with a new incident number.
+        """
+        return self._in_thread(self.storage.next_incident_number)
+
+
+
+def _first_error(f):
+    """
+    Unwrap the failure of a L{gatherResults}.
+    """
+    f.trap(FirstError)
+    return f.value.subFailure
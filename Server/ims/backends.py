@@ -0,0 +1,144 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Storage back ends
+"""
+
+__all__ = [
+    "backends",
+    "register_backend",
+    "storage_backend",
+    "make_storage",
+]
+
+from twisted.python.reflect import namedAny
+
+from ims.interfaces import IStorage
+from ims.store import Storage, StorageError
+from ims.sqlstore import SQLiteStorage
+
+
+
+#
+# Back ends by name, each a callable taking a configuration, the
+# directory in which to keep the data store, and an optional reactor,
+# and returning a store providing L{IStorage}.
+#
+backends = {}
+
+
+def register_backend(name, factory):
+    """
+    Register a storage back end, to be selected by setting C{StorageType}
+    to C{name} in the configuration.
+    """
+    backends[name] = factory
+
+
+def storage_backend(name):
+    """
+    Look up a storage back end by name.  A name which isn't registered is
+    taken as the fully qualified name of a back end, such as
+    C{mypackage.mymodule.my_backend}.
+
+    @return: the back end's factory.
+    """
+    factory = backends.get(name, None)
+    if factory is not None:
+        return factory
+
+    if "." in name:
+        try:
+            return namedAny(name)
+        except (ImportError, AttributeError) as e:
+            raise StorageError(
+                "Unable to load storage type {0}: {1}".format(name, e)
+            )
+
+    raise StorageError("Unknown storage type: {0}".format(name))
+
+
+def make_storage(config, path=None, reactor=None):
+    """
+    Make the data store configured by C{config.StorageType}.
+
+    @param path: the directory in which to keep the data store, if not
+        C{config.DataRoot}.
+    """
+    if path is None:
+        path = config.DataRoot
+
+    storage = storage_backend(config.StorageType)(config, path, reactor=reactor)
+
+    if not IStorage.providedBy(storage):
+        raise StorageError(
+            "Storage type {0} doesn't provide IStorage: {1!r}"
+            .format(config.StorageType, storage)
+        )
+
+    return storage
+
+
+
+def files_backend(config, path, reactor=None):
+    """
+    Store incidents in files (see L{ims.store.Storage}).
+    """
+    if config.worker is None:
+        journal_name = ".journal"
+    else:
+        journal_name = ".journal-{0}".format(config.worker)
+
+    return Storage(
+        path,
+        cache_size=config.IncidentCacheSize,
+        journal=config.WriteJournal,
+        journal_commit_delay=config.JournalCommitDelay,
+        reactor=reactor,
+        number_block_size=config.IncidentNumberBlockSize,
+        search_index=config.SearchIndex,
+        secondary_indexes=config.SecondaryIndexes,
+        layout=config.StorageLayout,
+        entry_log=config.ReportEntryLog,
+        compress=config.CompressIncidents,
+        warm_up_processes=config.WarmUpProcesses,
+        shared=config.Workers > 1,
+        journal_name=journal_name,
+        shared_cache_slot_size=config.SharedCacheSlotSize,
+        site=config.SyncSite,
+        sites=config.SyncSites,
+        history=config.IncidentHistory,
+        history_keyframe_interval=config.HistoryKeyframeInterval,
+    )
+
+
+def sqlite_backend(config, path, reactor=None):
+    """
+    Store incidents in an SQLite database (see
+    L{ims.sqlstore.SQLiteStorage}).
+    """
+    if config.Workers > 1:
+        # Other processes' writes would leave the cache stale.
+        cache_size = 0
+    else:
+        cache_size = config.IncidentCacheSize
+
+    return SQLiteStorage(path.child("incidents.sqlite"), cache_size=cache_size)
+
+
+register_backend("files", files_backend)
+register_backend("sqlite", sqlite_backend)
@@ -0,0 +1,763 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Storage benchmark
+"""
+
+__all__ = [
+    "Workload",
+    "run_workload",
+    "footprint",
+    "measure_memory",
+    "measure_dates",
+    "measure_encoding",
+    "main",
+]
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import sys
+import tarfile
+from random import Random
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
+from shutil import rmtree
+from timeit import default_timer as timer
+
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+import ims.data
+from ims.config import Configuration
+from ims.data import JSON, Incident, ReportEntry, Ranger, Location, to_json_text
+from ims.data import parse_date, render_date, rfc3339_date_time_format
+from ims.data import _Record, _parse_date
+from ims.backends import backends, storage_backend
+
+
+
+words = (
+    u"art", u"bike", u"burn", u"camp", u"car", u"child", u"dust", u"fire",
+    u"gate", u"generator", u"lost", u"medical", u"moop", u"music", u"noise",
+    u"playa", u"sound", u"stage", u"theme", u"tent", u"truck", u"water",
+    u"wind", u"yurt",
+)
+
+handles = (
+    u"Bucket", u"Easy E", u"Hubcap", u"Tool", u"Splinter", u"Slumber",
+    u"Safety Phil", u"Tulsa", u"Zeitgeist", u"Lefty",
+)
+
+
+
+class Workload(object):
+    """
+    A repeatable workload for a data store, in phases:
+
+      - C{bulk load}: write C{incidents} new incidents.
+      - C{random reads}: read C{reads} incidents chosen at random, starting
+        with an empty cache.
+      - C{edit bursts}: C{bursts} times, pick an incident and add
+        C{burst_size} report entries to it, one write at a time.
+      - C{searches}: run C{searches} searches for one or two words.
+      - C{listing}: list all incidents C{listings} times.
+
+    Each write is made durable before the next operation, as the server
+    does before responding.  The same C{seed} gives the same operations.
+    """
+
+    phases = (
+        "bulk load", "random reads", "edit bursts", "searches", "listing",
+    )
+
+    def __init__(
+        self, incidents=1000, reads=2000, bursts=50, burst_size=10,
+        searches=200, listings=20, seed=0,
+    ):
+        self.incidents = incidents
+        self.reads = reads
+        self.bursts = bursts
+        self.burst_size = burst_size
+        self.searches = searches
+        self.listings = listings
+        self.seed = seed
+
+
+    def make_incident(self, random, number):
+        created = datetime(2013, 8, 26) + timedelta(seconds=random.randrange(7 * 86400))
+
+        return Incident(
+            number,
+            rangers=[
+                Ranger(handle, None, None)
+                for handle in random.sample(handles, random.randrange(3))
+            ],
+            location=Location(
+                u"{0} camp".format(random.choice(words).title()),
+                u"{0}:{1:02d} & {2}".format(
+                    random.randrange(2, 11), random.choice((0, 15, 30, 45)),
+                    random.choice(u"ABCDEFGHIJKL"),
+                ),
+            ),
+            incident_types=[],
+            summary=self.make_text(random, 4),
+            report_entries=[
+                self.make_entry(random, created)
+                for _ in xrange(random.randrange(1, 6))
+            ],
+            created=created,
+            priority=random.choice((1, 3, 5)),
+        )
+
+
+    def make_entry(self, random, created):
+        return ReportEntry(
+            random.choice(handles), self.make_text(random, 12), created=created,
+        )
+
+
+    def make_text(self, random, count):
+        return u" ".join(random.choice(words) for _ in xrange(count))
+
+
+    def run(self, storage, durable):
+        """
+        Run this workload against a data store.
+
+        @param durable: a callable which waits for a write to be durable,
+            given the result of C{write_incident}.
+
+        @return: a list of the name of each phase, the latencies of its
+            operations and the time taken by the phase as a whole.
+        """
+        random = Random(self.seed)
+        results = []
+
+        def phase(name, operations):
+            latencies = []
+            start = timer()
+            for operation in operations:
+                before = timer()
+                operation()
+                latencies.append(timer() - before)
+            results.append((name, latencies, timer() - start))
+
+        numbers = []
+
+        def load():
+            number = storage.next_incident_number()
+            durable(storage.write_incident(self.make_incident(random, number)))
+            numbers.append(number)
+
+        phase("bulk load", [load] * self.incidents)
+
+        storage.incident_cache.clear()
+
+        def read():
+            storage.read_incident_with_number(random.choice(numbers))
+
+        phase("random reads", [read] * self.reads)
+
+        edited = []
+
+        def edit():
+            if not edited or len(edited) == self.burst_size:
+                edited[:] = [random.choice(numbers)]
+            else:
+                edited.append(edited[0])
+            incident = storage.read_incident_with_number(edited[0]).copy()
+            incident.report_entries.append(
+                self.make_entry(random, datetime(2013, 9, 2))
+            )
+            durable(storage.write_incident(incident))
+
+        phase("edit bursts", [edit] * (self.bursts * self.burst_size))
+
+        def search():
+            terms = random.sample(words, random.randrange(1, 3))
+            list(storage.search_incidents(terms, show_closed=random.random() < 0.5))
+
+        phase("searches", [search] * self.searches)
+
+        def listing():
+            list(storage.list_incidents())
+
+        phase("listing", [listing] * self.listings)
+
+        return results
+
+
+
+def run_workload(config, name, workload, directory=None):
+    """
+    Run a workload against a new data store of the named back end,
+    configured by C{config}, in a temporary directory.
+
+    @return: the results of L{Workload.run}.
+    """
+    path = FilePath(mkdtemp(prefix="ims-benchmark-", dir=directory))
+    try:
+        clock = Clock()
+        storage = storage_backend(name)(config, path.child("data"), reactor=clock)
+        storage.provision()
+
+        def durable(result):
+            if not isinstance(result, Deferred):
+                return
+            written = []
+            result.addBoth(written.append)
+            clock.advance(getattr(config, "JournalCommitDelay", 0))
+            assert written, "Write did not complete"
+
+        try:
+            return workload.run(storage, durable)
+        finally:
+            storage.close()
+    finally:
+        rmtree(path.path)
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(results):
+    """
+    @return: a JSON object with the number of operations, throughput in
+        operations per second and median and 99th percentile latencies in
+        milliseconds of each phase of each back end's results.
+    """
+    summary = {}
+    for name, phases in results:
+        summary[name] = backend = {}
+        for phase, latencies, elapsed in phases:
+            if not latencies:
+                continue
+            backend[phase] = {
+                "operations": len(latencies),
+                "throughput": len(latencies) / elapsed if elapsed else None,
+                "p50": percentile(latencies, 0.50) * 1000,
+                "p99": percentile(latencies, 0.99) * 1000,
+            }
+    return summary
+
+
+def report(summary):
+    """
+    @return: a table of the results in a summary from L{summarize}.
+    """
+    lines = [
+        "{0:<12} {1:<14} {2:>8} {3:>10} {4:>9} {5:>9}".format(
+            "Back end", "Workload", "Ops", "Ops/s", "p50 ms", "p99 ms"
+        )
+    ]
+    for name in sorted(summary):
+        for phase in Workload.phases:
+            if phase not in summary[name]:
+                continue
+            result = summary[name][phase]
+            lines.append(
+                "{0:<12} {1:<14} {2:>8} {3:>10.1f} {4:>9.3f} {5:>9.3f}".format(
+                    name, phase, result["operations"], result["throughput"] or 0,
+                    result["p50"], result["p99"],
+                )
+            )
+    return "\n".join(lines)
+
+
+
+class _Plain(object):
+    """
+    An object which keeps its attributes in an instance dictionary.
+    """
+
+
+
+def footprint(obj, dict_backed=False, seen=None):
+    """
+    Add up the memory used by an object and everything it refers to,
+    counting each object once.
+
+    @param dict_backed: if true, count data objects (see L{ims.data}) as
+        if they kept their attributes in an instance dictionary, as they
+        once did, rather than in slots.
+
+    @return: a number of bytes.
+    """
+    if seen is None:
+        seen = set()
+
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, _Record):
+        values = [getattr(obj, name) for name in obj.__slots__]
+        if dict_backed:
+            plain = _Plain()
+            plain.__dict__.update(zip(obj.__slots__, values))
+            size = sys.getsizeof(plain) + sys.getsizeof(plain.__dict__)
+        else:
+            size = sys.getsizeof(obj)
+    else:
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            values = obj.keys() + obj.values()
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            values = obj
+        else:
+            values = ()
+
+    for value in values:
+        size += footprint(value, dict_backed, seen)
+
+    return size
+
+
+def measure_memory(workload):
+    """
+    Measure the memory used by the incidents a workload loads, parsed as
+    if read from a data store, both as they are and as they would be if
+    data objects kept their attributes in instance dictionaries.
+
+    @return: a JSON object with the number of incidents and report
+        entries and the bytes per incident of each representation.
+    """
+    random = Random(workload.seed)
+
+    incidents = [
+        Incident.from_json_text(
+            workload.make_incident(random, number).to_json_text(), number
+        )
+        for number in xrange(1, workload.incidents + 1)
+    ]
+
+    def per_incident(dict_backed):
+        return footprint(incidents, dict_backed) / float(len(incidents))
+
+    return {
+        "incidents": len(incidents),
+        "report_entries": sum(len(i.report_entries) for i in incidents),
+        "slots": per_incident(False),
+        "dict": per_incident(True),
+    }
+
+
+def report_memory(summary):
+    """
+    @return: a table of the results from L{measure_memory}.
+    """
+    lines = [
+        "{0} incidents, {1} report entries".format(
+            summary["incidents"], summary["report_entries"]
+        ),
+        "{0:<16} {1:>14} {2:>16}".format(
+            "Representation", "Bytes/incident", "Incidents/GiB"
+        ),
+    ]
+    for name, key in (("__slots__", "slots"), ("__dict__", "dict")):
+        lines.append(
+            "{0:<16} {1:>14.0f} {2:>16.0f}".format(
+                name, summary[key], (1 << 30) / summary[key]
+            )
+        )
+    lines.append(
+        "Slots save {0:.0%} per incident".format(
+            1 - summary["slots"] / summary["dict"]
+        )
+    )
+    return "\n".join(lines)
+
+
+def measure_dates(workload, entries=300, repeat=20):
+    """
+    Time parsing and rendering dates with L{parse_date} and L{render_date},
+    with and without its memo of parsed dates, against C{strptime} and
+    C{strftime}, alone and as part of parsing an incident with C{entries}
+    report entries.
+
+    @return: a JSON object with the number of dates in the incident and
+        the microseconds per operation of each implementation.
+    """
+    random = Random(workload.seed)
+
+    incident = workload.make_incident(random, 1)
+    incident.report_entries = [
+        workload.make_entry(
+            random, incident.created + timedelta(seconds=60 * (i + 1))
+        )
+        for i in xrange(entries)
+    ]
+    incident.dispatched = incident.created + timedelta(seconds=30)
+    text = incident.to_json_text()
+
+    dates = [
+        render_date(date_time) for date_time in (
+            incident.created, incident.dispatched
+        )
+    ] + [
+        render_date(entry.created) for entry in incident.report_entries
+    ]
+    date_times = [parse_date(date) for date in dates]
+
+    # The implementations parse_date() and render_date() replaced
+    def strptime(rfc3339):
+        if not rfc3339:
+            return None
+        return datetime.strptime(rfc3339, rfc3339_date_time_format)
+
+    def strftime(date_time):
+        if not date_time:
+            return None
+        return date_time.strftime(rfc3339_date_time_format)
+
+    def unmemoized(rfc3339):
+        if not rfc3339:
+            return None
+        return _parse_date(rfc3339)
+
+    def per_call(f, values):
+        start = timer()
+        for _ in xrange(repeat):
+            for value in values:
+                f(value)
+        return (timer() - start) * 1000000 / (repeat * len(values))
+
+    def parse_incident(parse):
+        ims.data.parse_date = parse
+        try:
+            return per_call(
+                lambda text: Incident.from_json_text(text, 1).report_entries,
+                (text,)
+            )
+        finally:
+            ims.data.parse_date = parse_date
+
+    return {
+        "entries": entries,
+        "dates": len(dates),
+        "parse": {
+            "stdlib": per_call(strptime, dates),
+            "codec": per_call(_parse_date, dates),
+            "memo": per_call(parse_date, dates),
+        },
+        "render": {
+            "stdlib": per_call(strftime, date_times),
+            "codec": per_call(render_date, date_times),
+        },
+        "incident": {
+            "stdlib": parse_incident(strptime),
+            "codec": parse_incident(unmemoized),
+            "memo": parse_incident(parse_date),
+        },
+    }
+
+
+def report_dates(summary):
+    """
+    @return: a table of the results from L{measure_dates}.
+    """
+    lines = [
+        "Microseconds per operation; the incident has {0} report entries "
+        "and {1} dates".format(summary["entries"], summary["dates"]),
+        "{0:<16} {1:>10} {2:>10} {3:>10}".format(
+            "Operation", "stdlib", "codec", "memo"
+        ),
+    ]
+    for name, key in (
+        ("parse date", "parse"),
+        ("render date", "render"),
+        ("parse incident", "incident"),
+    ):
+        lines.append(
+            "{0:<16} {1:>10} {2:>10} {3:>10}".format(name, *(
+                "{0:.2f}".format(summary[key][column])
+                if column in summary[key] else "-"
+                for column in ("stdlib", "codec", "memo")
+            ))
+        )
+    for column in ("stdlib", "codec"):
+        lines.append(
+            "Parsing dates with the {0} takes {1:.0%} of parsing the "
+            "incident".format(
+                column,
+                summary["dates"] * summary["parse"][column] /
+                summary["incident"][column],
+            )
+        )
+    return "\n".join(lines)
+
+
+def dictionary_json_text(incident):
+    """
+    Render an incident as JSON text the way L{Incident.to_json_text} once
+    did, by building a dictionary for L{to_json_text}.
+    """
+    root = {}
+
+    if incident.incident_types is None:
+        incident_types = ()
+    else:
+        incident_types = incident.incident_types
+
+    root[JSON.number.value          ] = incident.number
+    root[JSON.priority.value        ] = incident.priority
+    root[JSON.summary.value         ] = incident.summary
+    root[JSON.location_name.value   ] = incident.location.name
+    root[JSON.location_address.value] = incident.location.address
+    root[JSON.incident_types.value  ] = incident_types
+
+    root[JSON.created.value   ] = render_date(incident.created)
+    root[JSON.dispatched.value] = render_date(incident.dispatched)
+    root[JSON.on_scene.value  ] = render_date(incident.on_scene)
+    root[JSON.closed.value    ] = render_date(incident.closed)
+
+    root[JSON.ranger_handles.value] = [
+        ranger.handle for ranger in incident.rangers
+    ]
+
+    root[JSON.report_entries.value] = [
+        entry.to_json() for entry in incident.report_entries
+    ]
+
+    return to_json_text(root)
+
+
+def measure_encoding(archive, repeat=1000):
+    """
+    Time rendering the incidents in an archive of incident files as JSON
+    text with L{Incident.to_json_text} against building a dictionary for
+    L{to_json_text}, and check that both render the same text.
+
+    @param archive: the L{FilePath} of a gzipped tar file of incident
+        files, named by incident number, such as C{test/incidents.tgz}.
+
+    @return: a JSON object with the number of incidents, their total
+        length, how many rendered the same text both ways, and the
+        microseconds per incident of each.
+    """
+    incidents = []
+
+    tar = tarfile.open(archive.path)
+    try:
+        for member in tar.getmembers():
+            if member.isfile():
+                incident = Incident.from_json_text(
+                    tar.extractfile(member).read(),
+                    int(member.name.split("/")[-1]),
+                )
+                incident.report_entries  # Decode them up front
+                incidents.append(incident)
+    finally:
+        tar.close()
+
+    def per_incident(render):
+        start = timer()
+        for _ in xrange(repeat):
+            for incident in incidents:
+                render(incident)
+        return (timer() - start) * 1000000 / (repeat * len(incidents))
+
+    return {
+        "incidents": len(incidents),
+        "bytes": sum(len(incident.to_json_text()) for incident in incidents),
+        "identical": sum(
+            incident.to_json_text() == dictionary_json_text(incident)
+            for incident in incidents
+        ),
+        "dictionary": per_incident(dictionary_json_text),
+        "encoder": per_incident(Incident.to_json_text),
+    }
+
+
+def report_encoding(summary):
+    """
+    @return: a table of the results from L{measure_encoding}.
+    """
+    lines = [
+        "{0} incidents, {1} bytes of JSON; {2} rendered identically".format(
+            summary["incidents"], summary["bytes"], summary["identical"]
+        ),
+        "{0:<16} {1:>14} {2:>10}".format("Encoder", "us/incident", "MB/s"),
+    ]
+    for name, key in (("dictionary", "dictionary"), ("compiled", "encoder")):
+        lines.append(
+            "{0:<16} {1:>14.2f} {2:>10.1f}".format(
+                name, summary[key],
+                summary["bytes"] / float(summary["incidents"]) / summary[key],
+            )
+        )
+    return "\n".join(lines)
+
+
+
+class Options(usage.Options):
+    """
+    Command line options.
+    """
+    synopsis = "Usage: benchmark_storage [options]"
+
+    optFlags = [
+        ["json", "j", "Write results as JSON."],
+        [
+            "memory", "m",
+            "Measure the memory used by parsed incidents instead of timing "
+            "back ends."
+        ],
+        [
+            "dates", "t",
+            "Time parsing and rendering dates instead of timing back ends."
+        ],
+        [
+            "encoding", "e",
+            "Time rendering the incidents in an archive as JSON instead of "
+            "timing back ends."
+        ],
+    ]
+
+    optParameters = [
+        ["config", "f", None, "Configuration file for back end options."],
+        ["directory", "d", None, "Directory in which to make data stores."],
+        ["incidents", None, 1000, "Number of incidents to load.", int],
+        ["reads", None, 2000, "Number of random reads.", int],
+        ["bursts", None, 50, "Number of edit bursts.", int],
+        ["burst-size", None, 10, "Number of edits per burst.", int],
+        ["searches", None, 200, "Number of searches.", int],
+        ["listings", None, 20, "Number of listings of all incidents.", int],
+        ["seed", None, 0, "Random seed.", int],
+        [
+            "archive", "a", None,
+            "Archive of incident files for --encoding "
+            "(default: test/incidents.tgz)."
+        ],
+    ]
+
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["backends"] = []
+
+
+    def opt_backend(self, name):
+        """
+        Back end to benchmark (may be given more than once; default: all
+        registered back ends).
+        """
+        self["backends"].append(name)
+
+    opt_b = opt_backend
+
+
+    def postOptions(self):
+        if not self["backends"]:
+            self["backends"] = sorted(backends)
+
+        for name in self["backends"]:
+            try:
+                storage_backend(name)
+            except Exception as e:
+                raise usage.UsageError(str(e))
+
+        if self["config"] is None:
+            self["config"] = (
+                FilePath(__file__).parent().parent()
+                .child("conf").child("imsd.conf")
+            )
+        else:
+            self["config"] = FilePath(self["config"])
+
+        if self["archive"] is None:
+            self["archive"] = (
+                FilePath(__file__).parent().parent()
+                .child("test").child("incidents.tgz")
+            )
+        else:
+            self["archive"] = FilePath(self["archive"])
+
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        print >> sys.stderr, "{0}\n\n{1}".format(options, e)
+        sys.exit(64)
+
+    config = Configuration(options["config"], persist=False)
+
+    workload = Workload(
+        incidents=options["incidents"],
+        reads=options["reads"],
+        bursts=options["bursts"],
+        burst_size=options["burst-size"],
+        searches=options["searches"],
+        listings=options["listings"],
+        seed=options["seed"],
+    )
+
+    if options["memory"]:
+        summary = measure_memory(workload)
+        if options["json"]:
+            print to_json_text(summary)
+        else:
+            print report_memory(summary)
+        return
+
+    if options["dates"]:
+        summary = measure_dates(workload)
+        if options["json"]:
+            print to_json_text(summary)
+        else:
+            print report_dates(summary)
+        return
+
+    if options["encoding"]:
+        summary = measure_encoding(options["archive"])
+        if options["json"]:
+            print to_json_text(summary)
+        else:
+            print report_encoding(summary)
+        return
+
+    results = []
+    for name in options["backends"]:
+        print >> sys.stderr, "Benchmarking {0}...".format(name)
+        results.append(
+            (name, run_workload(config, name, workload, options["directory"]))
+        )
+
+    summary = summarize(results)
+
+    if options["json"]:
+        print to_json_text(summary)
+    else:
+        print report(summary)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -32,13 +32,28 @@ from twisted.python.filepath import FilePath
 
 from ims.data import to_json_text
 from ims.dms import DutyManagementSystem
-from ims.store import Storage
+from ims.backends import make_storage
+from ims.asyncstore import AsyncStorage
+from ims.watcher import StorageWatcher
+from ims.replication import WriteStream, ReplicationSource, Follower
+from ims.replication import ReplicationError
+from ims.sync import SyncEngine, SyncClient, SyncError
 
 
 
 class Configuration (object):
-    def __init__(self, configFile):
+    """
+    Server configuration.
+
+    If C{worker} is not C{None}, this is the configuration of the worker
+    process with that index in a multi-process server.  If C{persist} is
+    false, no data store or other persistent objects are set up.
+    """
+
+    def __init__(self, configFile, worker=None, persist=True):
         self.configFile = configFile
+        self.worker = worker
+        self.persist = persist
         self.load()
 
 
@@ -50,6 +65,32 @@ class Configuration (object):
             "Core.DataRoot: {DataRoot}\n"
             "Core.Resources: {Resources}\n"
             "Core.RejectClients: {RejectClients}\n"
+            "Core.StorageType: {StorageType}\n"
+            "Core.IncidentCacheSize: {IncidentCacheSize}\n"
+            "Core.WriteJournal: {WriteJournal}\n"
+            "Core.JournalCommitDelay: {JournalCommitDelay}\n"
+            "Core.IncidentNumberBlockSize: {IncidentNumberBlockSize}\n"
+            "Core.SearchIndex: {SearchIndex}\n"
+            "Core.SecondaryIndexes: {SecondaryIndexes}\n"
+            "Core.StorageLayout: {StorageLayout}\n"
+            "Core.StorageThreads: {StorageThreads}\n"
+            "Core.ReportEntryLog: {ReportEntryLog}\n"
+            "Core.CompressIncidents: {CompressIncidents}\n"
+            "Core.IncidentHistory: {IncidentHistory}\n"
+            "Core.HistoryKeyframeInterval: {HistoryKeyframeInterval}\n"
+            "Core.WarmUpProcesses: {WarmUpProcesses}\n"
+            "Core.WatchDataRoot: {WatchDataRoot}\n"
+            "Core.ServerPort: {ServerPort}\n"
+            "Core.Workers: {Workers}\n"
+            "Core.SharedCacheSlotSize: {SharedCacheSlotSize}\n"
+            "Core.ReplicationSocket: {ReplicationSocket}\n"
+            "Core.ReplicationBacklog: {ReplicationBacklog}\n"
+            "Core.FollowPrimary: {FollowPrimary}\n"
+            "Core.SyncSite: {SyncSite}\n"
+            "Core.SyncSites: {SyncSites}\n"
+            "Core.SyncPeer: {SyncPeer}\n"
+            "Core.SyncUser: {SyncUser}\n"
+            "Core.SyncInterval: {SyncInterval}\n"
             "\n"
             "DMS.Hostname: {DMSHost}\n"
             "DMS.Database: {DMSDatabase}\n"
@@ -75,6 +116,13 @@ class Configuration (object):
             except (NoSectionError, NoOptionError):
                 return default
 
+        def boolFromConfig(section, option, default):
+            value = valueFromConfig(section, option, None)
+            if value is None:
+                return default
+            else:
+                return value.lower() in ("true", "yes", "on", "1")
+
         def filePathFromConfig(section, option, root, segments):
             if section is None:
                 path = None
@@ -123,6 +171,92 @@ class Configuration (object):
         self.RejectClientsRegex = tuple([regex_compile(e) for e in rejectClients])
         log.msg("RejectClients: {0}".format(self.RejectClients))
 
+        self.StorageType = valueFromConfig("Core", "StorageType", "files")
+        log.msg("Storage type: {0}".format(self.StorageType))
+
+        self.IncidentCacheSize = int(valueFromConfig("Core", "IncidentCacheSize", 1000))
+        log.msg("Incident cache size: {0}".format(self.IncidentCacheSize))
+
+        self.WriteJournal = boolFromConfig("Core", "WriteJournal", True)
+        log.msg("Write journal: {0}".format(self.WriteJournal))
+
+        self.JournalCommitDelay = float(valueFromConfig("Core", "JournalCommitDelay", 0.0))
+        log.msg("Journal commit delay: {0}".format(self.JournalCommitDelay))
+
+        self.IncidentNumberBlockSize = int(valueFromConfig("Core", "IncidentNumberBlockSize", 10))
+        log.msg("Incident number block size: {0}".format(self.IncidentNumberBlockSize))
+
+        self.SearchIndex = boolFromConfig("Core", "SearchIndex", True)
+        log.msg("Search index: {0}".format(self.SearchIndex))
+
+        self.SecondaryIndexes = boolFromConfig("Core", "SecondaryIndexes", True)
+        log.msg("Secondary indexes: {0}".format(self.SecondaryIndexes))
+
+        self.StorageLayout = valueFromConfig("Core", "StorageLayout", "flat")
+        log.msg("Storage layout: {0}".format(self.StorageLayout))
+
+        self.StorageThreads = int(valueFromConfig("Core", "StorageThreads", 4))
+        log.msg("Storage threads: {0}".format(self.StorageThreads))
+
+        self.ReportEntryLog = boolFromConfig("Core", "ReportEntryLog", False)
+        log.msg("Report entry log: {0}".format(self.ReportEntryLog))
+
+        self.CompressIncidents = boolFromConfig("Core", "CompressIncidents", False)
+        log.msg("Compress incidents: {0}".format(self.CompressIncidents))
+
+        self.IncidentHistory = boolFromConfig("Core", "IncidentHistory", False)
+        log.msg("Incident history: {0}".format(self.IncidentHistory))
+
+        self.HistoryKeyframeInterval = int(valueFromConfig("Core", "HistoryKeyframeInterval", 20))
+        log.msg("History keyframe interval: {0}".format(self.HistoryKeyframeInterval))
+
+        self.WarmUpProcesses = int(valueFromConfig("Core", "WarmUpProcesses", 0))
+        log.msg("Warm-up processes: {0}".format(self.WarmUpProcesses))
+
+        self.WatchDataRoot = boolFromConfig("Core", "WatchDataRoot", False)
+        log.msg("Watch data root: {0}".format(self.WatchDataRoot))
+
+        self.ServerPort = int(valueFromConfig("Core", "ServerPort", 8080))
+        log.msg("Server port: {0}".format(self.ServerPort))
+
+        self.Workers = int(valueFromConfig("Core", "Workers", 1))
+        log.msg("Workers: {0}".format(self.Workers))
+
+        self.SharedCacheSlotSize = int(valueFromConfig("Core", "SharedCacheSlotSize", 16384))
+        log.msg("Shared cache slot size: {0}".format(self.SharedCacheSlotSize))
+
+        if valueFromConfig("Core", "ReplicationSocket", None) is None:
+            self.ReplicationSocket = None
+        else:
+            self.ReplicationSocket = filePathFromConfig("Core", "ReplicationSocket", self.ServerRoot, ())
+            log.msg("Replication socket: {0}".format(self.ReplicationSocket.path))
+
+        self.ReplicationBacklog = int(valueFromConfig("Core", "ReplicationBacklog", 1000))
+        log.msg("Replication backlog: {0}".format(self.ReplicationBacklog))
+
+        if valueFromConfig("Core", "FollowPrimary", None) is None:
+            self.FollowPrimary = None
+        else:
+            self.FollowPrimary = filePathFromConfig("Core", "FollowPrimary", self.ServerRoot, ())
+            log.msg("Follow primary: {0}".format(self.FollowPrimary.path))
+
+        self.SyncSite = int(valueFromConfig("Core", "SyncSite", 0))
+        log.msg("Sync site: {0}".format(self.SyncSite))
+
+        self.SyncSites = int(valueFromConfig("Core", "SyncSites", 1))
+        log.msg("Sync sites: {0}".format(self.SyncSites))
+
+        self.SyncPeer = valueFromConfig("Core", "SyncPeer", None)
+        log.msg("Sync peer: {0}".format(self.SyncPeer))
+
+        self.SyncUser = valueFromConfig("Core", "SyncUser", None)
+        log.msg("Sync user: {0}".format(self.SyncUser))
+
+        self.SyncPassword = valueFromConfig("Core", "SyncPassword", None)
+
+        self.SyncInterval = float(valueFromConfig("Core", "SyncInterval", 60))
+        log.msg("Sync interval: {0}".format(self.SyncInterval))
+
         self.DMSHost     = valueFromConfig("DMS", "Hostname", None)
         self.DMSDatabase = valueFromConfig("DMS", "Database", None)
         self.DMSUsername = valueFromConfig("DMS", "Username", None)
@@ -152,10 +286,15 @@ class Configuration (object):
             "Junk",
         )
 
+        self.IncidentTypesJSON = to_json_text(self.IncidentTypes)
+
         #
         # Persist some objects
         #
 
+        if not self.persist:
+            return
+
         self.dms = DutyManagementSystem(
             host     = self.DMSHost,
             database = self.DMSDatabase,
@@ -163,8 +302,56 @@ class Configuration (object):
             password = self.DMSPassword,
         )
 
-        storage = Storage(self.DataRoot)
+        shared = self.Workers > 1
+
+        storage = make_storage(self)
         storage.provision()
         self.storage = storage
 
-        self.IncidentTypesJSON = to_json_text(self.IncidentTypes)
+        self.async_storage = AsyncStorage(
+            storage, pool_size=self.StorageThreads
+        )
+
+        if (self.WatchDataRoot or shared) and self.StorageType == "files":
+            self.storage_watcher = StorageWatcher(storage)
+        else:
+            self.storage_watcher = None
+
+        if self.ReplicationSocket is not None or self.FollowPrimary is not None:
+            if shared or self.StorageType != "files":
+                raise ReplicationError(
+                    "Replication needs file storage and a single worker"
+                )
+
+        if self.ReplicationSocket is not None:
+            self.replication_source = ReplicationSource(
+                WriteStream(storage, backlog=self.ReplicationBacklog),
+                self.ReplicationSocket,
+                storage=self.async_storage,
+            )
+        else:
+            self.replication_source = None
+
+        if self.FollowPrimary is not None:
+            self.follower = Follower(self.async_storage, self.FollowPrimary)
+        else:
+            self.follower = None
+
+        if self.SyncSites > 1:
+            if shared or self.StorageType != "files" or self.follower is not None:
+                raise SyncError(
+                    "Sync needs file storage and a single worker, "
+                    "and can't be used by a follower"
+                )
+            self.sync_engine = SyncEngine(self.async_storage, self.SyncSite)
+        else:
+            self.sync_engine = None
+
+        if self.sync_engine is not None and self.SyncPeer is not None:
+            self.sync_client = SyncClient(
+                self.sync_engine, self.SyncPeer,
+                self.SyncUser, self.SyncPassword,
+                interval=self.SyncInterval,
+            )
+        else:
+            self.sync_client = None
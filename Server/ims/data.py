@@ -31,12 +31,22 @@ __all__ = [
 ]
 
 from json import dumps, load as from_json_io, loads as from_json_text
+from json.encoder import encode_basestring_ascii
 from datetime import datetime
 
 from twisted.python.constants import Values, ValueConstant
 
 rfc3339_date_time_format = "%Y-%m-%dT%H:%M:%SZ"
 
+# Versions of the JSON text which Incident.to_json_text() renders and of
+# the rules which Incident.validate() enforces.  Stores stamp incidents
+# with them as they are written, and trust text stamped with the current
+# versions to be valid and rendered as we would render it, so bump the
+# schema version when the text rendered changes and the validation
+# version when validation becomes stricter.
+schema_version = 1
+validation_version = 1
+
 
 
 class JSON(Values):
@@ -87,10 +97,48 @@ class InvalidDataError (ValueError):
 
 
 
-class Incident (object):
+class _Record(object):
+    """
+    Base class for data objects.  Their attributes are kept in slots
+    rather than in a dictionary per instance, which keeps them small
+    enough to hold many thousands in memory; subclasses list their
+    attributes in C{__slots__}.
+    """
+    __slots__ = ()
+
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+
+class Incident (_Record):
     """
     Incident
+
+    An incident read from JSON keeps its report entries as JSON until
+    C{report_entries} is first used, so that reading an incident only to
+    look at its other attributes doesn't pay to decode them.
     """
+    __slots__ = (
+        "number",
+        "rangers",
+        "location",
+        "incident_types",
+        "summary",
+        "_report_entries",
+        "_report_entries_json",
+        "created",
+        "dispatched",
+        "on_scene",
+        "closed",
+        "priority",
+    )
 
     @classmethod
     def from_json_text(cls, text, number=None, validate=True):
@@ -122,12 +170,6 @@ class Incident (object):
         if type(root) is not dict:
             raise InvalidDataError("JSON incident must be a dict")
 
-        def parse_date(rfc3339):
-            if not rfc3339:
-                return None
-            else:
-                return datetime.strptime(rfc3339, rfc3339_date_time_format)
-
         location = Location(
             name    = root.get(JSON.location_name.value   , None),
             address = root.get(JSON.location_address.value, None),
@@ -142,15 +184,7 @@ class Incident (object):
                 for handle in ranger_handles
             ]
 
-        report_entries = [
-            ReportEntry(
-                author = entry.get(JSON.author.value, u"<unknown>"),
-                text = entry.get(JSON.text.value, None),
-                created = parse_date(entry.get(JSON.created.value, None)),
-                system_entry = entry.get(JSON.system_entry.value, False),
-            )
-            for entry in root.get(JSON.report_entries.value, ())
-        ]
+        report_entries_json = root.get(JSON.report_entries.value, ())
 
         incident = cls(
             number         = number,
@@ -159,15 +193,23 @@ class Incident (object):
             location       = location,
             rangers        = rangers,
             incident_types = root.get(JSON.incident_types.value, None),
-            report_entries = report_entries,
+            report_entries = (),
             created        = parse_date(root.get(JSON.created.value, None)),
             dispatched     = parse_date(root.get(JSON.dispatched.value, None)),
             on_scene       = parse_date(root.get(JSON.on_scene.value, None)),
             closed         = parse_date(root.get(JSON.closed.value, None)),
         )
 
+        if type(report_entries_json) is list and report_entries_json:
+            # Decoded when first used
+            incident._report_entries_json = (report_entries_json, False)
+        else:
+            incident.report_entries = [
+                ReportEntry.from_json(entry) for entry in report_entries_json
+            ]
+
         if validate:
-            incident.validate()
+            incident.validate(report_entries=False)
 
         return incident
 
@@ -217,6 +259,30 @@ class Incident (object):
         self.priority       = priority
 
 
+    @property
+    def report_entries(self):
+        if self._report_entries_json is not None:
+            report_entries_json, validate = self._report_entries_json
+
+            report_entries = [
+                ReportEntry.from_json(entry) for entry in report_entries_json
+            ]
+            if validate:
+                for report_entry in report_entries:
+                    report_entry.validate()
+
+            self._report_entries = report_entries
+            self._report_entries_json = None
+
+        return self._report_entries
+
+
+    @report_entries.setter
+    def report_entries(self, report_entries):
+        self._report_entries = report_entries
+        self._report_entries_json = None
+
+
     def __str__(self):
         return (
             "{self.number}: {self.summary}"
@@ -277,9 +343,55 @@ class Incident (object):
             return NotImplemented
 
 
-    def validate(self):
+    def copy(self):
+        """
+        Make a copy of this incident which shares no mutable state with
+        the original.
+        """
+        if self.rangers is None:
+            rangers = None
+        else:
+            rangers = [ranger.copy() for ranger in self.rangers]
+
+        if self.location is None:
+            location = None
+        else:
+            location = self.location.copy()
+
+        if self._report_entries_json is not None:
+            # Still JSON, which is never modified; leave it to the copy to
+            # decode.
+            report_entries = ()
+        elif self._report_entries is None:
+            report_entries = None
+        else:
+            report_entries = [entry.copy() for entry in self._report_entries]
+
+        incident = self.__class__(
+            number         = self.number,
+            rangers        = rangers,
+            location       = location,
+            incident_types = self.incident_types,
+            summary        = self.summary,
+            report_entries = report_entries,
+            created        = self.created,
+            dispatched     = self.dispatched,
+            on_scene       = self.on_scene,
+            closed         = self.closed,
+            priority       = self.priority,
+        )
+        incident._report_entries_json = self._report_entries_json
+
+        return incident
+
+
+    def validate(self, report_entries=True):
         """
         Validate this incident.
+
+        @param report_entries: if false, don't decode report entries which
+            are still JSON in order to validate them; they are validated as
+            they are decoded instead.
         """
         if self.rangers is None:
             raise InvalidDataError("Rangers may not be None.")
@@ -302,7 +414,9 @@ class Incident (object):
                 "Incident summary must be unicode, not {0!r}".format(self.summary)
             )
 
-        if self.report_entries is not None:
+        if self._report_entries_json is not None and not report_entries:
+            self._report_entries_json = (self._report_entries_json[0], True)
+        elif self.report_entries is not None:
             for report_entry in self.report_entries:
                 report_entry.validate()
 
@@ -339,58 +453,41 @@ class Incident (object):
         return self
 
 
-    def to_json_text(self):
-        root = {}
-
-        def render_date(date_time):
-            if not date_time:
-                return None
-            else:
-                return date_time.strftime(rfc3339_date_time_format)
-
-        if self.incident_types is None:
-            incident_types = ()
-        else:
-            incident_types = self.incident_types
-
-        root[JSON.number.value          ] = self.number
-        root[JSON.priority.value        ] = self.priority
-        root[JSON.summary.value         ] = self.summary
-        root[JSON.location_name.value   ] = self.location.name
-        root[JSON.location_address.value] = self.location.address
-        root[JSON.incident_types.value  ] = incident_types
-
-        root[JSON.created.value   ] = render_date(self.created)
-        root[JSON.dispatched.value] = render_date(self.dispatched)
-        root[JSON.on_scene.value  ] = render_date(self.on_scene)
-        root[JSON.closed.value    ] = render_date(self.closed)
-
-        root[JSON.ranger_handles.value] = [ranger.handle for ranger in self.rangers]
-
-        root[JSON.report_entries.value] = [
-            {
-                JSON.author.value: entry.author,
-                JSON.text.value: entry.text,
-                JSON.created.value: render_date(entry.created),
-                JSON.system_entry.value: entry.system_entry,
-            }
-            for entry in self.report_entries
-        ]
-
+    def to_json_text(self, include_report_entries=True):
+        """
+        @param include_report_entries: if false, render the incident with
+            no report entries.
+        """
         try:
-            return to_json_text(root)
+            return _encoder.incident(self, include_report_entries)
         except TypeError:
             raise AssertionError(
                 "{0!r}.to_json_text() generated unserializable data: {1!r}"
-                .format(self.__class__.__name__, root)
+                .format(self.__class__.__name__, self)
             )
 
 
 
-class ReportEntry(object):
+class ReportEntry(_Record):
     """
     Report entry
     """
+    __slots__ = (
+        "author",
+        "text",
+        "created",
+        "system_entry",
+    )
+
+    @classmethod
+    def from_json(cls, root):
+        return cls(
+            author = root.get(JSON.author.value, u"<unknown>"),
+            text = root.get(JSON.text.value, None),
+            created = parse_date(root.get(JSON.created.value, None)),
+            system_entry = root.get(JSON.system_entry.value, False),
+        )
+
 
     def __init__(self, author, text, created=None, system_entry=False):
         if created is None:
@@ -445,6 +542,38 @@ class ReportEntry(object):
             return NotImplemented
 
 
+    def copy(self):
+        return self.__class__(
+            author       = self.author,
+            text         = self.text,
+            created      = self.created,
+            system_entry = self.system_entry,
+        )
+
+
+    def to_json(self):
+        return {
+            JSON.author.value: self.author,
+            JSON.text.value: self.text,
+            JSON.created.value: render_date(self.created),
+            JSON.system_entry.value: self.system_entry,
+        }
+
+
+    def to_json_text(self):
+        """
+        @return: C{to_json_text(self.to_json())}, rendered without building
+            the dictionary.
+        """
+        try:
+            return _encoder.entry(self)
+        except TypeError:
+            raise AssertionError(
+                "{0!r}.to_json_text() generated unserializable data: {1!r}"
+                .format(self.__class__.__name__, self)
+            )
+
+
     def validate(self):
         if self.author is not None and type(self.author) is not unicode:
             raise InvalidDataError(
@@ -463,10 +592,15 @@ class ReportEntry(object):
 
 
 
-class Ranger(object):
+class Ranger(_Record):
     """
     Ranger
     """
+    __slots__ = (
+        "handle",
+        "name",
+        "status",
+    )
 
     def __init__(self, handle, name, status):
         if not handle:
@@ -510,6 +644,14 @@ class Ranger(object):
             return NotImplemented
 
 
+    def copy(self):
+        return self.__class__(
+            handle = self.handle,
+            name   = self.name,
+            status = self.status,
+        )
+
+
     def validate(self):
         if type(self.handle) is not unicode:
             raise InvalidDataError(
@@ -523,10 +665,14 @@ class Ranger(object):
 
 
 
-class Location(object):
+class Location(_Record):
     """
     Location
     """
+    __slots__ = (
+        "name",
+        "address",
+    )
 
     def __init__(self, name=None, address=None):
         self.name    = name
@@ -572,6 +718,13 @@ class Location(object):
             return NotImplemented
 
 
+    def copy(self):
+        return self.__class__(
+            name    = self.name,
+            address = self.address,
+        )
+
+
     def validate(self):
         if self.name and type(self.name) is not unicode:
             raise InvalidDataError(
@@ -587,3 +740,280 @@ class Location(object):
 
 def to_json_text(obj):
     return dumps(obj, separators=(',',':'))
+
+
+# Recently parsed dates, by text.  Report entries added in a burst, and
+# incidents read more than once, repeat the same times.
+_parsed_dates = {}
+_parsed_dates_size = 4096
+
+
+def parse_date(rfc3339):
+    """
+    Parse a date in the form C{YYYY-MM-DDTHH:MM:SSZ}.
+
+    @return: a L{datetime}, or C{None} if C{rfc3339} is empty.
+
+    @raise InvalidDataError: if C{rfc3339} is not a valid date.
+    """
+    if not rfc3339:
+        return None
+
+    if not isinstance(rfc3339, basestring):
+        # Not a valid date, and perhaps not hashable, so not memoized.
+        raise InvalidDataError("Invalid date: {0!r}".format(rfc3339))
+
+    date_time = _parsed_dates.get(rfc3339, None)
+    if date_time is None:
+        date_time = _parse_date(rfc3339)
+        if len(_parsed_dates) >= _parsed_dates_size:
+            _parsed_dates.clear()
+        _parsed_dates[rfc3339] = date_time
+
+    return date_time
+
+
+def _parse_date(rfc3339):
+    #
+    # Dates are almost always in exactly the form we render, which is
+    # faster to take apart by position than with strptime().
+    #
+    try:
+        text = str(rfc3339)
+    except (UnicodeError, TypeError, ValueError):
+        text = ""
+
+    if (
+        len(text) == 20 and
+        text[4] == "-" and text[7] == "-" and text[10] == "T" and
+        text[13] == ":" and text[16] == ":" and text[19] == "Z"
+    ):
+        digits = (
+            text[0:4] + text[5:7] + text[8:10] +
+            text[11:13] + text[14:16] + text[17:19]
+        )
+        if digits.isdigit():
+            # One int() is cheaper than one per field.
+            n = int(digits)
+            try:
+                return datetime(
+                    n // 10000000000, n // 100000000 % 100,
+                    n // 1000000 % 100, n // 10000 % 100,
+                    n // 100 % 100, n % 100,
+                )
+            except ValueError:
+                raise InvalidDataError("Invalid date: {0!r}".format(rfc3339))
+
+    # Fall back to strptime() for anything else it would accept, such as
+    # fields which aren't zero-padded.
+    try:
+        return datetime.strptime(rfc3339, rfc3339_date_time_format)
+    except (ValueError, TypeError):
+        raise InvalidDataError("Invalid date: {0!r}".format(rfc3339))
+
+
+def render_date(date_time):
+    """
+    Render a date in the form C{YYYY-MM-DDTHH:MM:SSZ}.
+
+    @return: the rendered date, or C{None} if C{date_time} is empty.
+    """
+    if not date_time:
+        return None
+    elif not date_time.microsecond and date_time.tzinfo is None:
+        # isoformat() renders this form, and is faster than formatting.
+        return date_time.isoformat() + "Z"
+    else:
+        return "%04d-%02d-%02dT%02d:%02d:%02dZ" % (
+            date_time.year, date_time.month, date_time.day,
+            date_time.hour, date_time.minute, date_time.second,
+        )
+
+
+
+class _Encoder(object):
+    """
+    Renders incidents and report entries as JSON text, exactly as
+    L{to_json_text} would render the dictionaries of them built by
+    L{Incident.to_json_text} and L{ReportEntry.to_json}, but without
+    building the dictionaries.
+
+    The order of their keys (which is the order in which such a
+    dictionary iterates) and the escaped keys are worked out once, into a
+    template for each.  Encoded short strings which recur, such as Ranger
+    handles, incident types and authors, are kept in a bounded memo, as
+    are encoded dates, since each write of an incident encodes all of its
+    report entries again.
+    """
+
+    memo_size = 4096
+    memo_length = 64
+
+
+    def __init__(self):
+        self.memo = {}
+        self.dates = {}
+
+        self.incident_template = self.compile((
+            JSON.number,
+            JSON.priority,
+            JSON.summary,
+            JSON.location_name,
+            JSON.location_address,
+            JSON.incident_types,
+            JSON.created,
+            JSON.dispatched,
+            JSON.on_scene,
+            JSON.closed,
+            JSON.ranger_handles,
+            JSON.report_entries,
+        ))
+
+        self.entry_template = self.compile((
+            JSON.author,
+            JSON.text,
+            JSON.created,
+            JSON.system_entry,
+        ))
+
+
+    def compile(self, keys):
+        """
+        @param keys: the keys of a dictionary, in the order in which they
+            are added to it.
+
+        @return: a format string which renders the dictionary, given the
+            encoded value for each key as arguments in the same order as
+            C{keys}.
+        """
+        # The order in which the dictionary iterates
+        order = {}
+        for index, key in enumerate(keys):
+            order[key.value] = index
+
+        return "{{" + ",".join(
+            "{0}:{{{1}}}".format(
+                encode_basestring_ascii(key)
+                .replace("{", "{{").replace("}", "}}"),
+                index,
+            )
+            for key, index in order.iteritems()
+        ) + "}}"
+
+
+    def incident(self, incident, include_report_entries=True):
+        if include_report_entries:
+            entry = self.entry
+            entries = "[" + ",".join([
+                entry(report_entry)
+                for report_entry in incident.report_entries
+            ]) + "]"
+        else:
+            entries = "[]"
+
+        location = incident.location
+
+        return self.incident_template.format(
+            self.value(incident.number),
+            self.value(incident.priority),
+            self.value(incident.summary),
+            self.string(location.name),
+            self.string(location.address),
+            self.strings(incident.incident_types),
+            self.date(incident.created),
+            self.date(incident.dispatched),
+            self.date(incident.on_scene),
+            self.date(incident.closed),
+            self.strings([ranger.handle for ranger in incident.rangers]),
+            entries,
+        )
+
+
+    def entry(self, entry):
+        # Called for every report entry, so the common cases are inline.
+        author = entry.author
+        if type(author) is unicode:
+            encoded_author = self.memo.get(author, None)
+            if encoded_author is None:
+                encoded_author = self.string(author)
+        else:
+            encoded_author = self.value(author)
+
+        text = entry.text
+        if type(text) is unicode:
+            encoded_text = encode_basestring_ascii(text)
+        else:
+            encoded_text = self.value(text)
+
+        created = entry.created
+        encoded_created = self.dates.get(created, None)
+        if encoded_created is None:
+            encoded_created = self.date(created)
+
+        system_entry = entry.system_entry
+        if system_entry is False:
+            encoded_system_entry = "false"
+        else:
+            encoded_system_entry = self.value(system_entry)
+
+        return self.entry_template.format(
+            encoded_author, encoded_text, encoded_created, encoded_system_entry,
+        )
+
+
+    def value(self, value):
+        if value is None:
+            return "null"
+        elif value is True:
+            return "true"
+        elif value is False:
+            return "false"
+        elif type(value) is int:
+            return str(value)
+        elif isinstance(value, basestring):
+            return encode_basestring_ascii(value)
+        else:
+            return to_json_text(value)
+
+
+    def string(self, value):
+        """
+        Encode a value which is usually a short string that recurs.
+        """
+        if not isinstance(value, basestring):
+            return self.value(value)
+
+        encoded = self.memo.get(value, None)
+        if encoded is None:
+            encoded = encode_basestring_ascii(value)
+            if len(value) <= self.memo_length:
+                if len(self.memo) >= self.memo_size:
+                    self.memo.clear()
+                self.memo[value] = encoded
+
+        return encoded
+
+
+    def strings(self, values):
+        if values is None:
+            return "[]"
+        else:
+            return "[" + ",".join([self.string(v) for v in values]) + "]"
+
+
+    def date(self, date_time):
+        encoded = self.dates.get(date_time, None)
+        if encoded is None:
+            text = render_date(date_time)
+            if text is None:
+                return "null"
+            encoded = '"' + text + '"'
+            if len(self.dates) >= self.memo_size:
+                self.dates.clear()
+            self.dates[date_time] = encoded
+
+        return encoded
+
+
+
+_encoder = _Encoder()
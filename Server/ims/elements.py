@@ -24,6 +24,7 @@ __all__ = [
     "incidents_from_query",
 ]
 
+from twisted.internet.defer import succeed
 from twisted.web.template import Element, renderer
 from twisted.web.template import XMLFile
 
@@ -77,35 +78,41 @@ class DispatchQueueElement(BaseElement):
             else:
                 return d.strftime("%a.%H:%M")
 
-        data = []
-
-        for number, etag in incidents_from_query(self.ims, request):
-            incident = self.ims.storage.read_incident_with_number(number)
-
-            if incident.summary:
-                summary = incident.summary
-            elif incident.report_entries:
-                for entry in incident.report_entries:
-                    if not entry.system_entry:
-                        summary = entry.text
-                        break
-            else:
-                summary = ""
-
-            data.append([
-                incident.number,
-                incident.priority,
-                format_date(incident.created),
-                format_date(incident.dispatched),
-                format_date(incident.on_scene),
-                format_date(incident.closed),
-                ", ".join(ranger.handle for ranger in incident.rangers),
-                str(incident.location),
-                ", ".join(incident.incident_types),
-                summary,
-            ])
-
-        return to_json_text(data)
+        def format_data(incidents):
+            data = []
+
+            for incident in incidents:
+                if incident.summary:
+                    summary = incident.summary
+                elif incident.report_entries:
+                    for entry in incident.report_entries:
+                        if not entry.system_entry:
+                            summary = entry.text
+                            break
+                else:
+                    summary = ""
+
+                data.append([
+                    incident.number,
+                    incident.priority,
+                    format_date(incident.created),
+                    format_date(incident.dispatched),
+                    format_date(incident.on_scene),
+                    format_date(incident.closed),
+                    ", ".join(ranger.handle for ranger in incident.rangers),
+                    str(incident.location),
+                    ", ".join(incident.incident_types),
+                    summary,
+                ])
+
+            return to_json_text(data)
+
+        d = incidents_from_query(self.ims, request)
+        d.addCallback(lambda incidents: self.ims.storage.read_incidents(
+            number for number, etag in incidents
+        ))
+        d.addCallback(format_data)
+        return d
 
 
     @renderer
@@ -143,16 +150,23 @@ class DispatchQueueElement(BaseElement):
 
 
 def incidents_from_query(ims, request):
-    if not hasattr(request, "ims_incidents"):
-        if request.args:
-            request.ims_incidents = ims.storage.search_incidents(
-                terms       = terms_from_query(request),
-                show_closed = show_closed_from_query(request),
-            )
-        else:
-            request.ims_incidents = ims.storage.list_incidents()
-
-    return request.ims_incidents
+    if hasattr(request, "ims_incidents"):
+        return succeed(request.ims_incidents)
+
+    if request.args:
+        d = ims.storage.search_incidents(
+            terms       = terms_from_query(request),
+            show_closed = show_closed_from_query(request),
+        )
+    else:
+        d = ims.storage.list_incidents()
+
+    def got_incidents(incidents):
+        request.ims_incidents = incidents
+        return incidents
+
+    d.addCallback(got_incidents)
+    return d
 
 
 def terms_from_query(request):
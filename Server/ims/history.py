@@ -0,0 +1,377 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Incident revision history
+"""
+
+__all__ = [
+    "HistoryError",
+    "IncidentHistory",
+    "revision_delta",
+    "apply_revision_delta",
+]
+
+import os
+from hashlib import sha1 as etag_hash
+
+from twisted.python import log
+
+from ims.data import JSON, to_json_text, from_json_text
+
+
+
+class HistoryError(RuntimeError):
+    """
+    Incident history error.
+    """
+
+
+
+def revision_delta(successor, revision):
+    """
+    Describe how to rebuild a revision of an incident from the revision
+    which followed it, both given as JSON objects.
+
+    Report entries are only ever added to the end of an incident, so the
+    delta holds the number of entries the two revisions share and any
+    entries of the earlier revision after those, and the earlier values
+    of any other fields which differ.
+
+    @return: a JSON object.
+    """
+    entries_key = JSON.report_entries.value
+
+    changed = {}
+    for key, value in revision.iteritems():
+        if key != entries_key and successor.get(key, None) != value:
+            changed[key] = value
+
+    removed = [
+        key for key in successor
+        if key != entries_key and key not in revision
+    ]
+
+    ours = revision.get(entries_key, None) or []
+    theirs = successor.get(entries_key, None) or []
+    shared = 0
+    for entry, other in zip(ours, theirs):
+        if entry != other:
+            break
+        shared += 1
+
+    delta = {}
+    if changed:
+        delta["changed"] = changed
+    if removed:
+        delta["removed"] = removed
+    if shared != len(theirs) or shared != len(ours):
+        delta["entries"] = [shared, ours[shared:]]
+
+    return delta
+
+
+def apply_revision_delta(successor, delta):
+    """
+    Rebuild a revision of an incident from the revision which followed
+    it and a delta from L{revision_delta}.
+
+    @return: a JSON object.
+    """
+    entries_key = JSON.report_entries.value
+
+    revision = dict(successor)
+
+    for key in delta.get("removed", ()):
+        revision.pop(key, None)
+
+    revision.update(delta.get("changed", {}))
+
+    if "entries" in delta:
+        shared, rest = delta["entries"]
+        revision[entries_key] = (
+            (successor.get(entries_key, None) or [])[:shared] + rest
+        )
+
+    return revision
+
+
+
+class IncidentHistory(object):
+    """
+    The prior revisions of an incident, kept in an append-only file.
+
+    Each line of the file is a JSON object describing one revision of the
+    incident, in order::
+
+        {"revision": <n>, "written": <time>, "etag": <etag>, ...}
+
+    where C{time} is when the revision was written.  The latest revision
+    is the incident itself; each revision's record also holds how to
+    rebuild the revision before it from it, as a delta (see
+    L{revision_delta}) under C{delta}, or, for every
+    C{keyframe_interval}th revision, as a full copy under C{keyframe}.
+    A revision is rebuilt by applying deltas back from the nearest later
+    copy, so that no more than C{keyframe_interval} deltas are applied
+    to rebuild any revision.
+
+    If the incident is changed other than through the history (for
+    example, if it was written before the history was kept), the
+    unrecorded revision is recorded without a way to rebuild the revision
+    before it, and revisions since the last keyframe before it can no
+    longer be rebuilt.
+    """
+
+    def __init__(self, fp, keyframe_interval=20):
+        self.fp = fp
+        self.keyframe_interval = keyframe_interval
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.fp})".format(self=self)
+
+
+    def records(self):
+        """
+        @return: the records of every revision, oldest first.
+        """
+        return self._read()[0]
+
+
+    def _read(self):
+        """
+        @return: the records of every revision, and the size of the part
+            of the file holding them.
+        """
+        try:
+            handle = self.fp.open("r")
+        except (IOError, OSError):
+            return [], 0
+
+        try:
+            lines = handle.read().split("\n")
+        finally:
+            handle.close()
+
+        if lines[-1]:
+            log.msg("Ignoring incomplete history record in {0}".format(self.fp.path))
+        lines.pop()
+
+        records = []
+        size = 0
+        for line in lines:
+            try:
+                records.append(from_json_text(line))
+            except ValueError:
+                log.msg("Ignoring invalid history record in {0}".format(self.fp.path))
+                break
+            size += len(line) + 1
+
+        return records, size
+
+
+    def _last(self):
+        """
+        @return: the record of the latest revision, or C{None} if there is
+            none, and the size of the part of the file up to the end of
+            it, reading only the end of the file.
+        """
+        try:
+            handle = self.fp.open("r")
+        except (IOError, OSError):
+            return None, 0
+
+        try:
+            handle.seek(0, os.SEEK_END)
+            position = handle.tell()
+            tail = ""
+            while position > 0:
+                size = min(4096, position)
+                position -= size
+                handle.seek(position)
+                tail = handle.read(size) + tail
+
+                # Stop once we have the last complete line.
+                end = tail.rfind("\n")
+                if end >= 0 and (position == 0 or tail.rfind("\n", 0, end) >= 0):
+                    break
+        finally:
+            handle.close()
+
+        end = tail.rfind("\n")
+        if end < 0:
+            return None, 0
+
+        line = tail[tail.rfind("\n", 0, end) + 1:end]
+        try:
+            return from_json_text(line), position + end + 1
+        except ValueError:
+            raise HistoryError("Invalid history record in {0}".format(self.fp.path))
+
+
+    def record(self, previous, current, written, previous_written=None, replaying=False):
+        """
+        Record a new revision of the incident.
+
+        @param previous: the JSON text of the incident before the
+            revision, or C{None} if it is new.
+        @param current: the JSON text of the revision.
+        @param written: when the revision was written, as RFC 3339 text.
+        @param previous_written: when the previous revision was written,
+            if it was not recorded.
+        @param replaying: whether the write is being replayed from a
+            journal, in which case it is not recorded if any revision has
+            the same etag.
+
+        @return: whether the revision was recorded.
+        """
+        etag = etag_hash(current).hexdigest()
+
+        if replaying:
+            records, size = self._read()
+            if any(r["etag"] == etag for r in records):
+                return False
+            last = records[-1] if records else None
+        else:
+            last, size = self._last()
+            if last is not None and last["etag"] == etag:
+                return False
+
+        if last is None:
+            number = 0
+        else:
+            number = last["revision"]
+
+        lines = []
+
+        if previous is None:
+            rebuild = {}
+        else:
+            previous_etag = etag_hash(previous).hexdigest()
+            if previous_etag == etag:
+                return False
+
+            if last is None or last["etag"] != previous_etag:
+                number += 1
+                lines.append({
+                    "revision": number,
+                    "written": previous_written,
+                    "etag": previous_etag,
+                })
+
+            if number % self.keyframe_interval == 0:
+                rebuild = {"keyframe": from_json_text(previous)}
+            else:
+                rebuild = {
+                    "delta": revision_delta(
+                        from_json_text(current), from_json_text(previous)
+                    )
+                }
+
+        record = {"revision": number + 1, "written": written, "etag": etag}
+        record.update(rebuild)
+        lines.append(record)
+
+        text = "".join(to_json_text(line) + "\n" for line in lines)
+
+        try:
+            # Truncate first, dropping any record torn by a crash.
+            try:
+                fd = os.open(self.fp.path, os.O_WRONLY | os.O_CREAT, 0644)
+            except (IOError, OSError):
+                # The incident's directory may not exist yet.
+                parent = self.fp.parent()
+                if parent.exists():
+                    raise
+                parent.makedirs()
+                fd = os.open(self.fp.path, os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                os.ftruncate(fd, size)
+                os.lseek(fd, size, os.SEEK_SET)
+                while text:
+                    text = text[os.write(fd, text):]
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            raise HistoryError(
+                "Unable to write history {0}: {1}".format(self.fp.path, e)
+            )
+
+        return True
+
+
+    def revision_as_of(self, records, when):
+        """
+        @param when: RFC 3339 text.
+
+        @return: the number of the revision current at the given time, or
+            C{None} if there was none.
+        """
+        revision = None
+        for record in records:
+            written = record["written"]
+            if written is not None and written > when:
+                break
+            revision = record["revision"]
+        return revision
+
+
+    def rebuild(self, records, current, revision):
+        """
+        Rebuild a revision of the incident.
+
+        @param records: the history's records.
+        @param current: the JSON text of the incident.
+
+        @return: the revision, as a JSON object.
+        """
+        by_revision = dict((r["revision"], r) for r in records)
+
+        if revision not in by_revision:
+            raise HistoryError("No such revision: {0}".format(revision))
+
+        latest = records[-1]["revision"]
+        current_ok = (
+            current is not None and
+            etag_hash(current).hexdigest() == records[-1]["etag"]
+        )
+
+        # Find the nearest revision from here on of which we have a copy.
+        start = None
+        for number in xrange(revision, latest + 1):
+            if number == latest:
+                if current_ok:
+                    start, copy = number, from_json_text(current)
+                break
+            following = by_revision.get(number + 1, {})
+            if "keyframe" in following:
+                start, copy = number, following["keyframe"]
+                break
+
+        if start is None:
+            raise HistoryError(
+                "Revision {0} is no longer available".format(revision)
+            )
+
+        for number in xrange(start, revision, -1):
+            delta = by_revision.get(number, {}).get("delta", None)
+            if delta is None:
+                raise HistoryError(
+                    "Revision {0} is no longer available".format(revision)
+                )
+            copy = apply_revision_delta(copy, delta)
+
+        return copy
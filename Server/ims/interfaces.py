@@ -0,0 +1,142 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Interfaces
+"""
+
+__all__ = [
+    "IStorage",
+]
+
+from zope.interface import Interface, Attribute
+
+
+
+class IStorage(Interface):
+    """
+    A data store of incidents: the operations the server needs of a
+    storage back end (see L{ims.backends}).
+
+    Back ends may offer more, which the server uses where it's offered:
+    per-incident locks (C{lock_incident} and C{unlock_incident}), a write
+    journal (C{journal}), notification of writes (C{write_observers}) and
+    incident history (C{history}); see L{ims.store.Storage}.
+    """
+
+    incident_cache = Attribute(
+        "The L{ims.store.IncidentCache} of parsed incidents read from and "
+        "written to the store."
+    )
+
+
+    def provision():
+        """
+        Create the store if it does not yet exist, and open it.
+        """
+
+
+    def close():
+        """
+        Write any pending changes to disk and close the store.
+        """
+
+
+    def list_incidents():
+        """
+        @return: an iterable of the numbers and etags of all incidents.
+        """
+
+
+    def search_incidents(terms=(), show_closed=False):
+        """
+        @return: an iterable of the numbers and etags of the incidents
+            matching all of the given terms, and only open incidents
+            unless C{show_closed} is true.
+        """
+
+
+    def plan_search(terms=(), show_closed=False):
+        """
+        Narrow down a search as far as possible without reading incidents.
+
+        @return: a tuple of an iterable of candidate incident numbers and
+            etags, whether candidates must be read to check that they
+            aren't closed, and whether they must be read to check that
+            they match C{terms}.
+        """
+
+
+    def etag_for_incident_with_number(number):
+        """
+        @return: the etag of the incident with the given number.
+
+        @raise ims.store.NoSuchIncidentError: if there is no such incident.
+        """
+
+
+    def read_incident_with_number_raw(number):
+        """
+        Read the JSON text of an incident.  This may be called from any
+        thread.
+
+        @raise ims.store.NoSuchIncidentError: if there is no such incident.
+        """
+
+
+    def read_incident_with_number_stamped_raw(number):
+        """
+        Read the JSON text of an incident, as
+        L{read_incident_with_number_raw} does, and whether it is known to
+        be valid and rendered as L{ims.data.Incident.to_json_text} renders
+        it, because it was stamped as written under the current schema and
+        validation rules (see L{ims.data.schema_version}).  This may be
+        called from any thread.
+
+        @return: a C{(json, current)} tuple.
+
+        @raise ims.store.NoSuchIncidentError: if there is no such incident.
+        """
+
+
+    def read_incident_with_number(number):
+        """
+        @return: the L{ims.data.Incident} with the given number.
+
+        @raise ims.store.NoSuchIncidentError: if there is no such incident.
+        """
+
+
+    def write_incident(incident):
+        """
+        Write an incident.
+
+        @return: C{None} if the write is durable on return, otherwise a
+            L{Deferred} which fires when it is.
+        """
+
+
+    def next_incident_number():
+        """
+        @return: an unused incident number.
+        """
+
+
+    def import_incidents(storage):
+        """
+        Copy all incidents from another store into this one, replacing
+        any incidents with the same numbers.
+        """
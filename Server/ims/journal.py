@@ -0,0 +1,668 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Write-ahead journal
+"""
+
+__all__ = [
+    "Journal",
+    "JournalError",
+]
+
+import os
+from errno import ENOENT
+from threading import Lock
+from zlib import crc32
+
+from twisted.python import log
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThreadPool
+
+
+
+class JournalError(RuntimeError):
+    """
+    Journal error.
+    """
+
+
+
+class Journal(object):
+    """
+    Append-only journal of incident writes.
+
+    Each write is appended to the journal file and is considered durable
+    once the journal has been synced to disk.  Writes are synced in
+    batches (group commit): the first write after a commit schedules the
+    next commit on the reactor, and every write appended before that
+    commit runs is synced along with it.  Once a batch is durable, each
+    write is applied by calling C{apply(number, text)}, which is expected
+    to update the incident's files and return their L{FilePath}s, and
+    then C{applied(number, text, error)}, if given, with the exception
+    which C{apply} raised, if any.  A write which fails to be applied is
+    kept, served by L{pending_text}, and tried again with each commit;
+    later writes to the same incident wait for it.
+
+    If C{threadpool} is set, the journal is synced, and the writes
+    applied, in one of its threads, so that the reactor is not blocked
+    while the disk catches up; writes appended meanwhile wait for the
+    next commit.  C{apply} must then be safe to call from that thread,
+    while C{applied} is still called on the reactor.
+
+    Applied files are not synced individually.  Instead, when the journal
+    grows past C{checkpoint_size}, it is checkpointed: the journal file is
+    moved aside, a new one is started with the writes which have yet to
+    be applied, and, once all files applied since the last checkpoint
+    have been synced, as has the file descriptor, if any, returned by
+    C{flush()}, the old file is removed.  With a thread pool, the syncing
+    is done in one of its threads.  After a crash, L{open} replays both
+    files, re-applying every write they hold.
+
+    Each journal record is a line of the form::
+
+        <sequence> <number> <checksum> <text>
+
+    where C{checksum} is the hexadecimal CRC-32 of C{text}.  A record
+    with a number of C{-} marks a checkpoint and carries no text.
+    Records that fail to parse, such as a record torn by a crash, end
+    replay of their file.
+    """
+
+    checkpoint_number = "-"
+
+
+    def __init__(
+        self, fp, apply, applied=None, flush=None,
+        reactor=None, commit_delay=0.0, checkpoint_size=1024 * 1024,
+    ):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.fp = fp
+        self.apply = apply
+        self.applied = applied
+        self.flush = flush
+        self.reactor = reactor
+        self.commit_delay = commit_delay
+        self.checkpoint_size = checkpoint_size
+        self.threadpool = None
+
+        self.sequence = 0
+
+        self._fh = None
+        self._pending = []
+        self._pending_text = {}
+        self._pending_commit = None
+        self._syncing = None
+        self._failed = []
+        self._applied = {}
+        self._new_file = False
+        self._checkpoint = None
+        self._checkpoint_lock = Lock()
+        self._commit_lock = Lock()
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.fp})".format(self=self)
+
+
+    def _old_fp(self):
+        return self.fp.siblingExtension(".old")
+
+
+    def open(self):
+        """
+        Open the journal, replaying any writes recorded in it.
+        """
+        if self._fh is not None:
+            return
+
+        replayed = 0
+
+        old_fp = self._old_fp()
+
+        for fp in (old_fp, self.fp):
+            if not fp.exists():
+                continue
+            for sequence, number, text in self._read(fp):
+                self.sequence = max(self.sequence, sequence)
+                if number is not None:
+                    self._record_applied(self.apply(number, text))
+                    if self.applied is not None:
+                        self.applied(number, text, None)
+                    replayed += 1
+
+        if replayed:
+            log.msg(
+                "Replayed {0} writes from journal {1}"
+                .format(replayed, self.fp.path)
+            )
+
+        self._fh = self.fp.open("a")
+
+        if old_fp.exists():
+            # A checkpoint was interrupted; finish it before starting
+            # another, which would replace the old file.
+            self._finish_checkpoint(
+                _Checkpoint(self._take_applied(), [], old_fp)
+            )
+
+        self.checkpoint()
+
+
+    def close(self):
+        """
+        Commit any pending writes and close the journal.
+        """
+        if self._fh is None:
+            return
+
+        self._take_over_sync()
+        self.commit(threaded=False)
+        self.checkpoint()
+
+        self._fh.close()
+        self._fh = None
+
+
+    def append(self, number, text, pending_text=None):
+        """
+        Record a write of incident text.
+
+        @param pending_text: the text to serve from L{pending_text} until
+            the write is applied, if not C{text} itself.
+
+        @return: a L{Deferred} which fires when the write is durable.
+        """
+        if self._fh is None:
+            raise JournalError("Journal is not open: {0}".format(self))
+
+        self.sequence += 1
+
+        try:
+            self._write_record(self._fh, self.sequence, number, text)
+        except (IOError, OSError) as e:
+            raise JournalError(
+                "Unable to write to journal {0}: {1}".format(self.fp, e)
+            )
+
+        d = Deferred()
+
+        if pending_text is None:
+            pending_text = text
+
+        self._pending.append((self.sequence, number, text, pending_text, d))
+        self._pending_text[number] = pending_text
+
+        if self._pending_commit is None:
+            self._pending_commit = self.reactor.callLater(
+                self.commit_delay, self.commit
+            )
+
+        return d
+
+
+    def _write_record(self, fh, sequence, number, text):
+        fh.write(
+            "{0} {1} {2:08x} {3}\n"
+            .format(sequence, number, checksum(text), text)
+        )
+
+
+    def pending_text(self, number):
+        """
+        Look up the text of a write which has not yet been applied.
+
+        @return: the most recently written text for the incident with
+            the given number, or C{None} if it has no pending writes.
+        """
+        return self._pending_text.get(number, None)
+
+
+    def pending_numbers(self):
+        """
+        @return: the numbers of incidents with writes which have not yet
+            been applied.
+        """
+        return self._pending_text.keys()
+
+
+    def commit(self, threaded=True):
+        """
+        Sync all pending writes to disk and apply them.
+        """
+        if self._pending_commit is not None:
+            if self._pending_commit.active():
+                self._pending_commit.cancel()
+            self._pending_commit = None
+
+        if self._syncing is not None:
+            # A sync is under way; pending writes are committed after it.
+            return
+
+        pending = self._pending
+        if not pending:
+            return
+
+        self._pending = []
+
+        if not threaded or self.threadpool is None:
+            self._sync(pending)
+            return
+
+        try:
+            self._fh.flush()
+        except (IOError, OSError) as e:
+            self._sync_failed(pending, e)
+            return
+
+        commit = _Commit(self._failed, pending)
+        self._failed = []
+        self._syncing = commit
+
+        d = deferToThreadPool(
+            self.reactor, self.threadpool,
+            self._commit_in_thread, commit, self._fh.fileno(), self._new_file,
+        )
+
+        def committed(results):
+            if self._syncing is not commit:
+                # The journal was closed (and synced) meanwhile.
+                return
+            self._syncing = None
+            self._new_file = False
+            self._applied_writes(pending, results)
+            if self._pending:
+                self.commit()
+
+        def failed(f):
+            if self._syncing is not commit:
+                return
+            self._syncing = None
+            self._failed = commit.failed
+            self._sync_failed(pending, f.value)
+            if self._pending:
+                self.commit()
+
+        d.addCallbacks(committed, failed)
+
+
+    def _commit_in_thread(self, commit, fd, new_file):
+        """
+        Sync the journal file and apply a commit's writes, unless the
+        reactor has taken the commit over (see L{_take_over_sync}).
+        """
+        with self._commit_lock:
+            if commit.taken_over:
+                return None
+            self._sync_file(fd, new_file)
+            commit.results = self._apply_files(commit.writes())
+            return commit.results
+
+
+    def _sync_file(self, fd, new_file):
+        """
+        Sync the journal file, and, if it was started by a checkpoint,
+        its directory, so that it can be found after a crash.
+        """
+        os.fsync(fd)
+        if new_file:
+            sync_path(self.fp.dirname())
+
+
+    def _sync(self, pending):
+        try:
+            self._fh.flush()
+            self._sync_file(self._fh.fileno(), self._new_file)
+        except (IOError, OSError) as e:
+            self._sync_failed(pending, e)
+            return
+
+        self._new_file = False
+        self._apply(pending)
+
+
+    def _sync_failed(self, pending, e):
+        log.err("Unable to sync journal {0}: {1}".format(self.fp, e))
+        error = JournalError(
+            "Unable to sync journal {0}: {1}".format(self.fp, e)
+        )
+        for sequence, number, text, pending_text, d in pending:
+            if self._pending_text.get(number, None) is pending_text:
+                del self._pending_text[number]
+            d.errback(error)
+
+
+    def _apply(self, pending):
+        commit = _Commit(self._failed, pending)
+        self._failed = []
+        self._applied_writes(pending, self._apply_files(commit.writes()))
+
+
+    def _apply_files(self, writes):
+        """
+        Apply writes in order, except those to incidents with an earlier
+        write which failed to be applied.  This touches nothing but what
+        C{apply} does, so that it can be done in a thread.
+
+        @return: a list of tuples of each write, whether it was applied,
+            the files which C{apply} returned and the exception which it
+            raised, if any.
+        """
+        results = []
+        failed = set()
+
+        for write in writes:
+            sequence, number, text, pending_text = write
+            applied, fps, error = False, None, None
+            if number not in failed:
+                try:
+                    fps = self.apply(number, text)
+                except Exception as e:
+                    error = e
+                else:
+                    applied = True
+            if not applied:
+                failed.add(number)
+            results.append((write, applied, fps, error))
+
+        return results
+
+
+    def _applied_writes(self, pending, results):
+        for write, applied, fps, error in results:
+            sequence, number, text, pending_text = write
+
+            if error is not None:
+                log.err(
+                    "Unable to apply journaled write of incident {0}: {1}"
+                    .format(number, error)
+                )
+
+            if self.applied is not None and (applied or error is not None):
+                self.applied(number, text, error)
+
+            if applied:
+                self._record_applied(fps)
+                if self._pending_text.get(number, None) is pending_text:
+                    del self._pending_text[number]
+            else:
+                # The write is durable in the journal, and is kept there
+                # and tried again with the next commit, or on replay;
+                # keep serving it from memory until then.
+                self._failed.append(write)
+
+        for sequence, number, text, pending_text, d in pending:
+            d.callback(sequence)
+
+        if self._fh.tell() > self.checkpoint_size:
+            self.checkpoint(threaded=True)
+
+
+    def _record_applied(self, fps):
+        if not isinstance(fps, (list, tuple)):
+            fps = (fps,)
+        for fp in fps:
+            self._applied[fp.path] = fp
+
+
+    def _take_applied(self):
+        fps = self._applied.values()
+        self._applied = {}
+        return fps
+
+
+    def _take_over_sync(self):
+        commit = self._syncing
+        if commit is None:
+            return
+
+        self._syncing = None
+
+        # Wait for a thread which has started the commit to finish it,
+        # rather than apply its writes twice; if none has, commit here
+        # and stop the thread from doing so.
+        with self._commit_lock:
+            commit.taken_over = True
+
+        if commit.results is None:
+            self._failed = commit.failed
+            self._sync(commit.pending)
+        else:
+            self._new_file = False
+            self._applied_writes(commit.pending, commit.results)
+
+
+    def checkpoint(self, threaded=False):
+        """
+        Sync all applied writes to disk and remove them from the journal.
+        If C{threaded} and the journal has a thread pool, the checkpoint
+        is finished in one of its threads, unless another is under way.
+        """
+        if threaded and self.threadpool is not None:
+            checkpoint = self._checkpoint
+            if checkpoint is None:
+                if self._syncing is None:
+                    checkpoint = self._switch()
+            elif checkpoint.running:
+                checkpoint = None
+            if checkpoint is not None:
+                self._start_checkpoint(checkpoint)
+            return
+
+        self._take_over_sync()
+
+        checkpoint = self._checkpoint
+        if checkpoint is not None:
+            # Likewise for a checkpoint under way, which must be finished
+            # before the old journal file is replaced.
+            self._finish_checkpoint(checkpoint)
+            self._checkpoint = None
+
+        checkpoint = self._switch()
+        if checkpoint is not None:
+            self._finish_checkpoint(checkpoint)
+
+
+    def _start_checkpoint(self, checkpoint):
+        self._checkpoint = checkpoint
+        checkpoint.running = True
+
+        d = deferToThreadPool(
+            self.reactor, self.threadpool, self._finish_checkpoint, checkpoint
+        )
+
+        def finished(_):
+            if self._checkpoint is checkpoint:
+                self._checkpoint = None
+
+        def failed(f):
+            if self._checkpoint is not checkpoint:
+                return
+            # Try again with the next checkpoint, before the old journal
+            # file is replaced.
+            checkpoint.running = False
+            log.err(
+                "Unable to checkpoint journal {0}: {1}"
+                .format(self.fp, f.value)
+            )
+
+        d.addCallbacks(finished, failed)
+
+
+    def _switch(self):
+        """
+        Move the journal file aside and start a new one holding the
+        writes which have yet to be applied.
+
+        @return: a L{_Checkpoint} which, once finished, removes the old
+            file, or C{None} if the journal file could not be replaced.
+        """
+        old_fp = self._old_fp()
+
+        try:
+            self._fh.flush()
+            os.rename(self.fp.path, old_fp.path)
+        except (IOError, OSError) as e:
+            log.err(
+                "Unable to checkpoint journal {0}: {1}".format(self.fp, e)
+            )
+            return None
+
+        try:
+            fh = self.fp.open("a")
+            fh.write(
+                "{0} {1} {2:08x} \n"
+                .format(self.sequence, self.checkpoint_number, checksum(""))
+            )
+            for sequence, number, text, pending_text in self._failed:
+                self._write_record(fh, sequence, number, text)
+            for sequence, number, text, pending_text, d in self._pending:
+                self._write_record(fh, sequence, number, text)
+            fh.flush()
+        except (IOError, OSError) as e:
+            log.err(
+                "Unable to checkpoint journal {0}: {1}".format(self.fp, e)
+            )
+            os.rename(old_fp.path, self.fp.path)
+            return None
+
+        self._fh.close()
+        self._fh = fh
+        self._new_file = True
+
+        fds = [os.dup(fh.fileno())]
+        if self.flush is not None:
+            fd = self.flush()
+            if fd is not None:
+                fds.append(fd)
+
+        return _Checkpoint(self._take_applied(), fds, old_fp)
+
+
+    def _finish_checkpoint(self, checkpoint):
+        """
+        Sync the files applied before a checkpoint, and the new journal
+        file, to disk and remove the old journal file.
+        """
+        with self._checkpoint_lock:
+            if checkpoint.finished:
+                return
+
+            directories = {self.fp.dirname(): True}
+            for fp in checkpoint.fps:
+                sync_path(fp.path)
+                directories[fp.dirname()] = True
+            for fd in checkpoint.fds:
+                os.fsync(fd)
+
+            try:
+                os.remove(checkpoint.old_fp.path)
+            except OSError as e:
+                if e.errno != ENOENT:
+                    raise
+
+            for directory in directories:
+                sync_path(directory)
+
+            for fd in checkpoint.fds:
+                os.close(fd)
+
+            checkpoint.finished = True
+
+
+    def _read(self, fp):
+        handle = fp.open("r")
+        try:
+            for line in handle:
+                if not line.endswith("\n"):
+                    log.msg("Ignoring incomplete journal record")
+                    return
+
+                try:
+                    sequence, number, check, text = line[:-1].split(" ", 3)
+                    sequence = int(sequence)
+                    if number == self.checkpoint_number:
+                        number = None
+                    else:
+                        number = int(number)
+                    check = int(check, 16)
+                except ValueError:
+                    log.msg("Ignoring invalid journal record")
+                    return
+
+                if check != checksum(text):
+                    log.msg("Ignoring corrupt journal record {0}".format(sequence))
+                    return
+
+                yield (sequence, number, text)
+        finally:
+            handle.close()
+
+
+
+class _Commit(object):
+    """
+    A commit under way in a thread: the writes which had failed to be
+    applied before it, which it tries again, the pending writes which it
+    syncs and applies, and the results of applying them, once it has.
+    """
+
+    def __init__(self, failed, pending):
+        self.failed = failed
+        self.pending = pending
+        self.results = None
+        self.taken_over = False
+
+
+    def writes(self):
+        return self.failed + [
+            (sequence, number, text, pending_text)
+            for sequence, number, text, pending_text, d in self.pending
+        ]
+
+
+
+class _Checkpoint(object):
+    """
+    A journal checkpoint under way: the files applied before it, which it
+    syncs, as it does the file descriptors C{fds} before closing them,
+    and the old journal file, which it then removes.
+    """
+
+    def __init__(self, fps, fds, old_fp):
+        self.fps = fps
+        self.fds = fds
+        self.old_fp = old_fp
+        self.running = False
+        self.finished = False
+
+
+
+def checksum(text):
+    return crc32(text) & 0xffffffff
+
+
+def sync_path(path):
+    """
+    Sync the file or directory at the given path to disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
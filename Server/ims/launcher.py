@@ -0,0 +1,292 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Server launcher
+"""
+
+__all__ = [
+    "makeService",
+    "ServerSite",
+    "WorkerPool",
+]
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import os
+import sys
+import socket
+
+from twisted.python import log, usage
+from twisted.python.filepath import FilePath
+from twisted.application.service import Service
+from twisted.application.internet import TCPServer
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.web.server import Site
+
+from ims.server import loadConfig, Resource
+
+
+
+class ServerSite(Site):
+    """
+    Site with an access log which may be shared by several processes.
+    """
+
+    displayTracebacks = False
+
+    def _openLogFile(self, path):
+        # Unbuffered, so that each line is appended in a single write and
+        # lines from different processes don't run into each other.
+        return open(path, "a", 0)
+
+
+def makeSite(resource, accessLog=None):
+    """
+    Make a web site serving a resource, as C{twistd web --notracebacks}
+    does.
+    """
+    return ServerSite(resource, logPath=accessLog)
+
+
+def makeService(accessLog=None):
+    """
+    Make the server's service, which listens on the configured port and
+    serves the IMS either itself or, if the configuration asks for more
+    than one worker, from a pool of worker processes.
+    """
+    config = loadConfig(persist=False)
+
+    if config.Workers > 1:
+        return WorkerPool(config.ServerPort, config.Workers, accessLog=accessLog)
+    else:
+        return TCPServer(config.ServerPort, makeSite(Resource(), accessLog))
+
+
+
+class WorkerPool(Service):
+    """
+    Pool of worker processes serving the IMS on a listening socket which
+    they share.
+
+    The socket is opened by this (the master) process and passed to each
+    worker as file descriptor 3; the kernel hands each new connection to
+    whichever worker accepts it first.  Output from the workers is
+    logged here, and workers which exit are restarted after
+    C{restart_delay} seconds.
+    """
+
+    restart_delay = 1.0
+    stop_timeout = 10.0
+
+
+    def __init__(self, port, count, accessLog=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.port = port
+        self.count = count
+        self.accessLog = accessLog
+        self.reactor = reactor
+
+        self.socket = None
+        self.workers = {}
+        self._stopped = {}
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}("
+            "port={self.port}, count={self.count})"
+            .format(self=self)
+        )
+
+
+    def startService(self):
+        Service.startService(self)
+
+        log.msg("Starting {0}".format(self))
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", self.port))
+        self.socket.listen(50)
+        self.socket.setblocking(False)
+
+        for index in xrange(self.count):
+            self.spawn(index)
+
+
+    def spawn(self, index):
+        """
+        Start the worker process with the given index.
+        """
+        if not self.running:
+            return
+
+        script = FilePath(__file__).sibling("launcher.py")
+
+        args = [sys.executable, "-u", script.path]
+        args.extend(["--worker", str(index), "--fd", "3"])
+        if self.accessLog is not None:
+            args.extend(["--access-log", os.path.abspath(self.accessLog)])
+
+        protocol = WorkerProtocol(self, index)
+        self.workers[index] = self.reactor.spawnProcess(
+            protocol, sys.executable, args, env=os.environ,
+            childFDs={0: "w", 1: "r", 2: "r", 3: self.socket.fileno()},
+        )
+
+
+    def workerEnded(self, index, reason):
+        """
+        Note that a worker process has exited, and restart it if the pool
+        is still running.
+        """
+        self.workers.pop(index, None)
+
+        stopped = self._stopped.pop(index, None)
+        if stopped is not None:
+            stopped.callback(None)
+            return
+
+        log.msg(
+            "Worker {0} exited: {1}; restarting in {2} seconds"
+            .format(index, reason.getErrorMessage(), self.restart_delay)
+        )
+        self.reactor.callLater(self.restart_delay, self.spawn, index)
+
+
+    def stopService(self):
+        Service.stopService(self)
+
+        log.msg("Stopping {0}".format(self))
+
+        waiting = []
+        for index, process in self.workers.items():
+            d = self._stopped[index] = Deferred()
+            waiting.append(d)
+            process.signalProcess("TERM")
+
+        def kill():
+            for process in self.workers.values():
+                log.msg("Killing worker process {0}".format(process.pid))
+                try:
+                    process.signalProcess("KILL")
+                except Exception:
+                    pass
+
+        timeout = self.reactor.callLater(self.stop_timeout, kill)
+
+        def stopped(_):
+            if timeout.active():
+                timeout.cancel()
+            self.socket.close()
+            self.socket = None
+
+        d = DeferredList(waiting)
+        d.addCallback(stopped)
+        return d
+
+
+
+class WorkerProtocol(ProcessProtocol):
+    """
+    Protocol for a worker process, logging its output.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self._buffers = {}
+
+
+    def childDataReceived(self, fd, data):
+        lines = (self._buffers.pop(fd, "") + data).split("\n")
+        self._buffers[fd] = lines.pop()
+        for line in lines:
+            log.msg("[worker {0}] {1}".format(self.index, line))
+
+
+    def processEnded(self, reason):
+        for fd, line in self._buffers.items():
+            if line:
+                log.msg("[worker {0}] {1}".format(self.index, line))
+        self._buffers.clear()
+
+        self.pool.workerEnded(self.index, reason)
+
+
+
+class WorkerOptions(usage.Options):
+    """
+    Options for a worker process.
+    """
+    optParameters = [
+        ["worker", None, None, "Index of this worker.", int],
+        ["fd", None, 3, "File descriptor of the listening socket.", int],
+        ["access-log", None, None, "Access log file."],
+    ]
+
+    def postOptions(self):
+        if self["worker"] is None:
+            raise usage.UsageError("No worker index given.")
+
+
+
+def workerMain(argv=None):
+    """
+    Run a worker process, serving the IMS on a socket inherited from the
+    master process, until the master exits.
+    """
+    from twisted.internet import reactor
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    options = WorkerOptions()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        print >> sys.stderr, "{0}\n\n{1}".format(options, e)
+        sys.exit(64)
+
+    log.startLogging(sys.stdout, setStdout=False)
+
+    site = makeSite(Resource(worker=options["worker"]), options["access-log"])
+
+    reactor.adoptStreamPort(options["fd"], socket.AF_INET, site)
+    os.close(options["fd"])
+
+    # Exit if the master process goes away.
+    master = os.getppid()
+    def checkMaster():
+        if os.getppid() != master:
+            log.msg("Master process {0} has exited".format(master))
+            reactor.stop()
+    LoopingCall(checkMaster).start(1.0, now=False)
+
+    reactor.run()
+
+
+
+if __name__ == "__main__":
+    workerMain()
@@ -0,0 +1,212 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Data store directory layouts
+"""
+
+__all__ = [
+    "DirectoryCache",
+    "FlatLayout",
+    "ShardedLayout",
+    "layouts",
+]
+
+import os
+from time import time
+
+from twisted.python import log
+
+
+
+class DirectoryCache(object):
+    """
+    Cache of directory listings.
+
+    A cached listing is used for as long as the directory's modification
+    time is unchanged.  Listings of directories modified within the last
+    C{granularity} seconds are not cached, as a change made within the
+    same tick of the file system's clock would not change the
+    modification time.
+    """
+
+    def __init__(self, granularity=1.0):
+        self.granularity = granularity
+        self._listings = {}
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}(directories={directories})"
+            .format(self=self, directories=len(self._listings))
+        )
+
+
+    def listdir(self, path):
+        """
+        List the names of the entries in a directory.
+
+        @return: a list of names, which the caller must not modify.
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            self._listings.pop(path, None)
+            return []
+
+        cached = self._listings.get(path, None)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        try:
+            names = os.listdir(path)
+        except OSError:
+            self._listings.pop(path, None)
+            return []
+
+        if mtime < time() - self.granularity:
+            self._listings[path] = (mtime, names)
+        else:
+            self._listings.pop(path, None)
+
+        return names
+
+
+    def discard(self, path):
+        """
+        Forget the cached listing of a directory.
+        """
+        self._listings.pop(path, None)
+
+
+    def clear(self):
+        """
+        Forget all cached listings.
+        """
+        self._listings.clear()
+
+
+
+class FlatLayout(object):
+    """
+    Layout with all incident files in one directory.
+
+    An incident's file is named after its number.  Other files for an
+    incident are named C{.<number>.<extension>}.
+    """
+
+    name = "flat"
+
+
+    def __init__(self, path, directories):
+        self.path = path
+        self.directories = directories
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.path})".format(self=self)
+
+
+    def directory(self, number):
+        """
+        @return: the directory containing the files for an incident.
+        """
+        return self.path
+
+
+    def fp(self, number, ext=""):
+        """
+        @return: the path of the file for an incident with the given
+            extension, or of the incident's main file if C{ext} is empty.
+        """
+        if ext:
+            name = ".{0}.{1}".format(number, ext)
+        else:
+            name = "{0}".format(number)
+
+        return self.directory(number).child(name)
+
+
+    def numbers(self):
+        """
+        Find the numbers of the incidents with files in this layout.
+        """
+        return self._numbers_in(self.path.path)
+
+
+    def _numbers_in(self, path):
+        for name in self.directories.listdir(path):
+            if name.startswith("."):
+                continue
+            try:
+                number = int(name)
+            except ValueError:
+                log.err(
+                    "Invalid filename in data store: {0}"
+                    .format(os.path.join(path, name))
+                )
+                continue
+
+            yield number
+
+
+
+class ShardedLayout(FlatLayout):
+    """
+    Layout with incident files spread over two levels of subdirectories,
+    each holding up to 100 entries.
+
+    The subdirectories for an incident are named for the two pairs of
+    digits preceding its last two, so incident 1234 is in C{00/12/1234}
+    and incident 567890 is in C{56/78/567890}.
+    """
+
+    name = "sharded"
+
+
+    def directory(self, number):
+        return (
+            self.path
+            .child("{0:02d}".format(number // 10000 % 100))
+            .child("{0:02d}".format(number // 100 % 100))
+        )
+
+
+    def numbers(self):
+        for top in self._shards_in(self.path.path):
+            for bottom in self._shards_in(top):
+                for number in self._numbers_in(bottom):
+                    yield number
+
+
+    def _shards_in(self, path):
+        for name in self.directories.listdir(path):
+            if name.startswith("."):
+                continue
+            if len(name) != 2 or not name.isdigit():
+                log.err(
+                    "Invalid entry in sharded data store: {0}"
+                    .format(os.path.join(path, name))
+                )
+                continue
+
+            yield os.path.join(path, name)
+
+
+
+layouts = dict(
+    (layout.name, layout) for layout in (FlatLayout, ShardedLayout)
+)
@@ -0,0 +1,148 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Inter-process incident locks
+"""
+
+__all__ = [
+    "IncidentLocks",
+]
+
+import os
+import fcntl
+from errno import EACCES, EAGAIN
+from thread import get_ident
+from threading import Condition
+
+
+
+class IncidentLocks(object):
+    """
+    Exclusive locks on incidents, shared by all processes using a lock
+    file.
+
+    The lock on an incident is a POSIX record lock on the byte of the
+    lock file at the incident's number; the file itself stays empty.
+    As POSIX locks are held by processes, not by file handles or
+    threads, each lock held by this process is recorded with the thread
+    holding it, which other threads wait for, and a count of the times
+    that thread has acquired it; an incident is unlocked when it has been
+    released as many times as it was acquired.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+        self._fd = None
+        self._held = {}
+        self._condition = Condition()
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.fp})".format(self=self)
+
+
+    def held(self, number):
+        """
+        @return: whether this thread holds the lock on an incident.
+        """
+        with self._condition:
+            thread, count = self._held.get(number, (None, 0))
+            return thread == get_ident() and count > 0
+
+
+    def acquire(self, number, blocking=True, wait_for_threads=True):
+        """
+        Lock an incident, waiting for other processes, and other threads
+        of this process, to release it unless C{blocking} is false.  If
+        C{wait_for_threads} is false, only other processes are waited for.
+
+        @return: whether the incident was locked.
+        """
+        thread = get_ident()
+
+        with self._condition:
+            while number in self._held:
+                holder, count = self._held[number]
+                if holder == thread:
+                    self._held[number] = (thread, count + 1)
+                    return True
+                if not blocking or not wait_for_threads:
+                    return False
+                self._condition.wait()
+
+            # Claim the incident, so that other threads wait while this
+            # one takes the process's lock.
+            self._held[number] = (thread, 0)
+
+            if self._fd is None:
+                self._fd = os.open(self.fp.path, os.O_RDWR | os.O_CREAT, 0644)
+
+        try:
+            if blocking:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, number)
+            else:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, number)
+        except IOError as e:
+            self._unclaim(number)
+            if e.errno in (EACCES, EAGAIN) and not blocking:
+                return False
+            raise
+        except:
+            self._unclaim(number)
+            raise
+
+        with self._condition:
+            self._held[number] = (thread, 1)
+
+        return True
+
+
+    def release(self, number):
+        """
+        Release an incident locked with L{acquire}.
+        """
+        with self._condition:
+            thread, count = self._held[number]
+
+            if count > 1:
+                self._held[number] = (thread, count - 1)
+                return
+
+        # Unlock before giving up the claim, so that another thread
+        # doesn't take the process's lock only for it to be unlocked here.
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, number)
+        finally:
+            self._unclaim(number)
+
+
+    def _unclaim(self, number):
+        with self._condition:
+            del self._held[number]
+            self._condition.notifyAll()
+
+
+    def close(self):
+        """
+        Release all locks.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        self._held.clear()
@@ -0,0 +1,230 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Incident etag manifest
+"""
+
+__all__ = [
+    "EtagManifest",
+]
+
+import os
+
+from twisted.python import log
+
+
+
+class EtagManifest(object):
+    """
+    The etags of all incidents in a store, kept in memory and persisted
+    in a single file.
+
+    The file is a log of C{<number> <etag>} lines, the last line for an
+    incident being current.  It is loaded once, appended to as etags
+    change, and rewritten without superseded lines when those make up
+    most of it, unless C{compact_slack} is C{None}.  (A manifest shared
+    by several processes must not be rewritten, as the others would go
+    on appending to the replaced file.)
+    """
+
+    def __init__(self, fp, compact_slack=1000):
+        self.fp = fp
+        self.compact_slack = compact_slack
+
+        self._etags = {}
+        self._lines = 0
+        self._fh = None
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.fp})".format(self=self)
+
+
+    def __len__(self):
+        return len(self._etags)
+
+
+    def __contains__(self, number):
+        return number in self._etags
+
+
+    def load(self):
+        """
+        Load the manifest.
+        """
+        if self._fh is not None:
+            return
+
+        self._etags.clear()
+        self._lines = 0
+
+        if self.fp.exists():
+            handle = self.fp.open("r")
+            try:
+                for line in handle:
+                    try:
+                        if not line.endswith("\n"):
+                            raise ValueError("Incomplete line")
+                        number, etag = line.split()
+                        number = int(number)
+                    except ValueError:
+                        log.msg(
+                            "Ignoring invalid line in etag manifest {0}: {1!r}"
+                            .format(self.fp.path, line)
+                        )
+                        continue
+
+                    self._etags[number] = etag
+                    self._lines += 1
+            finally:
+                handle.close()
+
+        self._fh = self.fp.open("a")
+
+
+    def close(self):
+        """
+        Sync and close the manifest.
+        """
+        if self._fh is None:
+            return
+
+        self.sync()
+        self._fh.close()
+        self._fh = None
+
+
+    def get(self, number):
+        """
+        @return: the etag for the incident with the given number, or
+            C{None} if it is unknown.
+        """
+        return self._etags.get(number, None)
+
+
+    def numbers(self):
+        """
+        @return: the numbers of the incidents with known etags.
+        """
+        return self._etags.keys()
+
+
+    def items(self):
+        """
+        @return: C{(number, etag)} tuples for the incidents with known
+            etags.
+        """
+        return self._etags.items()
+
+
+    def update(self, number, etag):
+        """
+        Change an incident's etag in memory only.
+        """
+        self._etags[number] = etag
+
+
+    def record(self, number, etag):
+        """
+        Change an incident's etag and append the change to the manifest
+        file.
+        """
+        self._etags[number] = etag
+
+        if self._fh is None:
+            return
+
+        try:
+            self._fh.write("{0} {1}\n".format(number, etag))
+            self._fh.flush()
+        except (IOError, OSError) as e:
+            log.err(
+                "Unable to record etag for incident {0}: {1}"
+                .format(number, e)
+            )
+            return
+
+        self._lines += 1
+
+        if (
+            self.compact_slack is not None and
+            self._lines > 2 * len(self._etags) + self.compact_slack
+        ):
+            self.compact()
+
+
+    def discard(self, number):
+        """
+        Forget an incident's etag, which will then be recomputed from the
+        incident when next needed.
+        """
+        self._etags.pop(number, None)
+
+
+    def sync(self):
+        """
+        Sync the manifest file to disk.
+        """
+        if self._fh is not None:
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+
+    def flush(self):
+        """
+        Flush the manifest file, so that it can be synced from another
+        thread.
+
+        @return: a duplicate of the file's descriptor, which the caller
+            must sync and close, or C{None} if the manifest isn't open.
+        """
+        if self._fh is None:
+            return None
+
+        self._fh.flush()
+        return os.dup(self._fh.fileno())
+
+
+    def compact(self):
+        """
+        Rewrite the manifest file with one line per incident.
+        """
+        temp_fp = self.fp.siblingExtension(".tmp")
+
+        try:
+            temp_fh = temp_fp.open("w")
+            try:
+                for number, etag in self._etags.iteritems():
+                    temp_fh.write("{0} {1}\n".format(number, etag))
+                temp_fh.flush()
+                os.fsync(temp_fh.fileno())
+            finally:
+                temp_fh.close()
+
+            temp_fp.moveTo(self.fp)
+        except (IOError, OSError) as e:
+            log.err(
+                "Unable to compact etag manifest {0}: {1}"
+                .format(self.fp.path, e)
+            )
+            return
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = self.fp.open("a")
+
+        self._lines = len(self._etags)
@@ -22,6 +22,9 @@ __all__ = [
     "IncidentManagementSystem",
 ]
 
+import zlib
+from hashlib import sha1 as etag_hash
+
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred
@@ -32,13 +35,15 @@ from twisted.web.client import Agent, ResponseDone
 
 from klein import Klein
 
-from ims.data import JSON, to_json_text, from_json_io
-from ims.data import Incident, ReportEntry
+from ims.data import JSON, to_json_text, from_json_io, from_json_text
+from ims.data import Incident, ReportEntry, InvalidDataError
+from ims.data import parse_date, render_date
 from ims.sauce import url_for, set_response_header
 from ims.sauce import http_sauce
 from ims.sauce import HeaderName, ContentType
 from ims.elements import HomePageElement, DispatchQueueElement
 from ims.elements import incidents_from_query
+from ims.sync import SyncError
 
 
 
@@ -53,7 +58,7 @@ class IncidentManagementSystem(object):
     def __init__(self, config):
         self.config = config
         self.avatarId = None
-        self.storage = config.storage
+        self.storage = config.async_storage
         self.dms = config.dms
 
 
@@ -111,7 +116,10 @@ class IncidentManagementSystem(object):
     def list_incidents(self, request):
         #set_response_header(request, HeaderName.etag, "*") # FIXME
         set_response_header(request, HeaderName.contentType, ContentType.JSON)
-        return to_json_text(tuple(incidents_from_query(self, request)))
+
+        d = incidents_from_query(self, request)
+        d.addCallback(lambda incidents: to_json_text(tuple(incidents)))
+        return d
 
 
     @app.route("/incidents/<number>", methods=("GET",))
@@ -121,30 +129,92 @@ class IncidentManagementSystem(object):
         #import time
         #time.sleep(0.3)
 
-        set_response_header(request, HeaderName.etag, self.storage.etag_for_incident_with_number(number))
-        set_response_header(request, HeaderName.contentType, ContentType.JSON)
+        as_of = request.args.get("as_of", None)
+        if as_of is not None:
+            return self.get_incident_as_of(request, number, as_of[0])
+
+        # Look up the etag before reading the incident, so that if the
+        # incident is written in between, the etag is the stale one.
+        d = self.storage.etag_for_incident_with_number(number)
+
+        def got_etag(etag):
+            set_response_header(request, HeaderName.etag, etag)
+            set_response_header(request, HeaderName.contentType, ContentType.JSON)
 
-        if False:
-            #
-            # This is faster, but doesn't benefit from any cleanup or
-            # validation code, so it's only OK if we know all data in the
-            # store is clean by this server version's standards.
-            #
-            return self.storage.read_incident_with_number_raw(number)
-        else:
             #
-            # This parses the data from the store, validates it, then
-            # re-serializes it.
+            # Text stamped as written under this server version's schema
+            # and validation rules is served as it is stored; anything
+            # else is parsed, validated, then re-serialized.
             #
-            incident = self.storage.read_incident_with_number(number)
-            return incident.to_json_text()
+            return self.storage.read_incident_with_number_validated_raw(number)
+
+        d.addCallback(got_etag)
+        return d
+
+
+    def get_incident_as_of(self, request, number, as_of):
+        if not self.keeps_history():
+            return self.no_history(request)
+
+        try:
+            when = parse_date(as_of)
+        except ValueError:
+            raise InvalidDataError("Invalid time: {0!r}".format(as_of))
+
+        if when is None:
+            raise InvalidDataError("No time given for as_of")
+
+        d = self.storage.read_incident_as_of_raw(number, when)
+
+        def got_incident(json):
+            set_response_header(request, HeaderName.etag, etag_hash(json).hexdigest())
+            set_response_header(request, HeaderName.contentType, ContentType.JSON)
+            return json
+
+        d.addCallback(got_incident)
+        return d
+
+
+    @app.route("/incidents/<number>/history", methods=("GET",))
+    @http_sauce
+    def get_incident_history(self, request, number):
+        if not self.keeps_history():
+            return self.no_history(request)
+
+        d = self.storage.incident_history(number)
+
+        def got_history(revisions):
+            set_response_header(request, HeaderName.contentType, ContentType.JSON)
+            return to_json_text([
+                {
+                    "revision": revision,
+                    "written": render_date(written),
+                    "etag": etag,
+                }
+                for revision, written, etag in revisions
+            ])
+
+        d.addCallback(got_history)
+        return d
+
+
+    def keeps_history(self):
+        return getattr(self.storage.storage, "history", False)
+
+
+    def no_history(self, request):
+        request.setResponseCode(http.NOT_FOUND)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "This server doesn't keep incident history.\n"
 
 
     @app.route("/incidents/<number>", methods=("POST",))
     @http_sauce
     def edit_incident(self, request, number):
+        if self.config.follower is not None:
+            return self.read_only(request)
+
         number = int(number)
-        incident = self.storage.read_incident_with_number(number)
 
         #
         # Handle the changes requested by the client
@@ -152,158 +222,240 @@ class IncidentManagementSystem(object):
         edits_json = from_json_io(request.content)
         edits = Incident.from_json(edits_json, number=number, validate=False)
 
-        user_entries = []
-
-        system_messages = []
-        state_changes = []
-
-        def log_edit_value(key, old, new):
-            if key is JSON.number:
-                return
-
-            if old == new:
-                #print "Client submitted unchaged value for {0}: {1}".format(JSON.describe(key), new)
-                return
-
-            print(JSON.states)
-            if key in JSON.states():
-                state_changes.append((key, new))
-                return
-
-            system_messages.append(u"Changed {0} to: {1}".format(JSON.describe(key), new if new else u"<no value>"))
-
-        def diff_set(key, old, new):
-            old = frozenset(old if old else ())
-            new = frozenset(new if new else ())
-            unchanged = old & new
-            removed = old ^ unchanged
-            added = new ^ unchanged
-            return added, removed
-
-        def log_edit_set(key, added, removed):
-            if added:
-                system_messages.append(u"Added to {0}: {1}".format(JSON.describe(key), ", ".join(added)))
-            if removed:
-                system_messages.append(u"Removed from {0}: {1}".format(JSON.describe(key), ", ".join(removed)))
-
-        for key in edits_json.keys():
-            key = JSON.lookupByValue(key)
-
-            if key is JSON.report_entries:
-                if edits.report_entries is not None:
-                    for entry in edits.report_entries:
-                        # Edit report entries to add author
-                        entry.author = self.avatarId.decode("utf-8")
-                        user_entries.append(entry)
-            elif key is JSON.location_name:
-                if edits.location.name is not None:
-                    log_edit_value(key, incident.location.name, edits.location.name)
-                    incident.location.name = edits.location.name
-            elif key is JSON.location_address:
-                if edits.location.address is not None:
-                    log_edit_value(key, incident.location.address, edits.location.address)
-                    incident.location.address = edits.location.address
-            elif key is JSON.ranger_handles:
-                if edits.rangers is not None:
-                    added, removed = diff_set(key, incident.rangers, edits.rangers)
-                    log_edit_set(key, [r.handle for r in added], [r.handle for r in removed])
-                    incident.rangers = edits.rangers
-            elif key is JSON.incident_types:
-                if edits.incident_types is not None:
-                    log_edit_set(key, *diff_set(key, incident.incident_types, edits.incident_types))
-                    incident.incident_types = edits.incident_types
-            else:
-                attr_name = key.name
-                attr_value = getattr(edits, attr_name)
-
-                if key in (JSON.created, JSON.dispatched, JSON.on_scene, JSON.closed):
-                    if edits.created is None:
-                        # If created is None, then we aren't editing state.
-                        # (It would be weird if others were not None here.)
+        def apply_edits(incident):
+            user_entries = []
+
+            system_messages = []
+            state_changes = []
+
+            def log_edit_value(key, old, new):
+                if key is JSON.number:
+                    return
+
+                if old == new:
+                    #print "Client submitted unchaged value for {0}: {1}".format(JSON.describe(key), new)
+                    return
+
+                print(JSON.states)
+                if key in JSON.states():
+                    state_changes.append((key, new))
+                    return
+
+                system_messages.append(u"Changed {0} to: {1}".format(JSON.describe(key), new if new else u"<no value>"))
+
+            def diff_set(key, old, new):
+                old = frozenset(old if old else ())
+                new = frozenset(new if new else ())
+                unchanged = old & new
+                removed = old ^ unchanged
+                added = new ^ unchanged
+                return added, removed
+
+            def log_edit_set(key, added, removed):
+                if added:
+                    system_messages.append(u"Added to {0}: {1}".format(JSON.describe(key), ", ".join(added)))
+                if removed:
+                    system_messages.append(u"Removed from {0}: {1}".format(JSON.describe(key), ", ".join(removed)))
+
+            for key in edits_json.keys():
+                key = JSON.lookupByValue(key)
+
+                if key is JSON.report_entries:
+                    if edits.report_entries is not None:
+                        for entry in edits.report_entries:
+                            # Edit report entries to add author
+                            entry.author = self.avatarId.decode("utf-8")
+                            user_entries.append(entry)
+                elif key is JSON.location_name:
+                    if edits.location.name is not None:
+                        log_edit_value(key, incident.location.name, edits.location.name)
+                        incident.location.name = edits.location.name
+                elif key is JSON.location_address:
+                    if edits.location.address is not None:
+                        log_edit_value(key, incident.location.address, edits.location.address)
+                        incident.location.address = edits.location.address
+                elif key is JSON.ranger_handles:
+                    if edits.rangers is not None:
+                        added, removed = diff_set(key, incident.rangers, edits.rangers)
+                        log_edit_set(key, [r.handle for r in added], [r.handle for r in removed])
+                        incident.rangers = edits.rangers
+                elif key is JSON.incident_types:
+                    if edits.incident_types is not None:
+                        log_edit_set(key, *diff_set(key, incident.incident_types, edits.incident_types))
+                        incident.incident_types = edits.incident_types
+                else:
+                    attr_name = key.name
+                    attr_value = getattr(edits, attr_name)
+
+                    if key in (JSON.created, JSON.dispatched, JSON.on_scene, JSON.closed):
+                        if edits.created is None:
+                            # If created is None, then we aren't editing state.
+                            # (It would be weird if others were not None here.)
+                            continue
+                    elif attr_value is None:
+                        # None values should not cause edits.
                         continue
-                elif attr_value is None:
-                    # None values should not cause edits.
-                    continue
 
-                log_edit_value(key, getattr(incident, attr_name), attr_value)
+                    log_edit_value(key, getattr(incident, attr_name), attr_value)
 
-                setattr(incident, attr_name, attr_value)
+                    setattr(incident, attr_name, attr_value)
 
-        #
-        # Figure out what to report about state changes
-        #
-        print("3")
-        highest_change = None
-        lowest_change = None
-        for state_changed, state_time in state_changes:
-            if state_time is None:
-                if lowest_change is None or JSON.cmpStates(lowest_change, state_changed) > 0:
-                    lowest_change = state_changed
-            else:
-                if highest_change is None or JSON.cmpStates(highest_change[0], state_changed) < 0:
-                    highest_change = (state_changed, state_time)
-
-        if highest_change is not None:
-            system_messages.append(u"State changed to: {0}".format(JSON.describe(highest_change[0])))
-        elif lowest_change is not None:
-            # We need one state less than lowest_change
-            last = None
-            for state in JSON.states():
-                if state == lowest_change:
-                    break
-                last = state
-            system_messages.append(u"State changed to: {0}".format(JSON.describe(last)))
+            #
+            # Figure out what to report about state changes
+            #
+            print("3")
+            highest_change = None
+            lowest_change = None
+            for state_changed, state_time in state_changes:
+                if state_time is None:
+                    if lowest_change is None or JSON.cmpStates(lowest_change, state_changed) > 0:
+                        lowest_change = state_changed
+                else:
+                    if highest_change is None or JSON.cmpStates(highest_change[0], state_changed) < 0:
+                        highest_change = (state_changed, state_time)
+
+            if highest_change is not None:
+                system_messages.append(u"State changed to: {0}".format(JSON.describe(highest_change[0])))
+            elif lowest_change is not None:
+                # We need one state less than lowest_change
+                last = None
+                for state in JSON.states():
+                    if state == lowest_change:
+                        break
+                    last = state
+                system_messages.append(u"State changed to: {0}".format(JSON.describe(last)))
 
-        #
-        # Add system report entries, then user entries
-        #
-        if system_messages:
-            incident.report_entries.append(
-                ReportEntry(
-                    author = self.avatarId.decode("utf-8"),
-                    text = u"\n".join(system_messages),
-                    system_entry = True,
+            #
+            # Add system report entries, then user entries
+            #
+            if system_messages:
+                incident.report_entries.append(
+                    ReportEntry(
+                        author = self.avatarId.decode("utf-8"),
+                        text = u"\n".join(system_messages),
+                        system_entry = True,
+                    )
                 )
-            )
-        incident.report_entries.extend(user_entries)
+            incident.report_entries.extend(user_entries)
 
         #
-        # Write to disk
+        # Write to disk, after any edits already under way
         #
-        self.storage.write_incident(incident)
+        d = self.storage.edit_incident(number, apply_edits)
 
         #
-        # Respond
+        # Respond once the write is durable
         #
         set_response_header(request, HeaderName.contentType, ContentType.JSON)
         request.setResponseCode(http.OK)
 
-        return "";
+        d.addCallback(lambda _: "")
+        return d
 
 
     @app.route("/incidents/", methods=("POST",))
     @http_sauce
     def new_incident(self, request):
-        incident = Incident.from_json_io(request.content, number=self.storage.next_incident_number())
+        if self.config.follower is not None:
+            return self.read_only(request)
 
-        # Edit report entrys to add author
-        for entry in incident.report_entries:
-            entry.author = self.avatarId.decode("utf-8")
+        d = self.storage.next_incident_number()
 
-        self.storage.write_incident(incident)
+        def got_number(number):
+            incident = Incident.from_json_io(request.content, number=number)
 
-        request.setResponseCode(http.CREATED)
+            # Edit report entrys to add author
+            for entry in incident.report_entries:
+                entry.author = self.avatarId.decode("utf-8")
+
+            d = self.storage.write_incident(incident)
+
+            request.setResponseCode(http.CREATED)
+
+            request.setHeader(
+                HeaderName.incidentNumber.value,
+                incident.number
+            )
+            request.setHeader(
+                HeaderName.location.value,
+                url_for(request, "get_incident", {"number": incident.number})
+            )
+
+            d.addCallback(lambda _: "")
+            return d
+
+        d.addCallback(got_number)
+        return d
+
+
+    @app.route("/replication", methods=("GET",))
+    @http_sauce
+    def replication(self, request):
+        set_response_header(request, HeaderName.contentType, ContentType.JSON)
+
+        status = {}
+        if self.config.replication_source is not None:
+            status["source"] = self.config.replication_source.status()
+        if self.config.follower is not None:
+            status["follower"] = self.config.follower.status()
+
+        return to_json_text(status)
+
+
+    @app.route("/sync", methods=("GET",))
+    @http_sauce
+    def sync_vector(self, request):
+        engine = self.config.sync_engine
+        if engine is None:
+            return self.not_syncing(request)
+
+        set_response_header(request, HeaderName.contentType, ContentType.JSON)
+        return to_json_text(engine.state())
+
+
+    @app.route("/sync", methods=("POST",))
+    @http_sauce
+    def sync(self, request):
+        engine = self.config.sync_engine
+        if engine is None:
+            return self.not_syncing(request)
+
+        body = request.content.read()
+        try:
+            if request.getHeader(HeaderName.contentEncoding.value) == "deflate":
+                body = zlib.decompress(body)
+            bundle = from_json_text(body)
+        except (zlib.error, ValueError) as e:
+            raise SyncError("Unable to read sync bundle: {0}".format(e))
+
+        d = engine.merge_bundle(bundle)
+
+        def merged(_):
+            set_response_header(request, HeaderName.contentType, ContentType.JSON)
+
+            response = to_json_text(engine.bundle(bundle["vector"]))
+
+            accept = request.getHeader(HeaderName.acceptEncoding.value) or ""
+            if "deflate" in accept:
+                set_response_header(request, HeaderName.contentEncoding, "deflate")
+                response = zlib.compress(response)
+
+            return response
+
+        d.addCallback(merged)
+        return d
+
+
+    def not_syncing(self, request):
+        request.setResponseCode(http.NOT_FOUND)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "This server doesn't sync.\n"
 
-        request.setHeader(
-            HeaderName.incidentNumber.value,
-            incident.number
-        )
-        request.setHeader(
-            HeaderName.location.value,
-            url_for(request, "get_incident", {"number": incident.number})
-        )
 
-        return "";
+    def read_only(self, request):
+        request.setResponseCode(http.FORBIDDEN)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "This server is a read-only replica.\n"
 
 
     @app.route("/queue", methods=("GET",))
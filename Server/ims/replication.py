@@ -0,0 +1,722 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Replication of incident writes to read-only followers
+"""
+
+__all__ = [
+    "ReplicationError",
+    "WriteStream",
+    "ReplicationSource",
+    "Follower",
+]
+
+from uuid import uuid4
+from collections import deque
+from hashlib import sha1 as etag_hash
+
+from zope.interface import implements
+
+from twisted.python import log
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall, Cooperator
+from twisted.internet.task import TaskFinished, TaskStopped
+from twisted.protocols.basic import LineReceiver
+
+from ims.data import Incident
+from ims.asyncstore import AsyncStorage
+
+
+
+class ReplicationError(RuntimeError):
+    """
+    Replication error.
+    """
+
+
+
+class WriteStream(object):
+    """
+    The writes made to a store, numbered in sequence.
+
+    Each write is recorded as a tuple of its sequence number, the time
+    at which it became durable, the incident number and the incident's
+    JSON text.  The last C{backlog} writes are kept, so that a follower
+    which falls briefly behind can catch up without copying the whole
+    store.  Sequence numbers start again at 1 in each new stream, which
+    is identified by a random C{epoch}.
+    """
+
+    def __init__(self, storage, backlog=1000, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.storage = storage
+        self.reactor = reactor
+        self.epoch = uuid4().hex
+        self.sequence = 0
+        self.observers = []
+
+        self._backlog = deque(maxlen=backlog)
+
+        storage.write_observers.append(self._wrote)
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.storage}, "
+            "epoch={self.epoch!r}, sequence={self.sequence})"
+            .format(self=self)
+        )
+
+
+    def _wrote(self, number, json):
+        self.sequence += 1
+        record = (self.sequence, self.reactor.seconds(), number, json)
+        self._backlog.append(record)
+
+        for observer in self.observers:
+            observer(record)
+
+
+    def since(self, sequence):
+        """
+        @return: the writes after the one with the given sequence number,
+            or C{None} if they are not all kept.
+        """
+        if sequence == self.sequence:
+            return []
+
+        if (
+            sequence > self.sequence or
+            not self._backlog or
+            self._backlog[0][0] > sequence + 1
+        ):
+            return None
+
+        return [record for record in self._backlog if record[0] > sequence]
+
+
+
+class ReplicationSource(object):
+    """
+    Streams the writes in a L{WriteStream} to followers connecting to a
+    UNIX socket.
+
+    The protocol is line-based.  A follower sends::
+
+        follow <epoch> <sequence>
+
+    naming the last write it has applied.  If the source still has the
+    writes since then, it sends them; otherwise, it sends a snapshot of
+    every incident::
+
+        snapshot <epoch> <sequence>
+        incident <number> <json>
+        ...
+        end <sequence>
+
+    after which the follower is at the given epoch and sequence.  Each
+    write is then sent as it becomes durable::
+
+        write <sequence> <time> <number> <json>
+
+    and every C{heartbeat_interval} seconds, the source sends its
+    current sequence number and time, so that followers can tell how far
+    behind they are::
+
+        sequence <sequence> <time>
+
+    (JSON text is sent on one line; line breaks can only appear between
+    its tokens, so they are replaced with spaces.)
+
+    A snapshot's incidents are read one at a time through C{storage}, an
+    L{ims.asyncstore.AsyncStorage} over the stream's store, and sent as
+    fast as the follower's connection takes them.  Writes made while a
+    snapshot is being sent follow its end.
+    """
+
+    heartbeat_interval = 1.0
+
+
+    def __init__(self, stream, fp, storage=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if storage is None:
+            storage = AsyncStorage(stream.storage, pool_size=0, reactor=reactor)
+
+        self.stream = stream
+        self.fp = fp
+        self.storage = storage
+        self.reactor = reactor
+        self.followers = []
+
+        self._port = None
+        self._heartbeat = None
+        self._snapshots = {}
+        self._cooperator = Cooperator(
+            scheduler=lambda f: self.reactor.callLater(0, f)
+        )
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.stream}, {self.fp.path})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Start listening for followers.
+        """
+        if self._port is not None:
+            return
+
+        log.msg("Starting {0}".format(self))
+
+        factory = Factory()
+        factory.protocol = SourceProtocol
+        factory.source = self
+
+        self._port = self.reactor.listenUNIX(
+            self.fp.path, factory, wantPID=True
+        )
+
+        self.stream.observers.append(self._wrote)
+
+        self._heartbeat = LoopingCall(self._beat)
+        self._heartbeat.clock = self.reactor
+        self._heartbeat.start(self.heartbeat_interval, now=False)
+
+
+    def stop(self):
+        """
+        Stop listening and disconnect followers.
+        """
+        if self._port is None:
+            return
+
+        self._heartbeat.stop()
+        self._heartbeat = None
+
+        self.stream.observers.remove(self._wrote)
+
+        for snapshot in self._snapshots.values():
+            snapshot.stopProducing()
+        self._snapshots = {}
+
+        for follower in self.followers:
+            follower.transport.loseConnection()
+        self.followers = []
+
+        d = self._port.stopListening()
+        self._port = None
+        return d
+
+
+    def status(self):
+        """
+        @return: a dictionary describing the source, for clients.
+        """
+        return {
+            "epoch": self.stream.epoch,
+            "sequence": self.stream.sequence,
+            "followers": len(self.followers),
+        }
+
+
+    def follow(self, protocol, epoch, sequence):
+        """
+        Start sending writes to a follower.
+        """
+        records = None
+        if epoch == self.stream.epoch:
+            records = self.stream.since(sequence)
+
+        if records is None:
+            log.msg(
+                "Sending snapshot at {0} to follower".format(self.stream.sequence)
+            )
+            self._snapshots[protocol] = _Snapshot(self, protocol)
+        else:
+            log.msg(
+                "Sending {0} writes to follower at {1}"
+                .format(len(records), sequence)
+            )
+            for record in records:
+                self._send_write(protocol, record)
+
+        self.followers.append(protocol)
+
+
+    def unfollow(self, protocol):
+        """
+        Stop sending writes to a follower.
+        """
+        if protocol in self.followers:
+            self.followers.remove(protocol)
+
+        snapshot = self._snapshots.pop(protocol, None)
+        if snapshot is not None:
+            snapshot.stopProducing()
+
+
+    def _snapshot_sent(self, snapshot):
+        protocol = snapshot.protocol
+        if self._snapshots.get(protocol) is not snapshot:
+            return
+
+        del self._snapshots[protocol]
+        for record in snapshot.queued:
+            self._send_write(protocol, record)
+
+
+    def _send_write(self, protocol, record):
+        sequence, time, number, json = record
+        protocol.sendLine(
+            "write {0} {1!r} {2} {3}"
+            .format(sequence, time, number, json.replace("\n", " "))
+        )
+
+
+    def _wrote(self, record):
+        for follower in self.followers:
+            snapshot = self._snapshots.get(follower)
+            if snapshot is None:
+                self._send_write(follower, record)
+            else:
+                snapshot.queued.append(record)
+
+
+    def _beat(self):
+        line = "sequence {0} {1!r}".format(
+            self.stream.sequence, self.reactor.seconds()
+        )
+        for follower in self.followers:
+            if follower not in self._snapshots:
+                follower.sendLine(line)
+
+
+
+class _Snapshot(object):
+    """
+    Sends a snapshot of every incident to a follower, as a producer on
+    its connection.  C{queued} holds the writes made since the snapshot's
+    sequence number, to be sent after it.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, source, protocol):
+        self.source = source
+        self.protocol = protocol
+        self.sequence = source.stream.sequence
+        self.queued = []
+
+        protocol.sendLine(
+            "snapshot {0} {1}".format(source.stream.epoch, self.sequence)
+        )
+        protocol.transport.registerProducer(self, True)
+
+        self._task = source._cooperator.cooperate(self._send())
+        self._task.whenDone().addCallbacks(self._sent, self._failed)
+
+
+    def _send(self):
+        storage = self.source.storage
+        numbers = []
+
+        d = storage.list_incidents()
+        d.addCallback(
+            lambda incidents: numbers.extend(sorted(n for n, etag in incidents))
+        )
+        yield d
+
+        for number in numbers:
+            d = storage.read_incident_with_number_raw(number)
+            d.addCallbacks(
+                self._read, self._unreadable,
+                callbackArgs=(number,), errbackArgs=(number,),
+            )
+            yield d
+
+
+    def _read(self, json, number):
+        self.protocol.sendLine(
+            "incident {0} {1}".format(number, json.replace("\n", " "))
+        )
+
+
+    def _unreadable(self, f, number):
+        log.err(
+            "Unable to read incident {0} for follower: {1}"
+            .format(number, f.value)
+        )
+
+
+    def _sent(self, _):
+        self.protocol.transport.unregisterProducer()
+        self.protocol.sendLine("end {0}".format(self.sequence))
+        self.source._snapshot_sent(self)
+
+
+    def _failed(self, f):
+        self.protocol.transport.unregisterProducer()
+        if f.check(TaskStopped):
+            return
+
+        log.err(f, "Unable to send snapshot to follower")
+        self.protocol.transport.loseConnection()
+
+
+    def pauseProducing(self):
+        self._task.pause()
+
+
+    def resumeProducing(self):
+        self._task.resume()
+
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except TaskFinished:
+            pass
+
+
+
+class SourceProtocol(LineReceiver):
+    """
+    Protocol for the source's end of a connection from a follower.
+    """
+
+    delimiter = "\n"
+    MAX_LENGTH = 1024
+
+
+    def connectionMade(self):
+        self.following = False
+
+
+    def lineReceived(self, line):
+        if self.following:
+            return
+
+        try:
+            command, epoch, sequence = line.split(" ")
+            if command != "follow":
+                raise ValueError(command)
+            sequence = int(sequence)
+        except ValueError:
+            log.msg("Invalid request from follower: {0!r}".format(line))
+            self.transport.loseConnection()
+            return
+
+        self.following = True
+        self.factory.source.follow(self, epoch, sequence)
+
+
+    def connectionLost(self, reason):
+        self.factory.source.unfollow(self)
+
+
+
+class Follower(object):
+    """
+    Applies the writes streamed by a L{ReplicationSource} to a store,
+    through an L{ims.asyncstore.AsyncStorage}, reconnecting whenever the
+    connection to the source is lost.
+
+    C{sequence} is the sequence number of the last write applied (with
+    all writes before it), and C{primary_sequence} that of the last
+    write which the source is known to have made.  C{synced_at} is the
+    time, by the source's clock, as of which the store was last known to
+    be a copy of the source's.
+    """
+
+    def __init__(self, storage, fp, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.storage = storage
+        self.fp = fp
+        self.reactor = reactor
+
+        self.epoch = None
+        self.sequence = 0
+        self.primary_sequence = 0
+        self.synced_at = None
+        self.errors = 0
+
+        self._factory = None
+        self._protocol = None
+        self._snapshot = None
+        self._receiving = None
+        self._pending = deque()
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.storage}, {self.fp.path})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Start following the source.
+        """
+        if self._factory is not None:
+            return
+
+        log.msg("Starting {0}".format(self))
+
+        self._factory = FollowerFactory(self)
+        self.reactor.connectUNIX(self.fp.path, self._factory)
+
+
+    def stop(self):
+        """
+        Stop following the source.
+        """
+        if self._factory is None:
+            return
+
+        self._factory.stopTrying()
+        self._factory = None
+
+        if self._protocol is not None:
+            self._protocol.transport.loseConnection()
+
+
+    @property
+    def connected(self):
+        return self._protocol is not None
+
+
+    def lag(self):
+        """
+        @return: how far behind the source this follower is, as a tuple of
+            a number of writes and of seconds (or C{None} if the follower
+            has never caught up with the source).
+        """
+        if self.synced_at is None:
+            seconds = None
+        else:
+            seconds = max(0.0, self.reactor.seconds() - self.synced_at)
+
+        return (self.primary_sequence - self.sequence, seconds)
+
+
+    def status(self):
+        """
+        @return: a dictionary describing the follower, for clients.
+        """
+        lag_sequence, lag_seconds = self.lag()
+
+        return {
+            "connected": self.connected,
+            "epoch": self.epoch,
+            "sequence": self.sequence,
+            "primary_sequence": self.primary_sequence,
+            "lag_sequence": lag_sequence,
+            "lag_seconds": lag_seconds,
+            "errors": self.errors,
+        }
+
+
+    def connected_to(self, protocol):
+        self._protocol = protocol
+        self._snapshot = None
+        self._receiving = self.epoch
+        protocol.sendLine("follow {0} {1}".format(self.epoch or "-", self.sequence))
+
+
+    def disconnected_from(self, protocol):
+        if self._protocol is protocol:
+            self._protocol = None
+
+
+    def received(self, line):
+        """
+        Handle a line from the source.
+        """
+        try:
+            command, rest = line.split(" ", 1)
+
+            if command == "write":
+                sequence, time, number, json = rest.split(" ", 3)
+                self._write(int(sequence), float(time), int(number), json)
+
+            elif command == "incident":
+                number, json = rest.split(" ", 1)
+                if self._snapshot is None:
+                    raise ValueError("Incident outside of snapshot")
+                self._write(None, None, int(number), json)
+
+            elif command == "sequence":
+                sequence, time = rest.split(" ")
+                self._heartbeat(int(sequence), float(time))
+
+            elif command == "snapshot":
+                epoch, sequence = rest.split(" ")
+                sequence = int(sequence)
+                log.msg("Receiving snapshot at {0}".format(sequence))
+                self._snapshot = (epoch, sequence)
+                self._receiving = epoch
+                if epoch != self.epoch:
+                    # Sequence numbers start again in a new stream.
+                    self.primary_sequence = sequence
+
+            elif command == "end":
+                if self._snapshot is None:
+                    raise ValueError("End outside of snapshot")
+                epoch, sequence = self._snapshot
+                self._snapshot = None
+                self._enqueue(None, lambda: self._snapshot_applied(epoch, sequence))
+
+            else:
+                raise ValueError(command)
+
+        except ValueError:
+            log.msg("Invalid line from replication source: {0!r}".format(line[:80]))
+            if self._protocol is not None:
+                self._protocol.transport.loseConnection()
+
+
+    def _write(self, sequence, time, number, json):
+        if sequence is None:
+            # Don't rewrite incidents in a snapshot which we already have.
+            try:
+                etag = self.storage.storage.etag_for_incident_with_number(number)
+            except Exception:
+                etag = None
+            if etag == etag_hash(json).hexdigest():
+                return
+        else:
+            self.primary_sequence = max(self.primary_sequence, sequence)
+
+        try:
+            incident = Incident.from_json_text(json, number=number)
+            d = self.storage.write_incident(incident)
+        except Exception as e:
+            self.errors += 1
+            log.err(
+                "Unable to apply replicated write of incident {0}: {1}"
+                .format(number, e)
+            )
+            d = None
+
+        if sequence is None:
+            self._enqueue(d, None)
+        else:
+            epoch = self._receiving
+            self._enqueue(d, lambda: self._applied(epoch, sequence, time))
+
+
+    def _enqueue(self, d, applied):
+        """
+        Call C{applied} once C{d} and everything enqueued before it have
+        fired.
+        """
+        entry = [d is None, applied]
+        self._pending.append(entry)
+
+        if d is None:
+            self._drain()
+            return
+
+        def failed(f):
+            self.errors += 1
+            log.err(f, "Unable to apply replicated write")
+
+        def done(_):
+            entry[0] = True
+            self._drain()
+
+        d.addErrback(failed)
+        d.addCallback(done)
+
+
+    def _drain(self):
+        while self._pending and self._pending[0][0]:
+            done, applied = self._pending.popleft()
+            if applied is not None:
+                applied()
+
+
+    def _applied(self, epoch, sequence, time):
+        if epoch != self.epoch:
+            # Superseded by a snapshot from another stream.
+            return
+        self.sequence = sequence
+        if sequence >= self.primary_sequence:
+            self.synced_at = time
+
+
+    def _snapshot_applied(self, epoch, sequence):
+        log.msg("Applied snapshot at {0}".format(sequence))
+        self.epoch = epoch
+        self.sequence = sequence
+        self.primary_sequence = max(self.primary_sequence, sequence)
+
+
+    def _heartbeat(self, sequence, time):
+        self.primary_sequence = max(self.primary_sequence, sequence)
+        if (
+            self.epoch is not None and not self._pending and
+            self.sequence == sequence
+        ):
+            self.synced_at = time
+
+
+
+class FollowerProtocol(LineReceiver):
+    """
+    Protocol for the follower's end of a connection to a source.
+    """
+
+    delimiter = "\n"
+    MAX_LENGTH = 16 * 1024 * 1024
+
+
+    def connectionMade(self):
+        self.factory.resetDelay()
+        self.factory.follower.connected_to(self)
+
+
+    def lineReceived(self, line):
+        self.factory.follower.received(line)
+
+
+    def connectionLost(self, reason):
+        self.factory.follower.disconnected_from(self)
+
+
+
+class FollowerFactory(ReconnectingClientFactory):
+    """
+    Factory for a follower's connections to a source.
+    """
+
+    protocol = FollowerProtocol
+    maxDelay = 5
+
+    def __init__(self, follower):
+        self.follower = follower
@@ -31,6 +31,7 @@ from functools import wraps
 from twisted.python import log
 from twisted.python.constants import Names, NamedConstant
 from twisted.python.constants import Values, ValueConstant
+from twisted.internet.defer import Deferred
 from twisted.web import http
 
 from klein.interfaces import IKleinRequest
@@ -38,6 +39,7 @@ from klein.interfaces import IKleinRequest
 from ims.data import InvalidDataError
 from ims.store import NoSuchIncidentError
 from ims.dms import DatabaseError
+from ims.sync import SyncError
 
 
 def url_for(request, endpoint, *args, **kwargs):
@@ -104,42 +106,69 @@ def http_sauce(f):
         request.user = self.avatarId
 
         try:
-            return f(self, request, *args, **kwargs)
-
-        except NoSuchIncidentError as e:
-            request.setResponseCode(http.NOT_FOUND)
-            set_response_header(request, HeaderName.contentType, ContentType.plain)
-            return "No such incident: {0}\n".format(e)
+            response = f(self, request, *args, **kwargs)
+        except Exception as e:
+            return error_response(request, e)
 
-        except InvalidDataError as e:
-            log.err(e)
-            request.setResponseCode(http.BAD_REQUEST)
-            set_response_header(request, HeaderName.contentType, ContentType.plain)
-            return "Invalid data: {0}\n".format(e)
+        if isinstance(response, Deferred):
+            def onError(failure):
+                try:
+                    failure.raiseException()
+                except Exception as e:
+                    return error_response(request, e)
 
-        except DatabaseError as e:
-            log.err(e)
-            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
-            set_response_header(request, HeaderName.contentType, ContentType.plain)
-            return "Database error."
+            response.addErrback(onError)
 
-        except Exception as e:
-            log.err(e)
-            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
-            set_response_header(request, HeaderName.contentType, ContentType.plain)
-            return "Server error.\n"
+        return response
 
     return wrapper
 
 
+def error_response(request, e):
+    """
+    Set up the response to a request for which an exception was raised.
+
+    @return: the body of the response.
+    """
+    if isinstance(e, NoSuchIncidentError):
+        request.setResponseCode(http.NOT_FOUND)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "No such incident: {0}\n".format(e)
+
+    if isinstance(e, InvalidDataError):
+        log.err(e)
+        request.setResponseCode(http.BAD_REQUEST)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "Invalid data: {0}\n".format(e)
+
+    if isinstance(e, SyncError):
+        log.err(e)
+        request.setResponseCode(http.BAD_REQUEST)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "Invalid sync: {0}\n".format(e)
+
+    if isinstance(e, DatabaseError):
+        log.err(e)
+        request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        set_response_header(request, HeaderName.contentType, ContentType.plain)
+        return "Database error."
+
+    log.err(e)
+    request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+    set_response_header(request, HeaderName.contentType, ContentType.plain)
+    return "Server error.\n"
+
+
 
 class HeaderName (Values):
-    contentType    = ValueConstant("Content-Type")
-    etag           = ValueConstant("ETag")
-    incidentNumber = ValueConstant("Incident-Number")
-    location       = ValueConstant("Location")
-    userAgent      = ValueConstant("User-Agent")
-    accept         = ValueConstant("Accept")
+    contentType     = ValueConstant("Content-Type")
+    etag            = ValueConstant("ETag")
+    incidentNumber  = ValueConstant("Incident-Number")
+    location        = ValueConstant("Location")
+    userAgent       = ValueConstant("User-Agent")
+    accept          = ValueConstant("Accept")
+    acceptEncoding  = ValueConstant("Accept-Encoding")
+    contentEncoding = ValueConstant("Content-Encoding")
 
 
 
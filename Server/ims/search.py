@@ -0,0 +1,457 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Incident search
+"""
+
+__all__ = [
+    "TrigramIndex",
+    "FieldIndex",
+    "IncidentIndexes",
+    "strings_from_incident",
+    "incident_matches_terms",
+    "incident_state",
+]
+
+from ims.data import JSON
+
+
+class TrigramIndex(object):
+    """
+    Index of the searchable strings in incidents by the three-character
+    sequences (trigrams) they contain.
+
+    A search term can only occur in strings which contain every trigram
+    in the term, so intersecting the sets of incidents containing each
+    of a term's trigrams yields a (usually small) set of candidate
+    incidents.  The candidates are then checked against the term, which
+    is quick because the index keeps each incident's lowercased strings.
+
+    Matching is exactly that of L{incident_matches_terms}.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._strings = {}
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}("
+            "incidents={incidents},"
+            "trigrams={trigrams})"
+            .format(
+                self=self,
+                incidents=len(self._strings),
+                trigrams=len(self._postings),
+            )
+        )
+
+
+    def __len__(self):
+        return len(self._strings)
+
+
+    def __contains__(self, number):
+        return number in self._strings
+
+
+    def add(self, incident):
+        """
+        Index an incident, replacing any prior index entries for it.
+        """
+        self.add_strings(incident.number, self.strings(incident))
+
+
+    @staticmethod
+    def strings(incident):
+        """
+        @return: the strings under which an incident is indexed, for
+            L{add_strings}.  These may be computed in another process.
+        """
+        return tuple(
+            string.lower()
+            for string in strings_from_incident(incident)
+            if string is not None
+        )
+
+
+    def add_strings(self, number, strings):
+        """
+        Index an incident under strings from L{strings}, replacing any
+        prior index entries for it.
+        """
+        self.remove(number)
+
+        self._strings[number] = strings
+
+        for string in strings:
+            for trigram in trigrams(string):
+                try:
+                    self._postings[trigram].add(number)
+                except KeyError:
+                    self._postings[trigram] = set((number,))
+
+
+    def remove(self, number):
+        """
+        Remove an incident from the index, if present.
+        """
+        strings = self._strings.pop(number, None)
+        if strings is None:
+            return
+
+        for string in strings:
+            for trigram in trigrams(string):
+                posting = self._postings.get(trigram, None)
+                if posting is not None:
+                    posting.discard(number)
+                    if not posting:
+                        del self._postings[trigram]
+
+
+    def clear(self):
+        """
+        Remove all incidents from the index.
+        """
+        self._postings.clear()
+        self._strings.clear()
+
+
+    def search(self, terms):
+        """
+        Find the incidents in which every search term occurs, case
+        insensitively, in some string.
+
+        @return: a set of incident numbers.
+        """
+        terms = [term.lower() for term in terms]
+
+        # Narrow down the candidates using the longest terms first, as
+        # they have the most selective sets of trigrams.
+        terms.sort(key=len, reverse=True)
+
+        candidates = None
+        for term in terms:
+            for trigram in trigrams(term):
+                posting = self._postings.get(trigram, None)
+                if posting is None:
+                    return set()
+                if candidates is None:
+                    candidates = set(posting)
+                else:
+                    candidates &= posting
+                if not candidates:
+                    return candidates
+
+        if candidates is None:
+            # No terms long enough to have trigrams
+            candidates = self._strings.iterkeys()
+
+        return set(
+            number for number in candidates
+            if self._matches(number, terms)
+        )
+
+
+    def _matches(self, number, terms):
+        strings = self._strings[number]
+        for term in terms:
+            for string in strings:
+                if term in string:
+                    break
+            else: # Didn't match term
+                return False
+        return True
+
+
+
+class FieldIndex(object):
+    """
+    Index of incidents by the values of some field.
+
+    C{values_from_incident} is called with an incident and returns an
+    iterable of the values under which to index it.
+    """
+
+    def __init__(self, values_from_incident):
+        self.values_from_incident = values_from_incident
+        self._numbers = {}
+        self._values = {}
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}("
+            "incidents={incidents},"
+            "values={values})"
+            .format(
+                self=self,
+                incidents=len(self._values),
+                values=len(self._numbers),
+            )
+        )
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def __contains__(self, number):
+        return number in self._values
+
+
+    def add(self, incident):
+        """
+        Index an incident, replacing any prior index entries for it.
+        """
+        number = incident.number
+
+        self.remove(number)
+
+        values = frozenset(
+            value for value in self.values_from_incident(incident)
+            if value is not None
+        )
+
+        self._values[number] = values
+
+        for value in values:
+            try:
+                self._numbers[value].add(number)
+            except KeyError:
+                self._numbers[value] = set((number,))
+
+
+    def remove(self, number):
+        """
+        Remove an incident from the index, if present.
+        """
+        values = self._values.pop(number, None)
+        if values is None:
+            return
+
+        for value in values:
+            numbers = self._numbers[value]
+            numbers.discard(number)
+            if not numbers:
+                del self._numbers[value]
+
+
+    def clear(self):
+        """
+        Remove all incidents from the index.
+        """
+        self._numbers.clear()
+        self._values.clear()
+
+
+    def values(self):
+        """
+        @return: the values under which incidents are indexed.
+        """
+        return self._numbers.keys()
+
+
+    def incidents(self):
+        """
+        @return: a set of the numbers of all indexed incidents.
+        """
+        return set(self._values)
+
+
+    def numbers(self, *values):
+        """
+        @return: a set of the numbers of incidents indexed under any of
+            the given values.
+        """
+        if len(values) == 1:
+            return set(self._numbers.get(values[0], ()))
+
+        result = set()
+        for value in values:
+            result.update(self._numbers.get(value, ()))
+        return result
+
+
+
+class IncidentIndexes(object):
+    """
+    Secondary indexes of incidents by state, Ranger handle, incident type
+    and location name.
+    """
+
+    def __init__(self):
+        self.state = FieldIndex(
+            lambda incident: (incident_state(incident),)
+        )
+        self.ranger = FieldIndex(
+            lambda incident: (ranger.handle for ranger in incident.rangers or ())
+        )
+        self.incident_type = FieldIndex(
+            lambda incident: incident.incident_types or ()
+        )
+        self.location = FieldIndex(
+            lambda incident: (
+                () if incident.location is None else (incident.location.name,)
+            )
+        )
+
+        self._indexes = (
+            self.state, self.ranger, self.incident_type, self.location
+        )
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}(incidents={incidents})"
+            .format(self=self, incidents=len(self.state))
+        )
+
+
+    def __len__(self):
+        return len(self.state)
+
+
+    def __contains__(self, number):
+        return number in self.state
+
+
+    def add(self, incident):
+        """
+        Index an incident, replacing any prior index entries for it.
+        """
+        for index in self._indexes:
+            index.add(incident)
+
+
+    def remove(self, number):
+        """
+        Remove an incident from the indexes, if present.
+        """
+        for index in self._indexes:
+            index.remove(number)
+
+
+    def clear(self):
+        """
+        Remove all incidents from the indexes.
+        """
+        for index in self._indexes:
+            index.clear()
+
+
+    def open_incidents(self):
+        """
+        @return: a set of the numbers of incidents which are not closed.
+        """
+        return self.state.numbers(*[
+            state for state in JSON.states() if state is not JSON.closed
+        ])
+
+
+    def query(
+        self, states=None, ranger_handle=None,
+        incident_type=None, location_name=None,
+    ):
+        """
+        Find incidents matching all of the given criteria.
+
+        @param states: an iterable of states (C{JSON.created} for new
+            incidents, C{JSON.dispatched}, C{JSON.on_scene} or
+            C{JSON.closed}), one of which the incidents must be in.
+
+        @return: a set of incident numbers.
+        """
+        result = None
+
+        for index, values in (
+            (self.state, states),
+            (self.ranger, (ranger_handle,)),
+            (self.incident_type, (incident_type,)),
+            (self.location, (location_name,)),
+        ):
+            if values is None or values == (None,):
+                continue
+
+            numbers = index.numbers(*values)
+
+            if result is None:
+                result = numbers
+            else:
+                result &= numbers
+
+        if result is None:
+            result = self.state.incidents()
+
+        return result
+
+
+
+def trigrams(string):
+    """
+    Produce the three-character sequences in a string.
+    """
+    return set(string[i:i+3] for i in xrange(len(string) - 2))
+
+
+
+
+def strings_from_incident(incident):
+    """
+    Produce the strings in an incident which are searched by
+    L{ims.store.Storage.search_incidents}.
+    """
+    yield incident.summary
+    if incident.location is not None:
+        yield incident.location.name
+        yield incident.location.address
+    for incident_type in incident.incident_types or ():
+        yield incident_type
+    for ranger in incident.rangers or ():
+        yield ranger.handle
+    for entry in incident.report_entries or ():
+        yield entry.text
+
+
+def incident_matches_terms(incident, terms):
+    """
+    Determine whether every search term occurs, case insensitively, in
+    some string in an incident.
+    """
+    for term in terms:
+        for string in strings_from_incident(incident):
+            if string is None:
+                continue
+            if term.lower() in string.lower():
+                break
+        else: # Didn't match term
+            return False
+    return True
+
+
+
+def incident_state(incident):
+    """
+    Determine the state of an incident, which is the latest state for
+    which the incident has a time.  Incidents with no state times are
+    new (C{JSON.created}).
+    """
+    for state in reversed(JSON.states()):
+        if getattr(incident, state.name) is not None:
+            return state
+    return JSON.created
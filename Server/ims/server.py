@@ -22,12 +22,14 @@ __all__ = [
     "Resource",
 ]
 
+import os
+
 if __name__ == "__main__":
     import sys
-    import os
     sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
 from twisted.python.filepath import FilePath
+from twisted.internet import reactor
 from twisted.cred.checkers import FilePasswordDB
 
 from ims.config import Configuration
@@ -35,13 +37,44 @@ from ims.auth import guard
 from ims.protocol import IncidentManagementSystem
 
 
-def loadConfig():
-    configFile = FilePath(__file__).parent().parent().child("conf").child("imsd.conf")
-    return Configuration(configFile)
-
-
-def Resource():
-    config = loadConfig()
+def configFile():
+    """
+    @return: the configuration file, which is C{conf/imsd.conf} unless the
+        C{IMSD_CONFIG} environment variable names another.
+    """
+    path = os.environ.get("IMSD_CONFIG", None)
+    if path:
+        return FilePath(path)
+    return FilePath(__file__).parent().parent().child("conf").child("imsd.conf")
+
+
+def loadConfig(worker=None, persist=True):
+    return Configuration(configFile(), worker=worker, persist=persist)
+
+
+def Resource(worker=None):
+    config = loadConfig(worker)
+    reactor.callWhenRunning(config.async_storage.start)
+    # Close the store only once the storage threads, which read from it
+    # and sync its journal, have stopped, and everything else stopping
+    # "before" shutdown is done with it.
+    reactor.addSystemEventTrigger("during", "shutdown", config.async_storage.stop)
+    reactor.addSystemEventTrigger("after", "shutdown", config.storage.close)
+    if config.storage_watcher is not None:
+        reactor.callWhenRunning(config.storage_watcher.start)
+        reactor.addSystemEventTrigger("during", "shutdown", config.storage_watcher.stop)
+    if config.replication_source is not None:
+        reactor.callWhenRunning(config.replication_source.start)
+        reactor.addSystemEventTrigger("before", "shutdown", config.replication_source.stop)
+    if config.follower is not None:
+        reactor.callWhenRunning(config.follower.start)
+        reactor.addSystemEventTrigger("before", "shutdown", config.follower.stop)
+    if config.sync_engine is not None:
+        reactor.callWhenRunning(config.sync_engine.start)
+        reactor.addSystemEventTrigger("before", "shutdown", config.sync_engine.close)
+    if config.sync_client is not None:
+        reactor.callWhenRunning(config.sync_client.start)
+        reactor.addSystemEventTrigger("before", "shutdown", config.sync_client.stop)
     return guard(
         lambda: IncidentManagementSystem(config),
         "Ranger Incident Management System",
@@ -0,0 +1,292 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Incident cache shared between processes
+"""
+
+__all__ = [
+    "SharedIncidentCache",
+    "SharedCacheError",
+]
+
+import os
+import mmap
+import fcntl
+import struct
+from errno import EACCES, EAGAIN
+from threading import Lock
+
+from twisted.python import log
+
+
+
+class SharedCacheError(RuntimeError):
+    """
+    Shared cache error.
+    """
+
+
+
+class SharedIncidentCache(object):
+    """
+    Cache of the text and etags of incidents in a memory-mapped file,
+    shared by all processes using a store, so that an incident written
+    by one process can be read by the others without reading its files,
+    and so that adding processes doesn't add copies of the cache.
+
+    The file holds a header followed by C{slots} slots of C{slot_size}
+    bytes; an incident is cached in the slot at its number modulo
+    C{slots}, which it gives up to any other incident cached there
+    later.  A slot records the incident's number plus one (so that the
+    zeroes of an empty slot don't read as incident 0), a generation which
+    identifies the state of the incident's files that the slot reflects,
+    the incident's etag and its JSON text.  Incidents too long for a slot
+    are not cached.
+
+    Reads take no locks.  Each slot begins with a sequence counter which
+    writers make odd before changing the slot and even again afterwards;
+    a reader which finds the counter odd, or changed once it has copied
+    the slot, tries again.  Writers to a slot exclude each other with a
+    POSIX record lock on the slot's first byte, and, as that doesn't
+    exclude other threads of the same process, with a thread lock.
+    Callers must hold the incident's lock (see L{ims.locks}) while
+    caching an incident, so that there is a single writer per incident.
+
+    The first process to open the file clears it, as the store may have
+    changed while no process was using it.  Each process holds a shared
+    lock on the header while it has the file open, so the first process
+    is the one able to lock the header exclusively.
+    """
+
+    magic = "IMC2"
+
+    header_format = "<4sII"
+    header_size = 64
+
+    # sequence, number + 1 (0 if empty), generation, etag, length
+    slot_format = "<IIQ40sI"
+    slot_header_size = struct.calcsize(slot_format)
+
+    # Times a reader tries to copy a slot which is being written
+    read_retries = 100
+
+
+    def __init__(self, fp, slots=1000, slot_size=16384):
+        if slots < 1:
+            raise SharedCacheError("Shared cache must have slots")
+        if slot_size <= self.slot_header_size:
+            raise SharedCacheError(
+                "Shared cache slot size is too small: {0}".format(slot_size)
+            )
+
+        self.fp = fp
+        self.slots = slots
+        self.slot_size = slot_size
+        self.hits = 0
+        self.misses = 0
+
+        self._fd = None
+        self._map = None
+        self._write_lock = Lock()
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}("
+            "{self.fp},"
+            "slots={self.slots!r},"
+            "slot_size={self.slot_size!r},"
+            "hits={self.hits},"
+            "misses={self.misses})"
+            .format(self=self)
+        )
+
+
+    def _file_size(self):
+        return self.header_size + self.slots * self.slot_size
+
+
+    def open(self):
+        """
+        Open and map the cache file, creating or clearing it if this is
+        the first process to use it.
+        """
+        if self._fd is not None:
+            return
+
+        size = self._file_size()
+        header = struct.pack(
+            self.header_format, self.magic, self.slots, self.slot_size
+        )
+
+        fd = os.open(self.fp.path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, 0)
+            except IOError as e:
+                if e.errno not in (EACCES, EAGAIN):
+                    raise
+                first = False
+            else:
+                first = True
+
+            if first:
+                log.msg("Clearing shared cache {0}".format(self.fp.path))
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, header)
+
+            # Downgrade to (or wait for) a shared lock.
+            fcntl.lockf(fd, fcntl.LOCK_SH, 1, 0)
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            if (
+                os.fstat(fd).st_size != size or
+                os.read(fd, len(header)) != header
+            ):
+                raise SharedCacheError(
+                    "Shared cache {0} is in use with other dimensions"
+                    .format(self.fp.path)
+                )
+
+            self._map = mmap.mmap(fd, size)
+        except (IOError, OSError, mmap.error) as e:
+            os.close(fd)
+            raise SharedCacheError(
+                "Unable to open shared cache {0}: {1}".format(self.fp.path, e)
+            )
+        except:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+
+
+    def close(self):
+        """
+        Unmap and close the cache file.
+        """
+        if self._fd is None:
+            return
+
+        self._map.close()
+        self._map = None
+
+        os.close(self._fd)
+        self._fd = None
+
+
+    def _slot_offset(self, number):
+        return self.header_size + (number % self.slots) * self.slot_size
+
+
+    def get(self, number):
+        """
+        Look up an incident.
+
+        @return: a tuple of the cached incident's generation, etag and
+            JSON text, or C{None} if the incident is not cached.
+        """
+        if self._map is None:
+            return None
+
+        offset = self._slot_offset(number)
+        capacity = self.slot_size - self.slot_header_size
+
+        for _ in xrange(self.read_retries):
+            sequence, slot_number, generation, etag, length = (
+                struct.unpack_from(self.slot_format, self._map, offset)
+            )
+            if sequence & 1:
+                continue
+
+            if slot_number != number + 1:
+                break
+
+            start = offset + self.slot_header_size
+            text = self._map[start:start + min(length, capacity)]
+
+            if struct.unpack_from("<I", self._map, offset)[0] == sequence:
+                self.hits += 1
+                return (generation, etag.rstrip("\x00"), text)
+
+        self.misses += 1
+        return None
+
+
+    def put(self, number, generation, etag, text):
+        """
+        Cache an incident, replacing whatever is in its slot.
+
+        @return: whether the incident was cached.
+        """
+        if self._map is None:
+            return False
+
+        if len(text) > self.slot_size - self.slot_header_size:
+            self.discard(number)
+            return False
+
+        self._write_slot(number, (number, generation, etag, text))
+
+        return True
+
+
+    def discard(self, number, keep_generation=None):
+        """
+        Remove an incident from the cache, unless it is cached with the
+        generation C{keep_generation}.
+        """
+        if self._map is None:
+            return
+
+        self._write_slot(number, None, keep_generation)
+
+
+    def _write_slot(self, number, entry, keep_generation=None):
+        with self._write_lock:
+            self._write_slot_locked(number, entry, keep_generation)
+
+
+    def _write_slot_locked(self, number, entry, keep_generation):
+        offset = self._slot_offset(number)
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+        try:
+            sequence, slot_number, generation = struct.unpack_from(
+                "<IIQ", self._map, offset
+            )
+
+            if entry is None:
+                if slot_number != number + 1 or generation == keep_generation:
+                    return
+                slot_number, generation, etag, text = (0, 0, "", "")
+            else:
+                number, generation, etag, text = entry
+                slot_number = number + 1
+
+            struct.pack_into(
+                self.slot_format, self._map, offset,
+                (sequence + 1) & 0xffffffff, slot_number, generation, etag,
+                len(text)
+            )
+            start = offset + self.slot_header_size
+            self._map[start:start + len(text)] = text
+            struct.pack_into("<I", self._map, offset, (sequence + 2) & 0xffffffff)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
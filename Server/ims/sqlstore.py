@@ -0,0 +1,377 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+SQLite data store
+"""
+
+__all__ = [
+    "SQLiteStorage",
+]
+
+import sqlite3
+from threading import RLock
+from hashlib import sha1 as etag_hash
+
+from zope.interface import implements
+
+from twisted.python import log
+from twisted.internet.threads import deferToThreadPool
+
+from ims.data import Incident, render_date
+from ims.store import StorageError, NoSuchIncidentError
+from ims.store import IncidentCache
+from ims.store import incident_number
+from ims.search import incident_matches_terms
+from ims.interfaces import IStorage
+
+
+
+schema = """
+    create table if not exists incident (
+        number     integer primary key,
+        priority   integer not null,
+        created    text,
+        dispatched text,
+        on_scene   text,
+        closed     text,
+        etag       text not null,
+        json       text not null
+    );
+
+    create index if not exists incident_priority   on incident (priority);
+    create index if not exists incident_created    on incident (created);
+    create index if not exists incident_dispatched on incident (dispatched);
+    create index if not exists incident_on_scene   on incident (on_scene);
+    create index if not exists incident_closed     on incident (closed);
+
+    create table if not exists incident_number (
+        last integer not null
+    );
+"""
+
+
+
+class SQLiteStorage(object):
+    """
+    Back-end storage in an SQLite database.
+
+    Each incident is stored as a row containing its JSON text and etag,
+    along with indexed copies of the fields used to select incidents.
+
+    The database connection may be used from any thread, one at a time.
+    If C{threadpool} is set (see L{ims.asyncstore.AsyncStorage}), writes
+    are made in its threads, and written incidents are cached on the
+    reactor once they are committed.
+    """
+    implements(IStorage)
+
+
+    def __init__(self, path, cache_size=1000, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.path = path
+        self.reactor = reactor
+        self.threadpool = None
+        self.incident_cache = IncidentCache(cache_size)
+        self._db = None
+        self._lock = RLock()
+        log.msg("New data store: {0}".format(self))
+
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.path})".format(self=self)
+
+
+    def provision(self):
+        if self._db is not None:
+            return
+
+        parent = self.path.parent()
+        if not parent.exists():
+            log.msg(
+                "Creating storage directory: {0}"
+                .format(parent)
+            )
+            parent.makedirs()
+
+        try:
+            db = sqlite3.connect(
+                self.path.path, isolation_level=None, check_same_thread=False
+            )
+            db.execute("pragma journal_mode = wal")
+            db.executescript(schema)
+
+            with transaction(db, self._lock):
+                (count,) = db.execute(
+                    "select count(*) from incident_number"
+                ).fetchone()
+                if count == 0:
+                    db.execute(
+                        "insert into incident_number (last) "
+                        "select coalesce(max(number), 0) from incident"
+                    )
+        except sqlite3.Error as e:
+            raise StorageError(
+                "Unable to open database {0}: {1}".format(self.path, e)
+            )
+
+        self._db = db
+
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+    @property
+    def db(self):
+        self.provision()
+        return self._db
+
+
+    def list_incidents(self):
+        return (
+            (number, str(etag)) for number, etag
+            in self._query("select number, etag from incident")
+        )
+
+
+    def search_incidents(self, terms=(), show_closed=False):
+        log.msg("Searching for {0!r}, closed={1}".format(terms, show_closed))
+
+        candidates, check_closed, check_terms = self.plan_search(
+            terms, show_closed
+        )
+
+        return (
+            (number, etag) for number, etag in candidates
+            if not check_terms or incident_matches_terms(
+                self.read_incident_with_number(number), terms
+            )
+        )
+
+
+    def plan_search(self, terms=(), show_closed=False):
+        """
+        See L{ims.store.Storage.plan_search}.
+        """
+        if show_closed:
+            query = "select number, etag from incident"
+        else:
+            query = "select number, etag from incident where closed is null"
+
+        candidates = [(number, str(etag)) for number, etag in self._query(query)]
+
+        return (candidates, False, bool(terms))
+
+
+    def etag_for_incident_with_number(self, number):
+        return str(self._select_one("etag", number))
+
+
+    def read_incident_with_number_stamped_raw(self, number):
+        # Incidents in the database aren't stamped.
+        return self.read_incident_with_number_raw(number), False
+
+
+    def read_incident_with_number_raw(self, number):
+        return self._select_one("json", number).encode("utf-8")
+
+
+    def read_incident_with_number(self, number):
+        number = incident_number(number)
+
+        incident = self.incident_cache.get(number)
+        if incident is not None:
+            return incident
+
+        incident = Incident.from_json_text(
+            self._select_one("json", number), number=number
+        )
+
+        self.incident_cache.put(incident)
+
+        return incident
+
+
+    def write_incident(self, incident):
+        return self.write_incidents((incident,))
+
+
+    def write_incidents(self, incidents):
+        """
+        Write a number of incidents in a single transaction.
+
+        @return: a L{Deferred} if this store has a thread pool, otherwise
+            C{None}.
+        """
+        db = self.db
+
+        rows = []
+
+        for incident in incidents:
+            incident.validate()
+
+            self.incident_cache.remove(incident.number)
+
+            json = incident.to_json_text()
+
+            rows.append((
+                incident.number,
+                incident.priority,
+                render_date(incident.created),
+                render_date(incident.dispatched),
+                render_date(incident.on_scene),
+                render_date(incident.closed),
+                etag_hash(json).hexdigest(),
+                json.decode("utf-8"),
+            ))
+
+        if self.threadpool is None:
+            self._cache_written(self._insert(db, rows))
+            return None
+
+        d = deferToThreadPool(
+            self.reactor, self.threadpool, self._insert, db, rows
+        )
+        d.addCallback(self._cache_written)
+        return d
+
+
+    def _insert(self, db, rows):
+        """
+        Write incident rows to the database.  This may be called from any
+        thread.
+
+        @return: the incidents as they will be read back.
+        """
+        stored = []
+
+        with transaction(db, self._lock):
+            for row in rows:
+                number, json = row[0], row[-1]
+
+                db.execute(
+                    """
+                    insert or replace into incident (
+                        number, priority,
+                        created, dispatched, on_scene, closed,
+                        etag, json
+                    )
+                    values (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    row
+                )
+
+                # Cache the incident as it will be read back, not as given.
+                stored.append(Incident.from_json_text(
+                    json.encode("utf-8"), number=number, validate=False
+                ))
+                db.execute(
+                    "update incident_number set last = ? where last < ?",
+                    (number, number)
+                )
+
+        return stored
+
+
+    def _cache_written(self, stored):
+        # Only once the transaction is committed, as a rolled back write
+        # must not be read back from the cache.
+        for incident in stored:
+            self.incident_cache.put(incident)
+
+
+    def next_incident_number(self):
+        db = self.db
+
+        with transaction(db, self._lock):
+            db.execute("update incident_number set last = last + 1")
+            (number,) = db.execute("select last from incident_number").fetchone()
+
+        return number
+
+
+    def import_incidents(self, storage):
+        """
+        Copy all incidents from another store into this one, replacing
+        any incidents with the same numbers.
+        """
+        self.write_incidents([
+            storage.read_incident_with_number(number)
+            for number, etag in storage.list_incidents()
+        ])
+
+
+    def _query(self, query, parameters=()):
+        db = self.db
+        with self._lock:
+            return db.execute(query, parameters).fetchall()
+
+
+    def _select_one(self, column, number):
+        number = incident_number(number)
+
+        rows = self._query(
+            "select {0} from incident where number = ?".format(column),
+            (number,)
+        )
+
+        if not rows:
+            raise NoSuchIncidentError(number)
+
+        return rows[0][0]
+
+
+
+class transaction(object):
+    """
+    Context manager which runs a block in an immediate (write-locked)
+    transaction, committing on success and rolling back on failure.
+
+    If a lock is given, it is held for the duration of the transaction.
+    """
+
+    def __init__(self, db, lock=None):
+        self.db = db
+        self.lock = lock
+
+
+    def __enter__(self):
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            self.db.execute("begin immediate")
+        except:
+            if self.lock is not None:
+                self.lock.release()
+            raise
+        return self.db
+
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if type is None:
+                self.db.execute("commit")
+            else:
+                self.db.execute("rollback")
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+        return False
@@ -22,10 +22,33 @@ __all__ = [
     "Storage",
 ]
 
+import os
+import zlib
+import struct
+from time import time
+from datetime import datetime
+from collections import OrderedDict
 from hashlib import sha1 as etag_hash
 
+from zope.interface import implements
+
 from twisted.python import log
-from ims.data import Incident
+from twisted.python.failure import Failure
+from twisted.internet.threads import deferToThreadPool
+from ims.data import Incident, ReportEntry, InvalidDataError, from_json_text
+from ims.data import parse_date, render_date
+from ims.data import schema_version, validation_version
+from ims.journal import Journal, checksum, sync_path
+from ims.allocator import IncidentNumberAllocator
+from ims.manifest import EtagManifest
+from ims.layout import DirectoryCache, layouts
+from ims.locks import IncidentLocks
+from ims.sharedcache import SharedIncidentCache
+from ims.archive import IncidentArchive
+from ims.search import TrigramIndex, IncidentIndexes, incident_matches_terms
+from ims.warmup import warm_up, upgrade
+from ims.history import IncidentHistory, HistoryError
+from ims.interfaces import IStorage
 
 
 
@@ -43,15 +66,253 @@ class NoSuchIncidentError(StorageError):
 
 
 
+class IncidentCache(object):
+    """
+    Bounded cache of parsed incidents, evicting the least recently used
+    incident when full.
+
+    Incidents are copied on the way in and on the way out, so callers
+    may freely modify what they are given without corrupting the cache.
+    """
+
+    def __init__(self, size_limit):
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        self._incidents = OrderedDict()
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}("
+            "size_limit={self.size_limit!r},"
+            "size={size},"
+            "hits={self.hits},"
+            "misses={self.misses})"
+            .format(self=self, size=len(self))
+        )
+
+
+    def __len__(self):
+        return len(self._incidents)
+
+
+    def __contains__(self, number):
+        return number in self._incidents
+
+
+    def get(self, number):
+        """
+        Look up an incident.
+
+        @return: a copy of the cached incident with the given number, or
+            C{None} if no such incident is cached.
+        """
+        try:
+            incident = self._incidents.pop(number)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        # Re-insert to mark as most recently used
+        self._incidents[number] = incident
+        self.hits += 1
+
+        return incident.copy()
+
+
+    def put(self, incident):
+        """
+        Add an incident to the cache, replacing any cached incident with
+        the same number.
+        """
+        if self.size_limit <= 0:
+            return
+
+        self._incidents.pop(incident.number, None)
+        self._incidents[incident.number] = incident.copy()
+
+        while len(self._incidents) > self.size_limit:
+            self._incidents.popitem(last=False)
+
+
+    def remove(self, number):
+        """
+        Remove an incident from the cache, if present.
+        """
+        self._incidents.pop(number, None)
+
+
+    def clear(self):
+        """
+        Remove all incidents from the cache.
+        """
+        self._incidents.clear()
+
+
+
 class Storage(object):
     """
     Back-end storage
+
+    Each incident is stored in a file named for its number.  If
+    C{entry_log} is true, that file holds only the incident's header
+    fields, and its report entries are kept in an append-only log
+    alongside it, one JSON entry per line, so that adding entries to an
+    incident appends to the log instead of rewriting the incident.
+
+    If C{warm_up_processes} is not zero, every incident is read, parsed
+    and validated when the store is provisioned, in that many processes,
+    to fill in etags, indexes and the cache up front.  Incidents which
+    fail are logged and listed in C{warm_up_errors}.
+
+    If C{shared} is true, the store may be used by several processes at
+    once, each with its own journal, named C{journal_name}.  Writes to an
+    incident then hold an inter-process lock on it until they are
+    applied to its files, and callers which read an incident in order to
+    write it back must hold the lock (see L{lock_incident}) while doing
+    so.  Each process must find out about the others' writes by watching
+    the store (see L{ims.watcher}).  Rather than each keeping its own
+    cache of parsed incidents, the processes share a cache of incident
+    text of C{cache_size} incidents of up to C{shared_cache_slot_size}
+    bytes (see L{ims.sharedcache}), which each process updates as it
+    writes incidents.
+
+    If C{compress} is true, incident files are written compressed with
+    zlib, preceded by L{compressed_header}.  Files are read whether they
+    are compressed or not.
+
+    Incident files are stamped as they are written with the versions of
+    the schema and validation rules they were written under (see
+    L{ims.data.schema_version}), in a header of the form::
+
+        IMSV<schema version>.<validation version> <checksum>\0
+
+    where C{checksum} is the hexadecimal CRC-32 of the incident's text.
+    Text stamped with the current versions is known to be valid and
+    rendered as this version renders it, so it is parsed without being
+    validated and may be served as it is (see
+    L{read_incident_with_number_stamped_raw}); anything else, including
+    text whose checksum doesn't match, such as a file edited by hand, is
+    validated.  Writes replayed from the journal are not stamped, as they
+    may have been made by an older version.  L{upgrade_incidents} stamps
+    every incident which is valid.
+
+    Each of C{write_observers} is called with the number and JSON text of
+    every incident written, in order, once the write is durable.
+
+    New incidents are numbered for C{site} of C{sites} (see
+    L{ims.allocator}).
+
+    If C{history} is true, every revision of each incident is kept in a
+    history file alongside it, as a delta against the revision after it,
+    with a full copy every C{history_keyframe_interval} revisions (see
+    L{ims.history}).  Revisions are recorded as writes are applied.
+
+    If C{threadpool} is set (see L{ims.asyncstore.AsyncStorage}), writes
+    are applied to incident files in its threads, as is the journal
+    synced, and the store's in-memory state is updated on the reactor
+    once they are.  A caller must then wait for a write to an incident
+    to be durable before writing the incident again.
     """
 
-    def __init__(self, path):
+    implements(IStorage)
+
+    # Marks a compressed incident file; JSON text can't start with it
+    compressed_header = "IMSZ\x00"
+
+    # Starts a stamped incident file, before any compressed header
+    stamp_header = "IMSV"
+
+    # Versions of the schema and validation rules this store writes under
+    version_stamp = "{0}.{1}".format(schema_version, validation_version)
+
+    # Extensions of the files kept for each incident besides its main file
+    incident_file_extensions = ("entries",)
+
+    # Extension of the file holding each incident's revision history
+    history_extension = "history"
+
+    def __init__(
+        self, path, cache_size=1000,
+        journal=False, journal_commit_delay=0.0, reactor=None,
+        number_block_size=10, search_index=False, secondary_indexes=False,
+        layout="flat", entry_log=False, compress=False,
+        warm_up_processes=0, shared=False, journal_name=".journal",
+        shared_cache_slot_size=16384, site=0, sites=1,
+        history=False, history_keyframe_interval=20,
+    ):
+        if layout not in layouts:
+            raise StorageError("Unknown storage layout: {0}".format(layout))
+
+        if reactor is None:
+            from twisted.internet import reactor
+
         self.path = path
+        self.reactor = reactor
+        self.layout_name = layout
+        self.layout = None
+        self.directories = DirectoryCache()
         self.incidents = None
-        self.incident_etags = {}
+        self.entry_log = entry_log
+        self.compress = compress
+        self.warm_up_processes = warm_up_processes
+        self.warm_up_errors = {}
+        self._entry_log_sizes = {}
+        self._own_writes = None
+        self.shared = shared
+        self.write_observers = []
+        self.history = history
+        self.history_keyframe_interval = history_keyframe_interval
+        self.threadpool = None
+        self._replaying = False
+
+        if shared:
+            self.locks = IncidentLocks(path.child(".locks"))
+            self.incident_etags = EtagManifest(
+                path.child(".etags"), compact_slack=None
+            )
+            if cache_size > 0:
+                self.shared_cache = SharedIncidentCache(
+                    path.child(".cache"),
+                    slots=cache_size, slot_size=shared_cache_slot_size,
+                )
+            else:
+                self.shared_cache = None
+            self.incident_cache = IncidentCache(0)
+        else:
+            self.locks = None
+            self.incident_etags = EtagManifest(path.child(".etags"))
+            self.shared_cache = None
+            self.incident_cache = IncidentCache(cache_size)
+        self.archive = IncidentArchive(path.child(".archive"))
+        self.incident_numbers = IncidentNumberAllocator(
+            path.child(".incident_number"), self._first_unused_number,
+            block_size=number_block_size, site=site, sites=sites,
+        )
+        self._provisioned = False
+
+        if search_index:
+            self.search_index = TrigramIndex()
+        else:
+            self.search_index = None
+
+        if secondary_indexes:
+            self.indexes = IncidentIndexes()
+        else:
+            self.indexes = None
+
+        if journal:
+            self.journal = Journal(
+                path.child(journal_name), self._write_files,
+                applied=self._written,
+                flush=self.incident_etags.flush,
+                reactor=reactor,
+                commit_delay=journal_commit_delay,
+            )
+        else:
+            self.journal = None
+
         log.msg("New data store: {0}".format(self))
 
 
@@ -60,7 +321,7 @@ class Storage(object):
 
 
     def provision(self):
-        if hasattr(self, "_max_incident_number"):
+        if self._provisioned:
             return
 
         if not self.path.exists():
@@ -77,22 +338,286 @@ class Storage(object):
                 .format(self.path)
             )
 
-        max = 0
+        self.layout = self._load_layout()
+
+        self.incident_etags.load()
+
+        if self.shared_cache is not None:
+            self.shared_cache.open()
+
+        self.archive.open()
+        if len(self.archive):
+            # Incidents written since they were archived are live.
+            for number in self.layout.numbers():
+                self.archive.discard(number)
+
+        if self.journal is not None:
+            self._replaying = True
+            try:
+                self.journal.open()
+            finally:
+                self._replaying = False
+
+        self._provisioned = True
+
+        if self.warm_up_processes > 0:
+            self._warm_up()
+        else:
+            self._build_indexes()
+
+
+    def _load_layout(self):
+        """
+        Determine the layout of this store from its layout file, which is
+        written when the store is created.  Stores without a layout file
+        predate layouts and are flat.
+        """
+        layout_fp = self.path.child(".layout")
+
+        if layout_fp.exists():
+            name = layout_fp.getContent().strip()
+            if name not in layouts:
+                raise StorageError(
+                    "Unknown layout in {0}: {1}".format(layout_fp.path, name)
+                )
+        elif [n for n in self.path.listdir() if not n.startswith(".")]:
+            name = "flat"
+        else:
+            name = self.layout_name
+            layout_fp.setContent("{0}\n".format(name))
+
+        if name != self.layout_name:
+            log.msg(
+                "Data store {0} has {1} layout, not {2}; "
+                "use storetool migrate-layout to change it."
+                .format(self.path.path, name, self.layout_name)
+            )
+
+        return layouts[name](self.path, self.directories)
+
+
+    def migrate_layout(self, name):
+        """
+        Move all incident files into a different layout.  This must not
+        be done while other processes are using the store.
+
+        @return: the number of incidents moved.
+        """
+        if name not in layouts:
+            raise StorageError("Unknown storage layout: {0}".format(name))
+
+        self.provision()
+
+        if self.journal is not None:
+            # Apply and sync pending writes before moving files around.
+            self.journal.commit(threaded=False)
+            self.journal.checkpoint()
+
+        old = self.layout
+        new = layouts[name](self.path, self.directories)
+
+        if new.name == old.name:
+            return 0
+
+        log.msg(
+            "Migrating {0} from {1} layout to {2}"
+            .format(self, old.name, new.name)
+        )
+
+        def move(number):
+            destination = new.fp(number)
+            parent = destination.parent()
+            if not parent.exists():
+                parent.makedirs()
+
+            try:
+                old.fp(number).moveTo(destination)
+                for ext in self.incident_file_extensions + (self.history_extension,):
+                    source = old.fp(number, ext)
+                    if source.exists():
+                        source.moveTo(new.fp(number, ext))
+            except (IOError, OSError) as e:
+                raise StorageError(
+                    "Unable to move incident {0}: {1}".format(number, e)
+                )
+
+        # Incident numbers 10 through 99 are also the names of top-level
+        # subdirectories in the sharded layout.  Moving incidents in
+        # ascending order moves such an incident's file out of the way
+        # before the directory of the same name is needed; going the
+        # other way, such incidents are moved once the directory has
+        # been emptied and removed.
+        count = 0
+        deferred = []
+        for number in sorted(old.numbers()):
+            if not old.fp(number).isfile():
+                # A subdirectory left by an interrupted migration.
+                continue
+            if new.fp(number).isdir():
+                deferred.append(number)
+                continue
+            move(number)
+            count += 1
+
+        if new.name == "flat":
+            self._remove_empty_shards()
+
+        for number in deferred:
+            move(number)
+            count += 1
+
+        if deferred:
+            self._remove_empty_shards()
+
+        self.path.child(".layout").setContent("{0}\n".format(new.name))
+
+        self.layout = new
+        self.layout_name = new.name
+        self.directories.clear()
+        self.incidents = None
+
+        return count
+
+
+    def _remove_empty_shards(self):
+        for top in self.path.children():
+            if top.basename().startswith(".") or not top.isdir():
+                continue
+            for bottom in top.children():
+                if bottom.isdir() and not bottom.listdir():
+                    bottom.remove()
+            if not top.listdir():
+                top.remove()
+
+
+    def _indexes(self):
+        return [
+            index for index in (self.search_index, self.indexes)
+            if index is not None
+        ]
+
+
+    def _build_indexes(self):
+        indexes = self._indexes()
+        if not indexes:
+            return
+
+        log.msg("Building indexes for {0}".format(self))
+
+        for index in indexes:
+            index.clear()
+
         for number, etag in self.list_incidents():
+            try:
+                incident = self.read_incident_with_number(number)
+                # Report entries are decoded, and validated, when first
+                # used; do so here rather than while indexing.
+                incident.report_entries
+            except Exception as e:
+                log.err(
+                    "Unable to index incident {0}: {1}".format(number, e)
+                )
+                continue
+            self._index_incident(incident, indexes)
+
+
+    def _index_incident(self, incident, indexes):
+        """
+        Add an incident to the given indexes, or, if it can't be indexed,
+        log why and leave it out of all of them.
+        """
+        try:
+            for index in indexes:
+                index.add(incident)
+        except Exception as e:
+            log.err(
+                "Unable to index incident {0}: {1}".format(incident.number, e)
+            )
+            for index in indexes:
+                index.remove(incident.number)
+
+
+    def _warm_up(self):
+        start = time()
+
+        numbers = sorted(self._list_incidents())
+
+        if self.indexes is not None:
+            keep = None
+        elif self.incident_cache.size_limit > 0:
+            # The latest incidents are most likely to be read soon.
+            keep = numbers[-self.incident_cache.size_limit:]
+        else:
+            keep = ()
+
+        log.msg(
+            "Warming up {0} incidents in {1} with {2} processes"
+            .format(len(numbers), self, self.warm_up_processes)
+        )
+
+        indexes = self._indexes()
+        for index in indexes:
+            index.clear()
+
+        self.warm_up_errors = {}
+
+        try:
+            results = list(
+                warm_up(self, numbers, self.warm_up_processes, keep)
+            )
+        except Exception as e:
+            log.err(
+                "Unable to warm up {0} in parallel: {1}".format(self, e)
+            )
+            self._build_indexes()
+            return
+
+        # Put incidents in the cache in ascending order, so that the
+        # latest are evicted last.
+        results.sort()
+
+        for number, etag, incident, strings, error in results:
+            if error is not None:
+                log.err(
+                    "Unable to read incident {0}: {1}".format(number, error)
+                )
+                self.warm_up_errors[number] = error
+                continue
+
+            if self.incident_etags.get(number) != etag:
+                self.incident_etags.record(number, etag)
+
+            if self.search_index is not None:
+                self.search_index.add_strings(number, strings)
+
+            if incident is not None:
+                if self.indexes is not None:
+                    self._index_incident(incident, (self.indexes,))
+                self.incident_cache.put(incident)
+
+        log.msg(
+            "Warmed up {0} incidents in {1} in {2:.2f} seconds ({3} errors)"
+            .format(
+                len(numbers), self, time() - start, len(self.warm_up_errors)
+            )
+        )
+
+
+    def _first_unused_number(self):
+        log.msg("Scanning for highest incident number in {0}".format(self))
+
+        max = 0
+        for number in self._list_incidents():
             if number > max:
                 max = number
-        self._max_incident_number = max
+        return max + 1
 
 
     def _incident_fp(self, number, ext=""):
-        if ext:
-            ext    = ".{0}".format(ext)
-            prefix = "."
-        else:
-            ext    = ""
-            prefix = ""
+        if self.layout is None:
+            self.provision()
 
-        return self.path.child("{0}{1}{2}".format(prefix, number, ext))
+        return self.layout.fp(number, ext)
 
 
     def _open_incident(self, number, mode):
@@ -105,134 +630,1308 @@ class Storage(object):
 
 
     def _list_incidents(self):
-        for child in self.path.children():
-            name = child.basename()
-            if name.startswith("."):
-                continue
-            try:
-                number = int(name)
-            except ValueError:
-                log.err(
-                    "Invalid filename in data store: {0}"
-                    .format(name)
-                )
-                continue
+        if self.layout is None:
+            self.provision()
 
-            yield number
+        if not len(self.archive):
+            return self.layout.numbers()
 
+        numbers = set(self.layout.numbers())
+        numbers.update(self.archive.numbers())
+        return numbers
 
-    def list_incidents(self):
+
+    def list_incident_numbers(self):
+        """
+        @return: the numbers of all incidents.
+        """
         if self.incidents is None:
             incidents = {}
             for number in self._list_incidents():
                 incidents[number] = None
+            if self.journal is not None:
+                for number in self.journal.pending_numbers():
+                    incidents[number] = None
             self.incidents = incidents
-            
-        for number in self.incidents:
+
+        return list(self.incidents)
+
+
+    def list_incidents(self):
+        for number in self.list_incident_numbers():
             yield (number, self.etag_for_incident_with_number(number))
 
 
     def search_incidents(self, terms=(), show_closed=False):
         log.msg("Searching for {0!r}, closed={1}".format(terms, show_closed))
 
-        # Brute force implementation for now.
-        def strings_from_incident(incident):
-            yield incident.summary
-            yield incident.location.name
-            yield incident.location.address
-            for incident_type in incident.incident_types:
-                yield incident_type
-            for ranger in incident.rangers:
-                yield ranger.handle
-            for entry in incident.report_entries:
-                yield entry.text
-
-        for (number, etag) in self.list_incidents():
-            incident = self.read_incident_with_number(number)
+        candidates, check_closed, check_terms = self.plan_search(
+            terms, show_closed
+        )
 
-            if not show_closed and incident.closed:
-                continue
+        for (number, etag) in candidates:
+            if check_closed or check_terms:
+                incident = self.read_incident_with_number(number)
+
+                if check_closed and incident.closed:
+                    continue
+
+                if check_terms and not incident_matches_terms(incident, terms):
+                    continue
+
+            yield (number, etag)
 
-            for term in terms:
-                for string in strings_from_incident(incident):
-                    if string is None:
-                        continue
-                    if term.lower() in string.lower():
-                        break
-                else: # Didn't match term
-                    break
+
+    def plan_search(self, terms=(), show_closed=False):
+        """
+        Narrow down a search as far as possible without reading incidents.
+
+        @return: a tuple of an iterable of candidate incident numbers and
+            etags, whether candidates must be read to check that they
+            aren't closed, and whether they must be read to check that
+            they match C{terms}.
+        """
+        candidates = None
+
+        if terms and self.search_index is not None:
+            candidates = self.search_index.search(terms)
+            check_terms = False
+        else:
+            check_terms = bool(terms)
+
+        if not show_closed and self.indexes is not None:
+            open_incidents = self.indexes.open_incidents()
+            if candidates is None:
+                candidates = open_incidents
             else:
-                yield (number, etag)
+                candidates &= open_incidents
+            check_closed = False
+        else:
+            check_closed = not show_closed
+
+        if candidates is None:
+            incidents = self.list_incidents()
+        else:
+            incidents = (
+                (number, etag) for (number, etag) in self.list_incidents()
+                if number in candidates
+            )
+
+        return (incidents, check_closed, check_terms)
+
+
+    def query_incidents(
+        self, states=None, ranger_handle=None,
+        incident_type=None, location_name=None,
+    ):
+        """
+        Find incidents using the secondary indexes.  See
+        L{ims.search.IncidentIndexes.query}.
+
+        @return: an iterable of incident numbers and etags.
+        """
+        if self.indexes is None:
+            raise StorageError("Secondary indexes are not enabled")
+
+        numbers = self.indexes.query(
+            states=states,
+            ranger_handle=ranger_handle,
+            incident_type=incident_type,
+            location_name=location_name,
+        )
+
+        for number in numbers:
+            yield (number, self.etag_for_incident_with_number(number))
 
 
     def etag_for_incident_with_number(self, number):
-        if number in self.incident_etags:
-            return self.incident_etags[number]
+        number = incident_number(number)
 
-        etag_fp = self._incident_fp(number, "etag")
-        try:
-            etag = etag_fp.getContent()
-        except (IOError, OSError):
-            data = self.read_incident_with_number_raw(number)
-            etag = etag_hash(data).hexdigest()
-            try:
-                etag_fp.setContent(etag)
-            except (IOError, OSError) as e:
-                log.err("Unable to store etag for incident {0}: {1}".format(number, e))
+        etag = self.incident_etags.get(number)
 
-        if etag:
-            self.incident_etags[number] = etag
-            return etag
-        else:
-            raise StorageError("Unable to determine etag for incident {0}".format(number))
+        if etag is None:
+            # Not in the manifest, perhaps because the incident was
+            # written by an older version of this software or by another
+            # process.
+            etag = self.read_etag_for_incident_with_number(number)
+            self.incident_etags.record(number, etag)
+
+        return etag
+
+
+    def read_etag_for_incident_with_number(self, number):
+        """
+        Work out the etag of an incident from its text, without looking it
+        up in or adding it to the manifest.  This may be called from any
+        thread.
+        """
+        number = incident_number(number)
+
+        cached = None
+        if self.shared_cache is not None and not self._pending(number):
+            cached = self.shared_cache.get(number)
+        if cached is not None:
+            return cached[1]
+
+        data = self.read_incident_with_number_raw(number)
+        return etag_hash(data).hexdigest()
+
+
+    def close(self):
+        """
+        Write any pending changes to disk.
+        """
+        if self.journal is not None:
+            self.journal.close()
+
+        self.incident_etags.close()
+        self.archive.close()
+
+        if self.shared_cache is not None:
+            self.shared_cache.close()
+
+        if self.locks is not None:
+            self.locks.close()
+
+
+    def lock_incident(self, number, blocking=True):
+        """
+        Take this process's lock on an incident, if the store is shared,
+        waiting for any other process holding it unless C{blocking} is
+        false.  What this process has cached about the incident is
+        forgotten, as another process may have written it.
+
+        @return: whether the incident was locked.
+        """
+        if self.locks is None:
+            return True
+
+        self.provision()
+
+        if self.locks.held(number):
+            return self.locks.acquire(number)
+
+        if not self.locks.acquire(number, blocking):
+            return False
+
+        self.incident_cache.remove(number)
+        self._entry_log_sizes.pop(number, None)
+
+        return True
+
+
+    def unlock_incident(self, number):
+        """
+        Release a lock taken with L{lock_incident}.
+        """
+        if self.locks is None:
+            return
+
+        self.locks.release(number)
 
 
     def read_incident_with_number_raw(self, number):
-        handle = self._open_incident(number, "r")
+        return self.read_incident_with_number_stamped_raw(number)[0]
+
+
+    def read_incident_with_number_stamped_raw(self, number):
+        """
+        Read the text of an incident, as L{read_incident_with_number_raw}
+        does, and whether it is stamped as written under the current
+        schema and validation rules.  Writes not yet applied are current.
+
+        @return: a C{(json, current)} tuple.
+        """
+        number = incident_number(number)
+
+        if self.journal is not None:
+            json = self.journal.pending_text(number)
+            if json is not None:
+                return json, True
+
+        if self.shared_cache is not None:
+            return self._read_shared(number)
+
+        return self.read_stored_incident_stamped_raw(number)
+
+
+    def _read_shared(self, number):
+        """
+        Read the text of an incident from the shared cache, or from its
+        files, adding it to the shared cache.  Text is cached with its
+        stamp, if it is current.
+
+        @return: a C{(json, current)} tuple.
+        """
+        cached = self.shared_cache.get(number)
+        if cached is not None:
+            return self._unstamp(cached[2])
+
+        # Hold the incident's lock, so that another process can't write
+        # the incident between our reading and caching it.  If another
+        # thread of this process holds it, it is writing the incident
+        # and may be waiting for a thread of our pool to sync the
+        # journal, so read the incident without caching it instead.
+        if not self.locks.acquire(number, wait_for_threads=False):
+            return self.read_stored_incident_stamped_raw(number)
         try:
-            json = handle.read()
+            cached = self.shared_cache.get(number)
+            if cached is not None:
+                return self._unstamp(cached[2])
+
+            generation = self._generation(number)
+            json, current = self.read_stored_incident_stamped_raw(number)
+            if current:
+                cached = self._stamp(json) + json
+            else:
+                cached = json
+            self.shared_cache.put(
+                number, generation, etag_hash(json).hexdigest(), cached
+            )
         finally:
-            handle.close()
-        return json
+            self.locks.release(number)
 
+        return json, current
+
+
+    def _pending(self, number):
+        """
+        @return: whether an incident has writes which are not yet applied.
+        """
+        return (
+            self.journal is not None and
+            self.journal.pending_text(number) is not None
+        )
+
+
+    def _generation(self, number):
+        """
+        @return: a number which identifies the state of an incident's
+            files.
+        """
+        signatures = [
+            file_signature(self._incident_fp(number, ext).path)
+            for ext in ("",) + self.incident_file_extensions
+        ]
+        return struct.unpack("<Q", etag_hash(repr(signatures)).digest()[:8])[0]
+
+
+    def _share_write(self, number, json, etag):
+        """
+        Put an incident into the shared cache once a write of it has been
+        applied, unless it has since been written again.
+        """
+        if self.shared_cache is None:
+            return
+
+        if self.incident_etags.get(number) != etag:
+            return
+
+        if self._pending(number):
+            return
+
+        self.shared_cache.put(
+            number, self._generation(number), etag, self._stamp(json) + json
+        )
+
+
+    def read_stored_incident_raw(self, number):
+        """
+        Read the stored text of an incident, disregarding writes which
+        have not yet been applied.
+        """
+        return self.read_stored_incident_stamped_raw(number)[0]
+
+
+    def read_stored_incident_stamped_raw(self, number):
+        """
+        Read the stored text of an incident, as L{read_stored_incident_raw}
+        does, and whether it is stamped as current.  Archived incidents
+        are not stamped.
+
+        @return: a C{(json, current)} tuple.
+        """
+        json = self.archive.get(number)
+        if json is not None:
+            return json, False
 
-    def read_incident_with_number(self, number):
         handle = self._open_incident(number, "r")
         try:
-            return Incident.from_json_io(handle, number=number)
+            json, current = self._unstamp(handle.read(), number)
         finally:
             handle.close()
 
+        return self._merge_entry_log(number, json), current
 
-    def write_incident(self, incident):
-        incident.validate()
 
-        self.provision()
+    def _stamp(self, text):
+        """
+        @return: the stamp (see L{Storage}) which marks C{text} as written
+            under the current schema and validation rules.
+        """
+        return "{0}{1} {2:08x}\x00".format(
+            self.stamp_header, self.version_stamp, checksum(text)
+        )
 
-        number = incident.number
 
-        incident_fh = self._open_incident(number, "w")
-        try:
-            incident_fh.write(incident.to_json_text())
-        finally:
-            incident_fh.close()
+    def _split_stamp(self, number, data):
+        """
+        Split the contents of an incident file into its stamp, or C{None}
+        if it has none, and the rest.
+        """
+        if not data.startswith(self.stamp_header):
+            return None, data
 
-        if self.incidents is not None:
-            self.incidents[number] = None
+        end = data.find("\x00")
+        if end < 0:
+            raise StorageError("Invalid stamp on incident {0}".format(number))
 
-        etag_fp = self._incident_fp(number, "etag")
-        try:
-            etag_fp.remove()
-        except (IOError, OSError):
-            pass
+        return data[:end + 1], data[end + 1:]
 
-        #self.incidents[number] = incident
 
-        if number > self._max_incident_number:
-            self._max_incident_number = number
+    def _unstamp(self, data, number=None):
+        """
+        Remove the stamp, if any, from the contents of an incident file,
+        or from text cached with its stamp, and decode the rest.
 
+        @param number: the incident's number, if C{data} is the contents
+            of its file.
 
-    def next_incident_number(self):
+        @return: a C{(json, current)} tuple.
+        """
+        stamp, data = self._split_stamp(number, data)
+
+        if number is not None:
+            data = self._decode(number, data)
+
+        return data, stamp is not None and stamp == self._stamp(data)
+
+
+    def _encode(self, text, compress=None, stamp=False):
+        """
+        Encode the text of an incident file for writing.
+
+        @param stamp: whether to stamp the text as current.
+        """
+        if compress is None:
+            compress = self.compress
+
+        if compress:
+            data = self.compressed_header + zlib.compress(text)
+        else:
+            data = text
+
+        if stamp:
+            return self._stamp(text) + data
+        else:
+            return data
+
+
+    def _decode(self, number, data):
+        """
+        Decode the contents of an incident file, after any stamp.
+        """
+        if not data.startswith(self.compressed_header):
+            return data
+
+        try:
+            return zlib.decompress(data[len(self.compressed_header):])
+        except zlib.error as e:
+            raise StorageError(
+                "Unable to decompress incident {0}: {1}".format(number, e)
+            )
+
+
+    def _merge_entry_log(self, number, json):
+        """
+        Add the entries in an incident's entry log, if it has one, to the
+        incident's JSON text.
+        """
+        try:
+            handle = self._incident_fp(number, "entries").open("r")
+        except (IOError, OSError):
+            return json
+
+        try:
+            lines = handle.read().split("\n")
+        finally:
+            handle.close()
+
+        if lines[-1]:
+            log.msg(
+                "Ignoring incomplete entry log record for incident {0}"
+                .format(number)
+            )
+        lines.pop()
+
+        if not lines:
+            return json
+
+        incident = Incident.from_json_text(json, number=number, validate=False)
+        for line in lines:
+            incident.report_entries.append(
+                ReportEntry.from_json(from_json_text(line))
+            )
+        return incident.to_json_text()
+
+
+    def read_incident_with_number(self, number):
+        number = incident_number(number)
+
+        incident = self.incident_cache.get(number)
+        if incident is not None:
+            return incident
+
+        json, current = self.read_incident_with_number_stamped_raw(number)
+        incident = Incident.from_json_text(
+            json, number=number, validate=not current
+        )
+
+        self.incident_cache.put(incident)
+
+        return incident
+
+
+    def write_incident(self, incident):
+        """
+        Write an incident.
+
+        If this store is journaled, the write is visible to readers
+        immediately, but is not durable until the returned L{Deferred}
+        fires.  Otherwise, if it has a thread pool, the write is visible
+        once it is durable.
+
+        @return: a L{Deferred} if this store is journaled or has a thread
+            pool, otherwise C{None}.
+        """
+        incident.validate()
+
+        self.provision()
+
+        number = incident.number
+
+        # Hold the incident's lock until the write is applied.
+        self.lock_incident(number)
+        try:
+            json = incident.to_json_text()
+            etag = etag_hash(json).hexdigest()
+
+            if self.entry_log:
+                record = self._entry_log_record(incident, etag)
+            else:
+                record = json
+
+            self.incident_cache.remove(number)
+            self.archive.discard(number)
+
+            if self.journal is not None:
+                result = self.journal.append(number, record, pending_text=json)
+                self.incident_etags.update(number, etag)
+            elif self.threadpool is not None:
+                result = self._write_in_thread(number, record, json)
+            else:
+                result = None
+                self._apply_write(number, record)
+                self._share_write(number, json, etag)
+        except:
+            self.unlock_incident(number)
+            raise
+
+        if result is None:
+            self.unlock_incident(number)
+        elif self.locks is not None:
+            def unlock(result):
+                if not isinstance(result, Failure):
+                    self._share_write(number, json, etag)
+                self.unlock_incident(number)
+                return result
+            result.addBoth(unlock)
+
+        if result is None:
+            self._notify_write(number, json)
+        elif self.write_observers:
+            def notify(result):
+                self._notify_write(number, json)
+                return result
+            result.addCallback(notify)
+
+        if self.journal is not None or result is None:
+            # Otherwise, the write is being applied in a thread, and the
+            # incident is stored once it has been.
+            self._stored(number, json)
+
+        return result
+
+
+    def _write_in_thread(self, number, record, json):
+        """
+        Apply a write in the thread pool, and then note that it was and
+        store the incident.
+        """
+        d = deferToThreadPool(
+            self.reactor, self.threadpool, self._write_files, number, record
+        )
+
+        def written(_):
+            self._written(number, record, None)
+            self._stored(number, json)
+
+        def failed(f):
+            self._written(number, record, f.value)
+            return f
+
+        d.addCallbacks(written, failed)
+        return d
+
+
+    def _stored(self, number, json):
+        """
+        Add a written incident to what this store keeps in memory.
+        """
+        if self.incidents is not None:
+            self.incidents[number] = None
+
+        # Cache and index the incident as it will be read back, not as
+        # given.
+        stored = Incident.from_json_text(json, number=number, validate=False)
+
+        self.incident_cache.put(stored)
+
+        for index in self._indexes():
+            index.add(stored)
+
+        self.incident_numbers.observe(number)
+
+
+    def _notify_write(self, number, json):
+        for observer in self.write_observers:
+            try:
+                observer(number, json)
+            except Exception:
+                log.err(
+                    None,
+                    "Unable to notify {0!r} of write to incident {1}"
+                    .format(observer, number)
+                )
+
+
+    def _entry_log_record(self, incident, etag):
+        """
+        Describe a write to an incident with an entry log as a record of
+        the form::
+
+            +<offset>\t<etag>\t<header>\t<entry>\t<entry>...
+
+        which appends the given entries to the incident's entry log at
+        C{offset}, and replaces its header if C{header} is not empty.  An
+        offset of C{-} replaces the log instead.  (Tabs and newlines are
+        always escaped in JSON text.)
+
+        An incident is written in full unless it was written with an
+        entry log and only has new entries added to the end.
+        """
+        number = incident.number
+        entries = incident.report_entries
+        header = incident.to_json_text(include_report_entries=False)
+
+        offset = self._entry_log_size(number)
+
+        if offset is None:
+            stored = None
+        else:
+            try:
+                stored = self.read_incident_with_number(number)
+            except NoSuchIncidentError:
+                stored = None
+
+        if (
+            stored is not None and
+            stored.report_entries == entries[:len(stored.report_entries)]
+        ):
+            entries = entries[len(stored.report_entries):]
+            if header == stored.to_json_text(include_report_entries=False):
+                header = ""
+            size = offset
+        else:
+            offset = "-"
+            size = 0
+
+        lines = [entry.to_json_text() for entry in entries]
+
+        self._entry_log_sizes[number] = size + sum(len(l) + 1 for l in lines)
+
+        return "\t".join(["+{0}".format(offset), etag, header] + lines)
+
+
+    def _entry_log_size(self, number):
+        """
+        @return: the size of an incident's entry log, including writes not
+            yet applied, or C{None} if it has no entry log.
+        """
+        size = self._entry_log_sizes.get(number, None)
+
+        if size is None:
+            try:
+                size = os.path.getsize(self._incident_fp(number, "entries").path)
+            except OSError:
+                return None
+            self._entry_log_sizes[number] = size
+        elif size < 0:
+            return None
+
+        return size
+
+
+    def _apply_write(self, number, record):
+        """
+        Apply a write, which is either the incident's JSON text or an
+        entry log record (see L{_entry_log_record}), to the incident's
+        files, and note that it was.
+
+        @return: the L{FilePath}s of the files written.
+        """
+        try:
+            fps = self._write_files(number, record)
+        except Exception as e:
+            self._written(number, record, e)
+            raise
+
+        self._written(number, record, None)
+
+        return fps
+
+
+    def _write_files(self, number, record):
+        """
+        Apply a write to an incident's files, as L{_apply_write} does,
+        except for noting that it was, which L{_written} does.  This may
+        be called from a thread other than the reactor's.
+
+        @return: the L{FilePath}s of the files written.
+        """
+        if self.shared_cache is not None:
+            # Readers which miss in the shared cache wait for the
+            # incident's lock, which the writer holds.
+            self.shared_cache.discard(number)
+
+        history_fp = self._record_history(number, record)
+
+        fps = self._apply_record(number, record)
+
+        if history_fp is None:
+            return fps
+        if not isinstance(fps, list):
+            fps = [fps]
+        return fps + [history_fp]
+
+
+    def _written(self, number, record, error):
+        """
+        Update the etag manifest and archive once a write has been applied
+        to an incident's files by L{_write_files}, or, if it failed to be
+        with the given exception, forget the size of its entry log.
+        """
+        if record.startswith("+"):
+            if error is not None:
+                # The log's size is no longer known, so the next write to
+                # the incident must replace it.
+                self._entry_log_sizes[number] = -1
+                return
+            etag = record.split("\t", 2)[1]
+        else:
+            if error is not None:
+                return
+            # Entries in the incident's text supersede any entry log.
+            self._entry_log_sizes.pop(number, None)
+            etag = etag_hash(record).hexdigest()
+
+        self.incident_etags.record(number, etag)
+        self.archive.discard(number)
+
+
+    def _apply_record(self, number, record):
+        if not record.startswith("+"):
+            return self._write_incident_file(number, record)
+
+        fields = record.split("\t")
+        offset, header = fields[0][1:], fields[2]
+        lines = "".join(line + "\n" for line in fields[3:])
+
+        log_fp = self._incident_fp(number, "entries")
+
+        try:
+            if offset == "-":
+                self._replace_file(number, "entries", lines)
+            else:
+                # Truncate first, so that re-applying a write replayed
+                # from the journal doesn't add the entries twice.
+                offset = int(offset)
+                fd = os.open(log_fp.path, os.O_WRONLY | os.O_CREAT, 0644)
+                try:
+                    os.ftruncate(fd, offset)
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    while lines:
+                        lines = lines[os.write(fd, lines):]
+                finally:
+                    os.close(fd)
+                self._wrote(log_fp)
+
+            if header:
+                self._replace_file(
+                    number, "",
+                    self._encode(header, stamp=not self._replaying),
+                )
+        except (IOError, OSError) as e:
+            raise StorageError(
+                "Unable to write incident {0}: {1}".format(number, e)
+            )
+
+        return [log_fp, self._incident_fp(number)]
+
+
+    def _history(self, number):
+        return IncidentHistory(
+            self._incident_fp(number, self.history_extension),
+            keyframe_interval=self.history_keyframe_interval,
+        )
+
+
+    def _record_history(self, number, record):
+        """
+        Record the revision of an incident which a write leaves, if this
+        store keeps incident history.  This is done before the write is
+        applied, so that if a write replayed from the journal was already
+        recorded, it is recognized.
+
+        @return: the L{FilePath} of the incident's history if it was
+            written, otherwise C{None}.
+        """
+        if not self.history:
+            return None
+
+        try:
+            previous = self.read_stored_incident_raw(number)
+        except NoSuchIncidentError:
+            previous = None
+
+        if record.startswith("+"):
+            current = self._entry_log_result(number, previous, record)
+        else:
+            current = record
+
+        try:
+            mtime = os.path.getmtime(self._incident_fp(number).path)
+        except OSError:
+            previous_written = None
+        else:
+            previous_written = render_date(datetime.utcfromtimestamp(mtime))
+
+        history = self._history(number)
+
+        try:
+            recorded = history.record(
+                previous, current,
+                render_date(datetime.utcfromtimestamp(self.reactor.seconds())),
+                previous_written=previous_written, replaying=self._replaying,
+            )
+        except HistoryError as e:
+            raise StorageError(
+                "Unable to record history of incident {0}: {1}"
+                .format(number, e)
+            )
+
+        if recorded:
+            return history.fp
+        else:
+            return None
+
+
+    def _entry_log_result(self, number, previous, record):
+        """
+        @return: the JSON text of an incident after an entry log record
+            (see L{_entry_log_record}) is applied to it.
+        """
+        fields = record.split("\t")
+        offset, header = fields[0][1:], fields[2]
+
+        if header:
+            incident = Incident.from_json_text(header, number=number, validate=False)
+        else:
+            incident = Incident.from_json_text(previous, number=number, validate=False)
+
+        entries = [
+            ReportEntry.from_json(from_json_text(line)) for line in fields[3:]
+        ]
+
+        if offset != "-" and previous is not None:
+            stored = Incident.from_json_text(previous, number=number, validate=False)
+            entries = stored.report_entries + entries
+
+        incident.report_entries = entries
+
+        return incident.to_json_text()
+
+
+    def incident_history(self, number):
+        """
+        @return: the number, time of writing (or C{None} if it is unknown)
+            and etag of each recorded revision of an incident, oldest
+            first.
+        """
+        number = incident_number(number)
+
+        records = self._history(number).records()
+
+        if not records:
+            # Raise if there is no such incident.
+            self.read_stored_incident_raw(number)
+
+        return [
+            (record["revision"], parse_date(record["written"]), record["etag"])
+            for record in records
+        ]
+
+
+    def read_incident_as_of_raw(self, number, when):
+        """
+        Rebuild the revision of an incident which was current at a given
+        time, from its history.
+
+        @param when: a L{datetime}.
+
+        @return: the JSON text of the revision.
+        """
+        number = incident_number(number)
+
+        if when is None:
+            raise InvalidDataError("No time given")
+
+        history = self._history(number)
+        records = history.records()
+
+        revision = history.revision_as_of(records, render_date(when))
+        if revision is None:
+            raise NoSuchIncidentError(number)
+
+        try:
+            current = self.read_stored_incident_raw(number)
+        except NoSuchIncidentError:
+            current = None
+
+        try:
+            root = history.rebuild(records, current, revision)
+        except HistoryError as e:
+            raise StorageError(
+                "Unable to read history of incident {0}: {1}"
+                .format(number, e)
+            )
+
+        return Incident.from_json(root, number=number, validate=False).to_json_text()
+
+
+    def _write_incident_file(self, number, json):
+        """
+        Replace an incident's file, and remove its entry log.
+        """
+        try:
+            incident_fp = self._replace_file(
+                number, "", self._encode(json, stamp=not self._replaying)
+            )
+
+            # Entries in the incident's text supersede any entry log.
+            log_fp = self._incident_fp(number, "entries")
+            if log_fp.exists():
+                log_fp.remove()
+                self._wrote(log_fp)
+        except (IOError, OSError) as e:
+            raise StorageError(
+                "Unable to write incident {0}: {1}".format(number, e)
+            )
+
+        return incident_fp
+
+
+    def _replace_file(self, number, ext, data):
+        """
+        Replace one of an incident's files.  The new contents are written
+        to a temporary file which is then renamed into place, so that
+        readers never see a partially written file.
+        """
+        incident_fp = self._incident_fp(number, ext)
+        if ext:
+            temp_fp = self._incident_fp(number, ext + ".tmp")
+        else:
+            temp_fp = self._incident_fp(number, "tmp")
+
+        try:
+            try:
+                temp_fh = temp_fp.open("w")
+            except (IOError, OSError):
+                # The incident's directory may not exist yet.
+                parent = temp_fp.parent()
+                if parent.exists():
+                    raise
+                parent.makedirs()
+                temp_fh = temp_fp.open("w")
+            try:
+                temp_fh.write(data)
+            finally:
+                temp_fh.close()
+            temp_fp.moveTo(incident_fp)
+        except (IOError, OSError) as e:
+            raise StorageError(
+                "Unable to write incident {0}: {1}".format(number, e)
+            )
+
+        self._wrote(incident_fp)
+
+        return incident_fp
+
+
+    def archive_incidents(self, closed_only=True):
+        """
+        Pack incidents into the archive and remove their live files.
+        Incidents in the archive which have since been written are
+        dropped from it.  This must not be done while other processes
+        are using the store.
+
+        @param closed_only: if true, archive only closed incidents;
+            otherwise archive all incidents, as after an event.
+
+        @return: the number of incidents moved into the archive.
+        """
+        self.provision()
+
+        if self.journal is not None:
+            # Apply and sync pending writes before moving files around.
+            self.journal.commit(threaded=False)
+            self.journal.checkpoint()
+
+        moved = []
+        for number in sorted(self.layout.numbers()):
+            if closed_only:
+                try:
+                    incident = Incident.from_json_text(
+                        self.read_incident_with_number_raw(number),
+                        number=number, validate=False,
+                    )
+                except Exception as e:
+                    log.err(
+                        "Unable to read incident {0}: {1}".format(number, e)
+                    )
+                    continue
+                if incident.closed is None:
+                    continue
+            moved.append(number)
+
+        if not moved:
+            return 0
+
+        log.msg("Archiving {0} incidents in {1}".format(len(moved), self))
+
+        numbers = set(self.archive.numbers())
+        numbers.update(moved)
+
+        self.archive.replace(
+            (number, self.read_incident_with_number_raw(number))
+            for number in sorted(numbers)
+        )
+
+        for number in moved:
+            self.layout.fp(number).remove()
+            self._wrote(self.layout.fp(number))
+            for ext in self.incident_file_extensions:
+                fp = self.layout.fp(number, ext)
+                if fp.exists():
+                    fp.remove()
+                    self._wrote(fp)
+            self._entry_log_sizes.pop(number, None)
+
+        return len(moved)
+
+
+    def track_writes(self):
+        """
+        Start keeping track of the state in which this store leaves the
+        files it writes, so that L{file_changed} can tell them apart from
+        changes made by others.
+        """
+        if self._own_writes is None:
+            self._own_writes = {}
+
+
+    def _wrote(self, fp):
+        if self._own_writes is not None:
+            self._own_writes[fp.path] = file_signature(fp.path)
+
+
+    def file_changed(self, fp):
+        """
+        Note that a file in the store has changed.  If it is one of an
+        incident's files and the change was not made by this store,
+        everything known about the incident is forgotten or re-read.
+
+        @return: the number of the incident, or C{None} if the change was
+            disregarded.
+        """
+        number = self._number_for_file(fp.basename())
+        if number is None:
+            return None
+
+        if self._own_writes is not None and fp.path in self._own_writes:
+            if self._own_writes[fp.path] == file_signature(fp.path):
+                return None
+
+        log.msg("Incident {0} was changed by another process".format(number))
+
+        self.invalidate_incident(number)
+
+        return number
+
+
+    def _number_for_file(self, name):
+        if name.startswith("."):
+            parts = name.split(".")
+            if len(parts) != 3 or parts[2] not in self.incident_file_extensions:
+                return None
+            name = parts[1]
+
+        if not name.isdigit():
+            return None
+
+        return int(name)
+
+
+    def invalidate_incident(self, number):
+        """
+        Forget everything cached about an incident and re-read it, as
+        after it has been changed by another process.
+
+        The incident is kept in the shared cache if it was put there after
+        the change, by the process which made it.
+        """
+        if self.shared_cache is not None and self.layout is not None:
+            self.shared_cache.discard(
+                number, keep_generation=self._generation(number)
+            )
+
+        self.incident_cache.remove(number)
+        self.incident_etags.discard(number)
+        self._entry_log_sizes.pop(number, None)
+
+        if self.layout is None:
+            return
+
+        self.directories.discard(self.layout.directory(number).path)
+
+        exists = self._incident_fp(number).exists()
+        if exists:
+            self.archive.discard(number)
+            self.incident_numbers.observe(number)
+        elif number not in self.archive:
+            if self.journal is None or self.journal.pending_text(number) is None:
+                if self.incidents is not None:
+                    self.incidents.pop(number, None)
+                for index in self._indexes():
+                    index.remove(number)
+                return
+
+        if self.incidents is not None:
+            self.incidents[number] = None
+
+        try:
+            self.etag_for_incident_with_number(number)
+            incident = self.read_incident_with_number(number)
+            incident.report_entries
+        except Exception as e:
+            log.err("Unable to read incident {0}: {1}".format(number, e))
+            self.incident_cache.remove(number)
+            self.incident_etags.discard(number)
+            for index in self._indexes():
+                index.remove(number)
+            return
+
+        self._index_incident(incident, self._indexes())
+
+
+    def recompress_incidents(self, compress=None):
+        """
+        Rewrite incident files which are not compressed (or, if
+        C{compress} is false, which are compressed) so that they are.
+        If C{compress} is C{None}, files are rewritten as this store
+        writes them.  This must not be done while other processes are
+        using the store.
+
+        @return: the number of incident files rewritten.
+        """
+        if compress is None:
+            compress = self.compress
+
+        self.provision()
+
+        if self.journal is not None:
+            # Apply and sync pending writes before rewriting files.
+            self.journal.commit(threaded=False)
+            self.journal.checkpoint()
+
+        log.msg(
+            "{0} incident files in {1}"
+            .format("Compressing" if compress else "Decompressing", self)
+        )
+
+        rewritten = []
+        for number in sorted(self.layout.numbers()):
+            incident_fp = self.layout.fp(number)
+            try:
+                data = incident_fp.getContent()
+            except (IOError, OSError) as e:
+                log.err(
+                    "Unable to read incident {0}: {1}".format(number, e)
+                )
+                continue
+
+            stamp, rest = self._split_stamp(number, data)
+            if rest.startswith(self.compressed_header) == bool(compress):
+                continue
+
+            json, current = self._unstamp(data, number)
+            self._replace_file(
+                number, "", self._encode(json, compress, stamp=current)
+            )
+            rewritten.append(incident_fp)
+
+        directories = set()
+        for fp in rewritten:
+            sync_path(fp.path)
+            directories.add(fp.dirname())
+        for directory in directories:
+            sync_path(directory)
+
+        return len(rewritten)
+
+
+    def upgraded_incident_raw(self, number):
+        """
+        Read the stored text of an incident and, unless it is stamped as
+        current, validate it and render it again.
+
+        @return: the text to write for the incident, or C{None} if it is
+            current.
+
+        @raise ims.data.InvalidDataError: if the incident is not valid.
+        """
+        json, current = self.read_stored_incident_stamped_raw(number)
+        if current:
+            return None
+
+        incident = Incident.from_json_text(json, number=number)
+        return incident.validate().to_json_text()
+
+
+    def upgrade_incidents(self, processes=0):
+        """
+        Stamp every incident file which isn't stamped as written under the
+        current schema and validation rules, after validating the incident
+        and rendering it again, so that it can be read without being
+        validated.  Incidents which are not valid are logged and left as
+        they are.  This must not be done while other processes are using
+        the store.
+
+        @param processes: the number of processes in which to read,
+            validate and render incidents, or C{0} to do so in this one.
+
+        @return: the number of incidents upgraded, and a dictionary of
+            descriptions of the problems with those which couldn't be, by
+            number.
+        """
         self.provision()
-        self._max_incident_number += 1
-        return self._max_incident_number
+
+        if self.journal is not None:
+            # Apply and sync pending writes before rewriting files.
+            self.journal.commit(threaded=False)
+            self.journal.checkpoint()
+
+        numbers = sorted(self.layout.numbers())
+
+        log.msg(
+            "Upgrading {0} incidents in {1} to version {2}"
+            .format(len(numbers), self, self.version_stamp)
+        )
+
+        if processes > 0:
+            results = upgrade(self, numbers, processes)
+        else:
+            def upgrade_here(number):
+                try:
+                    return (number, self.upgraded_incident_raw(number), None)
+                except Exception as e:
+                    return (number, None, "{0}".format(e))
+
+            results = (upgrade_here(number) for number in numbers)
+
+        errors = {}
+        rewritten = []
+        for number, json, error in results:
+            if error is not None:
+                log.err(
+                    "Unable to upgrade incident {0}: {1}".format(number, error)
+                )
+                errors[number] = error
+                continue
+
+            if json is None:
+                continue
+
+            rewritten.append(self._write_incident_file(number, json))
+            self._written(number, json, None)
+            self.incident_cache.remove(number)
+
+        directories = set()
+        for fp in rewritten:
+            sync_path(fp.path)
+            directories.add(fp.dirname())
+        for directory in directories:
+            sync_path(directory)
+        self.incident_etags.sync()
+
+        return len(rewritten), errors
+
+
+    def import_incidents(self, storage):
+        """
+        Copy all incidents from another store into this one, replacing
+        any incidents with the same numbers.
+        """
+        for number, etag in storage.list_incidents():
+            self.write_incident(storage.read_incident_with_number(number))
+
+
+    def next_incident_number(self):
+        self.provision()
+        return self.incident_numbers.allocate()
+
+
+
+def file_signature(path):
+    """
+    @return: a value which changes whenever the file at the given path is
+        replaced or modified, or C{None} if there is no such file.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def incident_number(number):
+    """
+    Convert an incident number, which may have come from a URL, to an
+    C{int}.
+    """
+    try:
+        return int(number)
+    except (TypeError, ValueError):
+        raise NoSuchIncidentError(number)
+
@@ -0,0 +1,269 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Data store maintenance tool
+"""
+
+__all__ = [
+    "main",
+]
+
+if __name__ == "__main__":
+    import sys
+    import os
+    sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+import sys
+from time import time
+from multiprocessing import cpu_count
+
+from twisted.python import usage
+from twisted.python.filepath import FilePath
+
+from ims.config import Configuration
+from ims.store import Storage
+from ims.layout import layouts
+
+
+
+class ImportFilesOptions(usage.Options):
+    """
+    Options for the C{import-files} command.
+    """
+    synopsis = "<directory>"
+
+    def parseArgs(self, directory):
+        self["directory"] = FilePath(directory)
+
+
+
+class MigrateLayoutOptions(usage.Options):
+    """
+    Options for the C{migrate-layout} command.
+    """
+    synopsis = "<layout>"
+
+    def parseArgs(self, layout):
+        if layout not in layouts:
+            raise usage.UsageError(
+                "Layout must be one of: {0}".format(", ".join(sorted(layouts)))
+            )
+        self["layout"] = layout
+
+
+
+class ArchiveOptions(usage.Options):
+    """
+    Options for the C{archive} command.
+    """
+    optFlags = [
+        ["all", "a", "Archive all incidents, not only closed ones."],
+    ]
+
+
+
+class RecompressOptions(usage.Options):
+    """
+    Options for the C{recompress} command.
+    """
+    optFlags = [
+        ["decompress", "d", "Decompress incident files."],
+        ["compress", "c", "Compress incident files."],
+    ]
+
+    def postOptions(self):
+        if self["compress"] and self["decompress"]:
+            raise usage.UsageError(
+                "Specify at most one of --compress and --decompress."
+            )
+
+
+
+class UpgradeOptions(usage.Options):
+    """
+    Options for the C{upgrade} command.
+    """
+    optParameters = [
+        [
+            "processes", "p", None,
+            "Number of processes with which to read incidents "
+            "(0 to read them here).", int
+        ],
+    ]
+
+    def postOptions(self):
+        if self["processes"] is None:
+            self["processes"] = cpu_count()
+        elif self["processes"] < 0:
+            raise usage.UsageError("Number of processes may not be negative.")
+
+
+
+class Options(usage.Options):
+    """
+    Command line options.
+    """
+    synopsis = "Usage: storetool [options] <command> [command options]"
+
+    optParameters = [
+        ["config", "f", None, "Configuration file."],
+    ]
+
+    subCommands = [
+        [
+            "import-files", None, ImportFilesOptions,
+            "Import incidents from a directory of incident files."
+        ],
+        [
+            "migrate-layout", None, MigrateLayoutOptions,
+            "Move the incident files in the data store into another layout."
+        ],
+        [
+            "archive", None, ArchiveOptions,
+            "Pack closed incidents into the data store's archive."
+        ],
+        [
+            "recompress", None, RecompressOptions,
+            "Rewrite incident files compressed or not, as configured."
+        ],
+        [
+            "upgrade", None, UpgradeOptions,
+            "Validate incident files and stamp them with the current version."
+        ],
+    ]
+
+
+    def postOptions(self):
+        if self.subCommand is None:
+            raise usage.UsageError("No command specified.")
+
+        if self["config"] is None:
+            self["config"] = (
+                FilePath(__file__).parent().parent()
+                .child("conf").child("imsd.conf")
+            )
+        else:
+            self["config"] = FilePath(self["config"])
+
+
+
+def import_files(config, options):
+    source = Storage(options["directory"], cache_size=0)
+    source.provision()
+
+    config.storage.import_incidents(source)
+
+    print "Imported incidents from {0} into {1}".format(source, config.storage)
+
+
+def migrate_layout(config, options):
+    storage = config.storage
+
+    if not isinstance(storage, Storage):
+        print >> sys.stderr, "Data store does not have a layout: {0}".format(storage)
+        sys.exit(1)
+
+    count = storage.migrate_layout(options["layout"])
+
+    print "Moved {0} incidents in {1} to {2} layout".format(
+        count, storage, options["layout"]
+    )
+
+
+def archive(config, options):
+    storage = config.storage
+
+    if not isinstance(storage, Storage):
+        print >> sys.stderr, "Data store does not have an archive: {0}".format(storage)
+        sys.exit(1)
+
+    count = storage.archive_incidents(closed_only=not options["all"])
+
+    print "Archived {0} incidents in {1} ({2} in archive)".format(
+        count, storage, len(storage.archive)
+    )
+
+
+def recompress(config, options):
+    storage = config.storage
+
+    if not isinstance(storage, Storage):
+        print >> sys.stderr, "Data store does not store files: {0}".format(storage)
+        sys.exit(1)
+
+    if options["compress"]:
+        compress = True
+    elif options["decompress"]:
+        compress = False
+    else:
+        compress = storage.compress
+
+    count = storage.recompress_incidents(compress)
+
+    print "{0} {1} incident files in {2}".format(
+        "Compressed" if compress else "Decompressed", count, storage
+    )
+
+
+def upgrade(config, options):
+    storage = config.storage
+
+    if not isinstance(storage, Storage):
+        print >> sys.stderr, "Data store does not stamp incidents: {0}".format(storage)
+        sys.exit(1)
+
+    count, errors = storage.upgrade_incidents(options["processes"])
+
+    print "Upgraded {0} incidents in {1} to version {2} ({3} invalid)".format(
+        count, storage, storage.version_stamp, len(errors)
+    )
+
+
+commands = {
+    "import-files": import_files,
+    "migrate-layout": migrate_layout,
+    "archive": archive,
+    "recompress": recompress,
+    "upgrade": upgrade,
+}
+
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        print >> sys.stderr, "{0}\n\n{1}".format(options, e)
+        sys.exit(64)
+
+    config = Configuration(options["config"])
+
+    start = time()
+    try:
+        commands[options.subCommand](config, options.subOptions)
+    finally:
+        config.storage.close()
+    print "Done in {0:.2f} seconds.".format(time() - start)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Synchronization of incidents between sites
+"""
+
+__all__ = [
+    "SyncError",
+    "SyncEngine",
+    "SyncClient",
+    "merge_incidents",
+]
+
+import zlib
+import urllib2
+from datetime import datetime
+from hashlib import sha1 as etag_hash
+
+from twisted.python import log
+from twisted.internet.defer import succeed, gatherResults
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from ims.data import Incident, to_json_text, from_json_text
+from ims.manifest import EtagManifest
+from ims.store import NoSuchIncidentError
+
+
+
+class SyncError(RuntimeError):
+    """
+    Synchronization error.
+    """
+
+
+
+def merge_incidents(ours, theirs, our_site, their_site):
+    """
+    Merge two copies of an incident, as written at two sites.
+
+    Report entries are only ever added, so the merged incident has every
+    entry in either copy, those in both being recognized by their author,
+    creation time and text, and sorted by those.
+
+    Every other field (priority, summary, location, Rangers, incident
+    types and the state timestamps) is taken from the copy which was
+    edited last: the copy with the newest report entry not in the other
+    copy, as every edit made through the server adds an entry.  If
+    neither copy has such entries, or theirs were created at the same
+    time, the copy from the site with the higher number wins.  Both
+    sites thus resolve a conflict the same way.
+
+    @return: the merged incident.
+    """
+    def key(entry):
+        return (entry.author, entry.created, entry.text)
+
+    def sort_key(entry):
+        return (
+            entry.created or datetime.min, entry.author or u"", entry.text or u""
+        )
+
+    our_entries = ours.report_entries or []
+    their_entries = theirs.report_entries or []
+
+    our_keys = set(key(entry) for entry in our_entries)
+    their_keys = set(key(entry) for entry in their_entries)
+
+    def edited(entries, other_keys):
+        times = [
+            entry.created or datetime.min
+            for entry in entries if key(entry) not in other_keys
+        ]
+        return max(times or [datetime.min])
+
+    if (
+        (edited(their_entries, our_keys), their_site) >
+        (edited(our_entries, their_keys), our_site)
+    ):
+        merged = theirs.copy()
+    else:
+        merged = ours.copy()
+
+    entries = [entry.copy() for entry in our_entries]
+    entries.extend(
+        entry.copy() for entry in their_entries if key(entry) not in our_keys
+    )
+    entries.sort(key=sort_key)
+
+    merged.report_entries = entries
+
+    return merged
+
+
+
+class _Unchanged(Exception):
+    """
+    Raised to abandon the write of a merged incident which is unchanged.
+    """
+
+
+
+class SyncEngine(object):
+    """
+    Exchanges incidents between the stores at different sites, each of
+    which may be written to while cut off from the others.
+
+    Each write to the store is given a version, C{(site, counter)}, where
+    C{counter} counts the writes made at C{site}; the versions are kept
+    in a manifest (C{.versions}).  A store's sync vector maps each site
+    to the highest counter of that site's writes it has seen.  To bring
+    another store up to date, we send it the incidents with versions
+    newer than its vector, so that the transfer grows with the number of
+    changes since the last sync rather than with the store.
+
+    Incoming incidents are merged with ours (see L{merge_incidents}).  If
+    the merged incident is the incoming one, we adopt its version, so
+    that it isn't sent back; if it differs from both, it is written as a
+    change made at this site, to be sent back to the other.
+
+    C{storage} is an L{ims.asyncstore.AsyncStorage}.
+    """
+
+    def __init__(self, storage, site):
+        self.storage = storage
+        self.site = site
+
+        path = storage.storage.path
+        self.versions = EtagManifest(path.child(".versions"))
+        self.vector_fp = path.child(".sync_vector")
+        self.vector = {}
+
+        self._adopting = {}
+        self._started = False
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.storage}, site={self.site})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Load the versions of incidents, giving a version to any incident
+        without one, and start versioning writes.
+        """
+        if self._started:
+            return
+
+        storage = self.storage.storage
+        storage.provision()
+
+        self.versions.load()
+
+        if self.vector_fp.exists():
+            try:
+                vector = from_json_text(self.vector_fp.getContent())
+                self.vector = dict(
+                    (int(site), int(counter))
+                    for site, counter in vector.iteritems()
+                )
+            except (IOError, ValueError, AttributeError) as e:
+                log.err(
+                    "Unable to read sync vector {0}: {1}"
+                    .format(self.vector_fp.path, e)
+                )
+
+        for number, etag in list(storage.list_incidents()):
+            version = self.version(number)
+            if version is None:
+                self._record(number, self._next_version())
+            else:
+                self._saw(version)
+
+        storage.write_observers.append(self._wrote)
+        self._started = True
+
+
+    def close(self):
+        """
+        Stop versioning writes.
+        """
+        if not self._started:
+            return
+
+        self.storage.storage.write_observers.remove(self._wrote)
+        self.versions.close()
+        self._save_vector()
+        self._started = False
+
+
+    def version(self, number):
+        """
+        @return: the version of an incident, or C{None} if it has none.
+        """
+        version = self.versions.get(number)
+        if version is None:
+            return None
+
+        site, counter = version.split(":")
+        return (int(site), int(counter))
+
+
+    def _next_version(self):
+        return (self.site, self.vector.get(self.site, 0) + 1)
+
+
+    def _saw(self, version):
+        site, counter = version
+        if counter > self.vector.get(site, 0):
+            self.vector[site] = counter
+
+
+    def _record(self, number, version):
+        self.versions.record(number, "{0}:{1}".format(*version))
+        self._saw(version)
+
+
+    def _wrote(self, number, json):
+        adopting = self._adopting.get(number, None)
+        if adopting is not None and adopting[0] == etag_hash(json).hexdigest():
+            del self._adopting[number]
+            self._record(number, adopting[1])
+        else:
+            self._record(number, self._next_version())
+
+
+    def _save_vector(self):
+        temp_fp = self.vector_fp.siblingExtension(".tmp")
+        try:
+            temp_fp.setContent(to_json_text(
+                dict((str(site), counter) for site, counter in self.vector.iteritems())
+            ))
+            temp_fp.moveTo(self.vector_fp)
+        except (IOError, OSError) as e:
+            log.err(
+                "Unable to write sync vector {0}: {1}"
+                .format(self.vector_fp.path, e)
+            )
+
+
+    def state(self):
+        """
+        @return: a JSON object holding this site's number and sync vector.
+        """
+        return {
+            "site": self.site,
+            "vector": dict(
+                (str(site), counter) for site, counter in self.vector.iteritems()
+            ),
+        }
+
+
+    def bundle(self, vector):
+        """
+        Bundle up the incidents changed since a sync vector, for another
+        site.
+
+        @param vector: the other site's sync vector, with sites as
+            strings, as in JSON.
+
+        @return: a JSON object holding this site's number and sync vector
+            and the changed incidents with their versions.
+        """
+        vector = dict((int(site), counter) for site, counter in vector.iteritems())
+
+        incidents = []
+        for number in sorted(self.versions.numbers()):
+            site, counter = self.version(number)
+            if counter <= vector.get(site, 0):
+                continue
+
+            try:
+                json = self.storage.storage.read_incident_with_number_raw(number)
+            except NoSuchIncidentError:
+                continue
+
+            incidents.append({
+                "number": number,
+                "version": [site, counter],
+                "incident": from_json_text(json),
+            })
+
+        bundle = self.state()
+        bundle["incidents"] = incidents
+        return bundle
+
+
+    def merge_bundle(self, bundle):
+        """
+        Merge the incidents in a bundle from another site into our store.
+
+        @return: a L{Deferred} firing with the number of incidents written.
+        """
+        try:
+            their_site = int(bundle["site"])
+            their_vector = bundle["vector"]
+            items = [
+                (
+                    int(item["number"]),
+                    tuple(int(part) for part in item["version"]),
+                    Incident.from_json(item["incident"], int(item["number"])),
+                )
+                for item in bundle["incidents"]
+            ]
+        except (KeyError, TypeError, ValueError) as e:
+            raise SyncError("Invalid sync bundle: {0}".format(e))
+
+        if their_site == self.site:
+            raise SyncError("Sync bundle is from this site ({0})".format(self.site))
+
+        d = gatherResults(
+            [
+                self._merge(number, version, theirs, their_site)
+                for number, version, theirs in items
+            ],
+            consumeErrors=True,
+        )
+
+        def merged(results):
+            # We now have every change the other site had seen.
+            for site, counter in their_vector.iteritems():
+                self._saw((int(site), int(counter)))
+            self._save_vector()
+
+            written = sum(results)
+            log.msg(
+                "Merged {0} incidents from site {1}, writing {2}"
+                .format(len(items), their_site, written)
+            )
+            return written
+
+        d.addCallback(merged)
+        return d
+
+
+    def _merge(self, number, version, theirs, their_site):
+        ours = self.version(number)
+        if ours is not None and ours == version:
+            return succeed(0)
+
+        def edit(incident):
+            merged = merge_incidents(incident, theirs, self.site, their_site)
+
+            if merged == incident:
+                raise _Unchanged()
+
+            for name in (
+                "priority", "summary", "location", "rangers",
+                "incident_types", "report_entries",
+                "created", "dispatched", "on_scene", "closed",
+            ):
+                setattr(incident, name, getattr(merged, name))
+
+            if merged == theirs:
+                self._adopt(number, incident, version)
+
+        d = self.storage.edit_incident(number, edit)
+
+        def failed(f):
+            if f.check(_Unchanged):
+                # We have what they have, but haven't seen their version.
+                self._saw(version)
+                return 0
+
+            f.trap(NoSuchIncidentError)
+
+            self._adopt(number, theirs, version)
+            d = self.storage.write_incident(theirs)
+            d.addCallback(lambda _: 1)
+            return d
+
+        d.addCallbacks(lambda _: 1, failed)
+        return d
+
+
+    def _adopt(self, number, incident, version):
+        self._adopting[number] = (
+            etag_hash(incident.to_json_text()).hexdigest(), version
+        )
+
+
+
+class SyncClient(object):
+    """
+    Synchronizes a store with the store of the server at C{url} every
+    C{interval} seconds, through its C{sync} resource, authenticating
+    as C{user}.
+
+    Each sync first fetches the server's sync vector, then sends the
+    incidents changed since then and receives the server's changes in
+    return.  Requests and responses are compressed.  If the server can't
+    be reached, the next sync tries again.
+    """
+
+    def __init__(self, engine, url, user, password, interval=60, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        if not url.endswith("/"):
+            url += "/"
+
+        self.engine = engine
+        self.url = url + "sync"
+        self.user = user
+        self.password = password
+        self.interval = interval
+        self.reactor = reactor
+
+        self.last_sync = None
+        self.last_error = None
+
+        self._loop = None
+        self._syncing = None
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.engine}, {self.url!r})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Start synchronizing periodically.
+        """
+        if self._loop is not None:
+            return
+
+        log.msg("Starting {0}".format(self))
+
+        self._loop = LoopingCall(self._sync_logged)
+        self._loop.clock = self.reactor
+        self._loop.start(self.interval, now=True)
+
+
+    def stop(self):
+        """
+        Stop synchronizing.
+        """
+        if self._loop is None:
+            return
+
+        self._loop.stop()
+        self._loop = None
+
+
+    def status(self):
+        """
+        @return: a dictionary describing the client, for clients.
+        """
+        return {
+            "url": self.url,
+            "last_sync": self.last_sync,
+            "last_error": self.last_error,
+        }
+
+
+    def _sync_logged(self):
+        if self._syncing is not None:
+            return
+
+        def done(result):
+            self._syncing = None
+            self.last_sync = self.reactor.seconds()
+            self.last_error = None
+
+        def failed(f):
+            self._syncing = None
+            self.last_error = f.getErrorMessage()
+            log.msg("Unable to sync with {0}: {1}".format(self.url, self.last_error))
+
+        self._syncing = self.sync()
+        self._syncing.addCallbacks(done, failed)
+
+
+    def sync(self):
+        """
+        Synchronize once.
+
+        @return: a L{Deferred} firing with the number of incidents
+            written to our store.
+        """
+        d = deferToThread(self._request, None)
+
+        def got_vector(response):
+            bundle = self.engine.bundle(response["vector"])
+            return deferToThread(self._request, bundle)
+
+        d.addCallback(got_vector)
+        d.addCallback(self.engine.merge_bundle)
+        return d
+
+
+    def _request(self, body):
+        """
+        Make a request of the server, in a thread.
+        """
+        passwords = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(None, self.url, self.user, self.password)
+        opener = urllib2.build_opener(urllib2.HTTPDigestAuthHandler(passwords))
+
+        request = urllib2.Request(self.url)
+        request.add_header("Accept-Encoding", "deflate")
+        if body is not None:
+            request.add_header("Content-Type", "application/json")
+            request.add_header("Content-Encoding", "deflate")
+            request.add_data(zlib.compress(to_json_text(body)))
+
+        try:
+            response = opener.open(request)
+            try:
+                data = response.read()
+                if response.info().get("Content-Encoding", None) == "deflate":
+                    data = zlib.decompress(data)
+            finally:
+                response.close()
+        except (urllib2.URLError, IOError, zlib.error) as e:
+            raise SyncError("Unable to sync with {0}: {1}".format(self.url, e))
+
+        return from_json_text(data)
@@ -0,0 +1,178 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.allocator}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.allocator import IncidentNumberAllocator
+from ims.store import Storage
+from ims.test.test_data import incident2_text
+
+
+
+class IncidentNumberAllocatorTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.allocator.IncidentNumberAllocator}
+    """
+
+    def setUp(self):
+        self.fp = FilePath(self.mktemp())
+        self.initialized = 0
+
+
+    def initial(self):
+        self.initialized += 1
+        return 1
+
+
+    def allocator(self, block_size=10):
+        return IncidentNumberAllocator(self.fp, self.initial, block_size)
+
+
+    def test_allocate(self):
+        """
+        Numbers are allocated in sequence, starting with the initial
+        value.
+        """
+        allocator = self.allocator()
+
+        self.assertEquals([allocator.allocate() for i in range(12)], range(1, 13))
+        self.assertEquals(self.initialized, 1)
+
+
+    def test_reserve_block(self):
+        """
+        The counter file is advanced a block at a time.
+        """
+        allocator = self.allocator(block_size=5)
+        allocator.allocate()
+
+        self.assertEquals(self.fp.getContent(), "6\n")
+
+
+    def test_persistent(self):
+        """
+        A new allocator continues after the block reserved by a prior
+        one.
+        """
+        self.allocator(block_size=5).allocate()
+
+        self.assertEquals(self.allocator(block_size=5).allocate(), 6)
+        self.assertEquals(self.initialized, 1)
+
+
+    def test_shared(self):
+        """
+        Allocators sharing a counter file never allocate the same
+        number.
+        """
+        allocators = [self.allocator(block_size=3) for i in range(3)]
+
+        numbers = [
+            allocator.allocate()
+            for i in range(7)
+            for allocator in allocators
+        ]
+
+        self.assertEquals(len(set(numbers)), len(numbers))
+
+
+    def test_observe(self):
+        """
+        Observed numbers are not allocated.
+        """
+        allocator = self.allocator(block_size=5)
+        allocator.observe(3)
+        self.assertEquals(allocator.allocate(), 4)
+
+        allocator.observe(20)
+        other = self.allocator(block_size=5)
+        self.assertEquals(other.allocate(), 21)
+
+
+    def test_observe_counted(self):
+        """
+        Observing numbers below what the counter file is known to hold
+        doesn't touch the file.
+        """
+        allocator = self.allocator(block_size=5)
+        allocator.observe(20)
+
+        updates = []
+        update = allocator._update
+        allocator._update = lambda f: updates.append(f) or update(f)
+
+        allocator.observe(20)
+        allocator.observe(7)
+        self.assertEquals(updates, [])
+
+        allocator.observe(21)
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(self.allocator().allocate(), 22)
+
+
+    def test_sites(self):
+        """
+        Each site allocates only numbers in its own residue class.
+        """
+        allocators = [
+            IncidentNumberAllocator(
+                FilePath(self.mktemp()), self.initial, 4, site, 3
+            )
+            for site in range(3)
+        ]
+
+        for site, allocator in enumerate(allocators):
+            numbers = [allocator.allocate() for i in range(5)]
+            self.assertEquals(
+                numbers, [n for n in range(1, 17) if n % 3 == site][:5]
+            )
+
+
+    def test_invalid_counter(self):
+        """
+        An unreadable counter file is reinitialized.
+        """
+        self.fp.setContent("garbage")
+
+        self.assertEquals(self.allocator().allocate(), 1)
+
+
+
+class StorageAllocationTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for incident number allocation by L{ims.store.Storage}.
+    """
+
+    def test_no_scan(self):
+        """
+        Once the counter file exists, a new store does not scan its
+        directory for incident numbers.
+        """
+        path = FilePath(self.mktemp())
+        storage = Storage(path)
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+        self.assertEquals(storage.next_incident_number(), 3)
+
+        storage = Storage(path)
+        storage._list_incidents = lambda: self.fail("Scanned directory")
+
+        self.assertEquals(storage.next_incident_number(), 13)
@@ -0,0 +1,173 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.archive}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.archive import IncidentArchive, ArchiveError
+from ims.store import Storage
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+class IncidentArchiveTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.archive.IncidentArchive}
+    """
+
+    def test_replace_get(self):
+        """
+        L{IncidentArchive.get} returns the text of incidents written with
+        L{IncidentArchive.replace}, including after reopening.
+        """
+        fp = FilePath(self.mktemp())
+        archive = IncidentArchive(fp)
+        archive.open()
+
+        self.assertEquals(len(archive), 0)
+        self.assertEquals(archive.replace([(1, "one"), (3, "three")]), 2)
+        self.assertEquals(archive.get(3), "three")
+
+        archive.close()
+        archive = IncidentArchive(fp)
+        archive.open()
+
+        self.assertEquals(sorted(archive.numbers()), [1, 3])
+        self.assertEquals(archive.get(1), "one")
+        self.assertEquals(archive.get(2), None)
+
+
+    def test_replace_from_self(self):
+        """
+        L{IncidentArchive.replace} can copy incidents from the archive
+        being replaced.
+        """
+        archive = IncidentArchive(FilePath(self.mktemp()))
+        archive.replace([(1, "one"), (2, "two")])
+        archive.replace(
+            [(n, archive.get(n)) for n in (1, 2)] + [(3, "three")]
+        )
+
+        self.assertEquals(
+            [archive.get(n) for n in (1, 2, 3)], ["one", "two", "three"]
+        )
+
+
+    def test_discard(self):
+        """
+        Discarded incidents are no longer served.
+        """
+        archive = IncidentArchive(FilePath(self.mktemp()))
+        archive.replace([(1, "one")])
+        archive.discard(1)
+
+        self.assertNotIn(1, archive)
+        self.assertEquals(archive.get(1), None)
+
+
+    def test_invalid(self):
+        """
+        Opening a file which is not an archive raises L{ArchiveError}.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent("Not an archive at all")
+
+        self.assertRaises(ArchiveError, IncidentArchive(fp).open)
+
+
+
+class ArchivedStorageTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage} with archived incidents.
+    """
+
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        storage = self.storage()
+        self.incident1 = Incident.from_json_text(incident1_text, 1)
+        self.incident2 = Incident.from_json_text(incident2_text, 2)
+        self.incident2.closed = None
+        storage.write_incident(self.incident1)
+        storage.write_incident(self.incident2)
+        self.assertEquals(storage.archive_incidents(), 1)
+        storage.close()
+
+
+    def storage(self):
+        storage = Storage(self.path, journal=True, search_index=True)
+        storage.provision()
+        self.addCleanup(storage.close)
+        return storage
+
+
+    def test_archive_closed(self):
+        """
+        L{Storage.archive_incidents} moves closed incidents out of the
+        live area, and they are still read transparently.
+        """
+        storage = self.storage()
+
+        self.assertFalse(self.path.child("1").exists())
+        self.assertTrue(self.path.child("2").exists())
+        self.assertEquals(sorted(storage.archive.numbers()), [1])
+
+        self.assertEquals(
+            sorted(number for number, etag in storage.list_incidents()), [1, 2]
+        )
+        self.assertEquals(storage.read_incident_with_number(1), self.incident1)
+        self.assertEquals(
+            [n for n, e in storage.search_incidents((u"spire",), True)], [1]
+        )
+        self.assertEquals(storage.next_incident_number(), 3)
+
+
+    def test_archive_all(self):
+        """
+        L{Storage.archive_incidents} archives open incidents too if asked.
+        """
+        storage = self.storage()
+
+        self.assertEquals(storage.archive_incidents(closed_only=False), 1)
+        self.assertEquals(sorted(storage.archive.numbers()), [1, 2])
+        self.assertEquals(storage.read_incident_with_number(2), self.incident2)
+
+
+    def test_edit_archived(self):
+        """
+        Writing an archived incident moves it back to the live area, and
+        the live copy is read after reopening the store.
+        """
+        storage = self.storage()
+        incident = storage.read_incident_with_number(1)
+        incident.summary = u"Edited"
+        storage.write_incident(incident)
+        storage.close()
+
+        self.assertTrue(self.path.child("1").exists())
+
+        storage = self.storage()
+
+        self.assertNotIn(1, storage.archive)
+        self.assertEquals(storage.read_incident_with_number(1).summary, u"Edited")
+
+        self.assertEquals(storage.archive_incidents(), 1)
+        self.assertEquals(storage.read_incident_with_number(1).summary, u"Edited")
+        self.assertFalse(self.path.child("1").exists())
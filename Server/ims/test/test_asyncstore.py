@@ -0,0 +1,327 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.asyncstore}.
+"""
+
+from hashlib import sha1 as etag_hash
+
+from twisted.python.filepath import FilePath
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+import twisted.trial.unittest
+
+from ims.data import Incident, InvalidDataError
+from ims.store import Storage, NoSuchIncidentError
+from ims.asyncstore import AsyncStorage
+from ims.test.test_data import incident1_text, incident2_text
+from ims.test.test_journal import FakeThreadPool, ThreadedClock
+
+
+
+class AsyncStorageTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.asyncstore.AsyncStorage}
+    """
+
+    def storage(self, pool_size=0, **kwargs):
+        storage = Storage(FilePath(self.mktemp()), **kwargs)
+        storage.provision()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+        storage.incident_cache.clear()
+
+        async = AsyncStorage(storage, pool_size=pool_size)
+        async.start()
+        self.addCleanup(async.stop)
+        return async
+
+
+    def test_read_in_thread(self):
+        """
+        L{AsyncStorage.read_incident_with_number} reads incidents in the
+        thread pool.
+        """
+        async = self.storage(pool_size=2)
+
+        d = async.read_incident_with_number("1")
+        d.addCallback(
+            self.assertEquals, Incident.from_json_text(incident1_text, 1)
+        )
+        return d
+
+
+    def test_read_validated_raw(self):
+        """
+        L{AsyncStorage.read_incident_with_number_validated_raw} serves
+        current text as it is stored, and validates and renders anything
+        else again.
+        """
+        async = self.storage(pool_size=2)
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.number = 3
+        async.storage.path.child("3").setContent(
+            incident.to_json_text().replace('"priority":2', '"priority": 2')
+        )
+        incident.number = 4
+        incident.priority = 9
+        async.storage.path.child("4").setContent(incident.to_json_text())
+
+        stored = async.storage.read_incident_with_number_raw(1)
+
+        d = async.read_incident_with_number_validated_raw(1)
+        d.addCallback(self.assertEquals, stored)
+        d.addCallback(
+            lambda _: async.read_incident_with_number_validated_raw(3)
+        )
+        d.addCallback(
+            self.assertEquals,
+            stored.replace('"number":1', '"number":3')
+        )
+        d.addCallback(
+            lambda _: self.assertFailure(
+                async.read_incident_with_number_validated_raw(4),
+                InvalidDataError
+            )
+        )
+        return d
+
+
+    def test_read_no_such_incident(self):
+        """
+        L{AsyncStorage.read_incident_with_number} fails with
+        L{NoSuchIncidentError} for unknown incidents.
+        """
+        async = self.storage(pool_size=2)
+
+        self.failureResultOf(
+            async.read_incident_with_number("x")
+        ).trap(NoSuchIncidentError)
+        return self.assertFailure(
+            async.read_incident_with_number(3), NoSuchIncidentError
+        )
+
+
+    def test_read_caches(self):
+        """
+        Incidents read are cached, and cached incidents are returned
+        without using the thread pool.
+        """
+        async = self.storage()
+        self.successResultOf(async.read_incident_with_number(1))
+
+        async._in_thread = None
+
+        self.assertEquals(
+            self.successResultOf(async.read_incident_with_number(1)).number, 1
+        )
+
+
+    def test_stale_read_not_cached(self):
+        """
+        An incident read before a write to it completes after the write
+        is not cached.
+        """
+        async = self.storage()
+
+        loads = []
+        def in_thread(f, *args, **kwargs):
+            d = Deferred()
+            loads.append((d, f))
+            return d
+        async._in_thread = in_thread
+
+        read = async.read_incident_with_number(1)
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.summary = u"Changed"
+        self.successResultOf(async.write_incident(incident))
+
+        d, f = loads.pop()
+        d.callback(Incident.from_json_text(incident1_text, 1))
+
+        self.assertNotEquals(self.successResultOf(read).summary, u"Changed")
+        self.assertEquals(
+            async.storage.read_incident_with_number(1).summary, u"Changed"
+        )
+
+
+    def test_writes_ordered(self):
+        """
+        A write to an incident does not start until earlier writes to it
+        are durable.
+        """
+        clock = Clock()
+        async = self.storage(journal=True, reactor=clock)
+
+        results = []
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        async.write_incident(incident).addCallback(results.append)
+
+        second_incident = incident.copy()
+        second_incident.summary = u"Second"
+        async.write_incident(second_incident).addCallback(results.append)
+
+        async.write_incident(
+            Incident.from_json_text(incident2_text, 2)
+        ).addCallback(results.append)
+
+        self.assertEquals(results, [])
+        self.assertEquals(
+            sorted(async.storage.journal.pending_numbers()), [1, 2]
+        )
+        self.assertEquals(
+            async.storage.journal.pending_text(1), incident.to_json_text()
+        )
+
+        clock.advance(0)
+
+        # The second write to incident 1 was journaled after the write
+        # to incident 2.
+        self.assertEquals(len(results), 3)
+        self.assertEquals(results, sorted(results))
+        json = second_incident.to_json_text()
+        self.assertEquals(
+            async.storage.path.child("1").getContent(),
+            async.storage._stamp(json) + json
+        )
+        self.assertEquals(async._locks, {})
+
+
+    def test_write_in_thread(self):
+        """
+        Writes to a store without a journal are applied in the thread
+        pool, and the incident is then stored.
+        """
+        async = self.storage(reactor=ThreadedClock())
+        storage = async.storage
+        storage.threadpool = threadpool = FakeThreadPool()
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.summary = u"Changed"
+        json = incident.to_json_text()
+
+        results = []
+        async.write_incident(incident).addCallback(results.append)
+
+        self.assertEquals(results, [])
+        self.assertNotIn(json, storage.path.child("1").getContent())
+        self.assertNotIn(1, storage.incident_cache)
+
+        threadpool.run()
+
+        self.assertEquals(len(results), 1)
+        self.assertEquals(
+            storage.path.child("1").getContent(), storage._stamp(json) + json
+        )
+        self.assertEquals(
+            storage.incident_etags.get(1), etag_hash(json).hexdigest()
+        )
+        self.assertEquals(
+            storage.read_incident_with_number(1).summary, u"Changed"
+        )
+
+
+    def test_etag_in_thread(self):
+        """
+        Etags which the store doesn't know are read in the thread pool,
+        and recorded.
+        """
+        async = self.storage()
+        async.storage.incident_etags.discard(2)
+
+        loads = []
+        def in_thread(f, *args, **kwargs):
+            d = Deferred()
+            loads.append((d, f, args))
+            return d
+        async._in_thread = in_thread
+
+        results = []
+        async.list_incidents().addCallback(results.append)
+
+        self.assertEquals(results, [])
+        [(load, f, args)] = loads
+        self.assertEquals(args, (2,))
+
+        etag = f(*args)
+        load.callback(etag)
+
+        self.assertEquals(
+            sorted(results[0]),
+            [(1, async.storage.incident_etags.get(1)), (2, etag)]
+        )
+        self.assertEquals(async.storage.incident_etags.get(2), etag)
+
+
+    def test_edits_ordered(self):
+        """
+        Edits made with L{AsyncStorage.edit_incident} each see the result
+        of earlier edits.
+        """
+        async = self.storage()
+
+        edited = []
+        def edit(incident):
+            edited.append(incident.summary)
+            incident.summary = u"Edit {0}".format(len(edited))
+            return d
+        d = Deferred()
+
+        first = async.edit_incident(1, edit)
+        second = async.edit_incident(1, edit)
+
+        self.assertEquals(len(edited), 1)
+
+        d.callback(None)
+
+        self.successResultOf(first)
+        self.successResultOf(second)
+        self.assertEquals(edited[1], u"Edit 1")
+        self.assertEquals(
+            async.storage.read_incident_with_number(1).summary, u"Edit 2"
+        )
+
+
+    def test_search(self):
+        """
+        L{AsyncStorage.search_incidents} reads incidents to check terms
+        when the store has no search index.
+        """
+        async = self.storage()
+
+        d = async.search_incidents((u"man", u"lefty"), show_closed=True)
+        self.assertEquals(
+            [number for number, etag in self.successResultOf(d)], [2]
+        )
+
+        d = async.search_incidents((u"man",), show_closed=False)
+        self.assertEquals(self.successResultOf(d), [])
+
+
+    def test_read_incidents_failure(self):
+        """
+        L{AsyncStorage.read_incidents} fails with the first error
+        encountered.
+        """
+        async = self.storage()
+
+        self.failureResultOf(
+            async.read_incidents([1, 3])
+        ).trap(NoSuchIncidentError)
@@ -0,0 +1,95 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.backends}.
+"""
+
+from zope.interface.verify import verifyObject
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.config import Configuration
+from ims.interfaces import IStorage
+from ims.store import StorageError
+from ims.backends import backends, storage_backend, make_storage
+from ims.backends import files_backend, register_backend
+
+
+
+class BackendTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.backends}
+    """
+
+    def config(self, storage_type):
+        config = Configuration(FilePath(self.mktemp()), persist=False)
+        config.StorageType = storage_type
+        return config
+
+
+    def test_registered(self):
+        """
+        Back ends are looked up by name.
+        """
+        self.assertIdentical(storage_backend("files"), files_backend)
+
+
+    def test_qualified_name(self):
+        """
+        Back ends which aren't registered are looked up by fully
+        qualified name.
+        """
+        self.assertIdentical(
+            storage_backend("ims.backends.files_backend"), files_backend
+        )
+
+
+    def test_unknown(self):
+        """
+        Unknown back ends are an error.
+        """
+        self.assertRaises(StorageError, storage_backend, "punch cards")
+        self.assertRaises(StorageError, storage_backend, "ims.nothing.here")
+
+
+    def test_interface(self):
+        """
+        Every registered back end provides L{IStorage}.
+        """
+        for name in backends:
+            storage = make_storage(
+                self.config(name), FilePath(self.mktemp())
+            )
+            storage.provision()
+            try:
+                self.assertTrue(verifyObject(IStorage, storage))
+            finally:
+                storage.close()
+
+
+    def test_not_storage(self):
+        """
+        A back end which doesn't provide L{IStorage} is an error.
+        """
+        register_backend("nothing", lambda config, path, reactor=None: object())
+        self.addCleanup(backends.pop, "nothing")
+
+        self.assertRaises(
+            StorageError, make_storage, self.config("nothing"),
+            FilePath(self.mktemp()),
+        )
@@ -0,0 +1,117 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.benchmark}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.config import Configuration
+from ims.backends import backends
+from ims.benchmark import Workload, run_workload, summarize, report
+from ims.benchmark import measure_memory, measure_dates, report_dates
+from ims.benchmark import measure_encoding, report_encoding
+
+
+
+class BenchmarkTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.benchmark}
+    """
+
+    def test_run(self):
+        """
+        A workload runs against every back end, and the same operations
+        are counted for each.
+        """
+        config = Configuration(FilePath(self.mktemp()), persist=False)
+        workload = Workload(
+            incidents=20, reads=10, bursts=2, burst_size=3,
+            searches=5, listings=2,
+        )
+
+        directory = FilePath(self.mktemp())
+        directory.createDirectory()
+
+        summary = summarize([
+            (name, run_workload(config, name, workload, directory.path))
+            for name in sorted(backends)
+        ])
+
+        for name in backends:
+            self.assertEquals(
+                dict(
+                    (phase, result["operations"])
+                    for phase, result in summary[name].iteritems()
+                ),
+                {
+                    "bulk load": 20,
+                    "random reads": 10,
+                    "edit bursts": 6,
+                    "searches": 5,
+                    "listing": 2,
+                },
+            )
+            self.assertTrue(
+                summary[name]["random reads"]["p50"] <=
+                summary[name]["random reads"]["p99"]
+            )
+
+        self.assertEquals(directory.listdir(), [])
+        self.assertEquals(
+            len(report(summary).splitlines()), 1 + 5 * len(backends)
+        )
+
+
+    def test_memory(self):
+        """
+        Parsed incidents take less memory than they would with instance
+        dictionaries.
+        """
+        summary = measure_memory(Workload(incidents=10))
+
+        self.assertEquals(summary["incidents"], 10)
+        self.assertTrue(0 < summary["slots"] < summary["dict"])
+
+
+    def test_dates(self):
+        """
+        Dates are timed being parsed and rendered by each implementation.
+        """
+        summary = measure_dates(Workload(), entries=10, repeat=1)
+
+        self.assertEquals(summary["dates"], 12)
+        self.assertEquals(sorted(summary["parse"]), ["codec", "memo", "stdlib"])
+        self.assertEquals(sorted(summary["render"]), ["codec", "stdlib"])
+        self.assertEquals(len(report_dates(summary).splitlines()), 7)
+
+
+    def test_encoding(self):
+        """
+        Every incident in C{test/incidents.tgz} renders the same text with
+        L{ims.data.Incident.to_json_text} as with a dictionary.
+        """
+        archive = (
+            FilePath(__file__).parent().parent().parent()
+            .child("test").child("incidents.tgz")
+        )
+        summary = measure_encoding(archive, repeat=1)
+
+        self.assertEquals(summary["incidents"], 16)
+        self.assertEquals(summary["identical"], 16)
+        self.assertEquals(len(report_encoding(summary).splitlines()), 4)
@@ -54,6 +54,32 @@ class ConfigurationTests(twisted.trial.unittest.TestCase):
         self.assertEquals(config.DataRoot  , dataRoot)
         self.assertEquals(config.Resources , resources)
 
+        self.assertEquals(config.StorageType, "files")
+        self.assertEquals(config.IncidentCacheSize, 1000)
+        self.assertEquals(config.WriteJournal, True)
+        self.assertEquals(config.JournalCommitDelay, 0.0)
+        self.assertEquals(config.IncidentNumberBlockSize, 10)
+        self.assertEquals(config.SearchIndex, True)
+        self.assertEquals(config.SecondaryIndexes, True)
+        self.assertEquals(config.StorageLayout, "flat")
+        self.assertEquals(config.StorageThreads, 4)
+        self.assertEquals(config.ReportEntryLog, False)
+        self.assertEquals(config.CompressIncidents, False)
+        self.assertEquals(config.WarmUpProcesses, 0)
+        self.assertEquals(config.WatchDataRoot, False)
+        self.assertEquals(config.ServerPort, 8080)
+        self.assertEquals(config.Workers, 1)
+        self.assertEquals(config.SharedCacheSlotSize, 16384)
+        self.assertEquals(config.ReplicationSocket, None)
+        self.assertEquals(config.ReplicationBacklog, 1000)
+        self.assertEquals(config.FollowPrimary, None)
+        self.assertEquals(config.IncidentHistory, False)
+        self.assertEquals(config.HistoryKeyframeInterval, 20)
+        self.assertEquals(config.SyncSite, 0)
+        self.assertEquals(config.SyncSites, 1)
+        self.assertEquals(config.SyncPeer, None)
+        self.assertEquals(config.SyncInterval, 60)
+
         self.assertEquals(config.DMSHost    , None)
         self.assertEquals(config.DMSDatabase, None)
         self.assertEquals(config.DMSUsername, None)
@@ -18,6 +18,7 @@
 Tests for L{ims.data}.
 """
 
+import cPickle as pickle
 from cStringIO import StringIO
 from datetime import datetime
 
@@ -30,6 +31,9 @@ from ims.data import (
     Ranger,
     Location,
     from_json_text,
+    to_json_text,
+    parse_date,
+    render_date,
 )
 
 
@@ -266,6 +270,133 @@ class IncidentTests(twisted.trial.unittest.TestCase):
         self.assertEquals(incident1a, incident1b)
 
 
+    def test_to_json_text_dictionary(self):
+        """
+        L{ims.data.Incident.to_json_text} renders the same text as
+        L{ims.data.to_json_text} renders a dictionary of the incident.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.incident_types.append(u"Caf\xe9 \"Rouge\"")
+        incident.report_entries[0].system_entry = True
+
+        root = from_json_text(incident1_text)
+        root["incident_types"] = incident.incident_types
+        root["report_entries"] = [
+            entry.to_json() for entry in incident.report_entries
+        ]
+
+        self.assertEquals(
+            incident.to_json_text(),
+            to_json_text(dict(
+                (key, root[key]) for key in (
+                    "number", "priority", "summary", "location_name",
+                    "location_address", "incident_types", "created",
+                    "dispatched", "on_scene", "closed", "ranger_handles",
+                    "report_entries",
+                )
+            )),
+        )
+
+
+    def test_to_json_text_no_entries(self):
+        """
+        L{ims.data.Incident.to_json_text} renders no report entries if
+        asked not to.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        root = from_json_text(
+            incident.to_json_text(include_report_entries=False)
+        )
+
+        self.assertEquals(root["report_entries"], [])
+        self.assertEquals(root["summary"], incident.summary)
+
+
+    def test_to_json_text_unserializable(self):
+        """
+        L{ims.data.Incident.to_json_text} raises L{AssertionError} for an
+        incident with values JSON can't represent.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.summary = object()
+
+        self.assertRaises(AssertionError, incident.to_json_text)
+
+
+    def test_copy(self):
+        """
+        L{ims.data.Incident.copy} produces an equal incident which shares
+        no mutable state with the original.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        copy = incident.copy()
+
+        self.assertEquals(copy, incident)
+        self.assertNotIdentical(copy.location, incident.location)
+        self.assertNotIdentical(copy.rangers, incident.rangers)
+        self.assertNotIdentical(copy.incident_types, incident.incident_types)
+        self.assertNotIdentical(copy.report_entries, incident.report_entries)
+        self.assertNotIdentical(copy.report_entries[0], incident.report_entries[0])
+
+
+    def test_compact(self):
+        """
+        Incidents and the objects they hold have no instance dictionary.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+
+        for obj in (
+            incident, incident.location,
+            incident.rangers[0], incident.report_entries[0],
+        ):
+            self.assertFalse(hasattr(obj, "__dict__"), obj)
+            self.assertRaises(AttributeError, setattr, obj, "bogus", None)
+
+
+    def test_pickle(self):
+        """
+        Incidents can be pickled, as when they are passed between
+        processes, with every protocol.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+
+        for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEquals(
+                pickle.loads(pickle.dumps(incident, protocol)), incident
+            )
+
+
+    def test_lazy_report_entries(self):
+        """
+        Report entries read from JSON are decoded when first used.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        self.assertNotEquals(incident._report_entries_json, None)
+
+        copy = incident.copy()
+        self.assertEquals(len(incident.report_entries), 4)
+        self.assertEquals(incident._report_entries_json, None)
+
+        self.assertNotEquals(copy._report_entries_json, None)
+        self.assertEquals(copy.report_entries, incident.report_entries)
+        self.assertNotIdentical(copy.report_entries, incident.report_entries)
+
+
+    def test_lazy_report_entries_invalid(self):
+        """
+        Report entries read from JSON are validated when they are decoded,
+        or when the incident is validated before it is written.
+        """
+        root = from_json_text(incident1_text)
+        root["report_entries"][1]["text"] = 42
+
+        incident = Incident.from_json(dict(root), 1)
+        self.assertRaises(InvalidDataError, getattr, incident, "report_entries")
+
+        incident = Incident.from_json(dict(root), 1, validate=False)
+        self.assertRaises(InvalidDataError, incident.validate)
+
+
     def equals_1(self, incident):
         self.assertEquals(incident.number, 1)
         self.assertEquals(incident.rangers, [Ranger(u"Tulsa", None, None)])
@@ -452,6 +583,20 @@ class ReportEntryTests(twisted.trial.unittest.TestCase):
         self.assertRaises(InvalidDataError, entry.validate)
 
 
+    def test_to_json_text(self):
+        """
+        L{ims.data.ReportEntry.to_json_text} renders the same text as
+        L{ims.data.to_json_text} renders L{ims.data.ReportEntry.to_json}.
+        """
+        for entry in (
+            ReportEntry(u"Tool", u"Something\nhappened!", datetime(2013, 3, 21)),
+            ReportEntry(None, u"\u2603", None, system_entry=True),
+        ):
+            self.assertEquals(
+                entry.to_json_text(), to_json_text(entry.to_json())
+            )
+
+
 
 class RangerTests(twisted.trial.unittest.TestCase):
     """
@@ -653,6 +798,61 @@ class LocationTests(twisted.trial.unittest.TestCase):
 
 
 
+class DateTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.data.parse_date} and L{ims.data.render_date}
+    """
+
+    def test_parse(self):
+        """
+        L{ims.data.parse_date} parses dates as C{strptime} would.
+        """
+        for text in (
+            u"2013-03-21T19:18:42Z", "2013-03-21T19:18:42Z",
+            "1999-12-31T23:59:59Z", "2013-3-2T9:08:42Z",
+        ):
+            self.assertEquals(
+                parse_date(text),
+                datetime.strptime(text, "%Y-%m-%dT%H:%M:%SZ"),
+            )
+
+        self.assertEquals(parse_date(None), None)
+        self.assertEquals(parse_date(u""), None)
+
+
+    def test_parse_invalid(self):
+        """
+        L{ims.data.parse_date} raises L{InvalidDataError} for text which
+        isn't a valid date.
+        """
+        for text in (
+            u"2013-03-21T19:18:42", u"2013-03-21 19:18:42Z",
+            u"2013-13-21T19:18:42Z", u"2013-02-30T19:18:42Z",
+            u"2013-03-21T24:18:42Z", u"2013-+3-21T19:18:42Z",
+            u"2013-03-21T19:18:4\u0662Z", u"Knocked out spire", 1,
+            [1], {u"date": u"2013-03-21T19:18:42Z"},
+        ):
+            self.assertRaises(InvalidDataError, parse_date, text)
+
+
+    def test_render(self):
+        """
+        L{ims.data.render_date} renders dates as C{strftime} would.
+        """
+        for date_time in (
+            datetime(2013, 3, 21, 19, 18, 42),
+            datetime(2013, 3, 21, 19, 18, 42, 500),
+            datetime(1999, 12, 31, 23, 59, 59),
+        ):
+            self.assertEquals(
+                render_date(date_time),
+                date_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            )
+
+        self.assertEquals(render_date(None), None)
+
+
+
 
 
 
@@ -0,0 +1,152 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.history}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import to_json_text
+from ims.history import IncidentHistory, HistoryError
+from ims.history import revision_delta, apply_revision_delta
+
+
+
+def revision(summary, *entries):
+    return {
+        "number": 1,
+        "summary": summary,
+        "report_entries": [{"text": text} for text in entries],
+    }
+
+
+
+class DeltaTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.history.revision_delta} and
+    L{ims.history.apply_revision_delta}
+    """
+
+    def test_appended(self):
+        """
+        A revision which added report entries is described by the number
+        of entries kept.
+        """
+        earlier = revision(u"Here", u"One")
+        later = revision(u"Here", u"One", u"Two")
+
+        delta = revision_delta(later, earlier)
+
+        self.assertEquals(delta, {"entries": [1, []]})
+        self.assertEquals(apply_revision_delta(later, delta), earlier)
+
+
+    def test_changed(self):
+        """
+        Fields which were changed, added or removed are restored.
+        """
+        earlier = revision(u"Here", u"One", u"Two")
+        earlier["priority"] = 3
+        later = revision(u"There", u"One", u"Three")
+        later["closed"] = "2013-08-28T12:00:00Z"
+
+        delta = revision_delta(later, earlier)
+
+        self.assertEquals(apply_revision_delta(later, delta), earlier)
+        self.assertEquals(delta["entries"], [1, [{"text": u"Two"}]])
+
+
+    def test_same(self):
+        """
+        Identical revisions have an empty delta.
+        """
+        self.assertEquals(
+            revision_delta(revision(u"Here", u"One"), revision(u"Here", u"One")),
+            {},
+        )
+
+
+
+class IncidentHistoryTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.history.IncidentHistory}
+    """
+
+    def setUp(self):
+        self.history = IncidentHistory(FilePath(self.mktemp()), keyframe_interval=4)
+        self.revisions = []
+
+
+    def write(self, *revisions):
+        for r in revisions:
+            if self.revisions:
+                previous = to_json_text(self.revisions[-1])
+            else:
+                previous = None
+            self.history.record(previous, to_json_text(r), u"t{0}".format(len(self.revisions)))
+            self.revisions.append(r)
+
+
+    def rebuild(self, number):
+        return self.history.rebuild(
+            self.history.records(), to_json_text(self.revisions[-1]), number
+        )
+
+
+    def test_rebuild(self):
+        """
+        Every revision can be rebuilt from the latest one.
+        """
+        self.write(*[
+            revision(u"Revision {0}".format(n), *[u"x" * 5000] * n)
+            for n in xrange(10)
+        ])
+
+        for n, r in enumerate(self.revisions):
+            self.assertEquals(self.rebuild(n + 1), r)
+
+
+    def test_torn(self):
+        """
+        A record torn by a crash is dropped when the next is written.
+        """
+        self.write(revision(u"One"), revision(u"Two"))
+        self.history.fp.setContent(self.history.fp.getContent() + '{"revis')
+        self.write(revision(u"Three"))
+
+        self.assertEquals([r["revision"] for r in self.history.records()], [1, 2, 3])
+        self.assertEquals(self.rebuild(1), self.revisions[0])
+
+
+    def test_unrecorded(self):
+        """
+        A revision which was not recorded is recorded with the next, and
+        revisions before it after the last keyframe are no longer
+        available.
+        """
+        self.write(*[revision(u"Revision {0}".format(n)) for n in xrange(6)])
+        self.revisions.append(revision(u"Changed"))
+        self.write(revision(u"After"))
+
+        records = self.history.records()
+        self.assertEquals([r["revision"] for r in records], range(1, 9))
+        self.assertEquals(records[-2]["written"], None)
+
+        self.assertEquals(self.rebuild(7), self.revisions[-2])
+        self.assertEquals(self.rebuild(4), self.revisions[3])
+        self.assertRaises(HistoryError, self.rebuild, 5)
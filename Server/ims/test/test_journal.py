@@ -0,0 +1,507 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.journal}.
+"""
+
+from twisted.python.failure import Failure
+from twisted.python.filepath import FilePath
+from twisted.internet.task import Clock
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.journal import Journal, JournalError, checksum
+from ims.store import Storage
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+def record(sequence, number, text):
+    """
+    @return: a journal record.
+    """
+    return "{0} {1} {2:08x} {3}\n".format(sequence, number, checksum(text), text)
+
+
+
+class JournalTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.journal.Journal}
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.applied = []
+        self.root = FilePath(self.mktemp())
+        self.root.createDirectory()
+
+
+    def journal(self):
+        journal = Journal(
+            self.root.child("journal"), self.apply, reactor=self.clock
+        )
+        journal.open()
+        return journal
+
+
+    def apply(self, number, text):
+        self.applied.append((number, text))
+        fp = self.root.child(str(number))
+        fp.setContent(text)
+        return fp
+
+
+    def test_append_not_open(self):
+        """
+        Appending to a journal which is not open fails.
+        """
+        journal = Journal(self.root.child("journal"), self.apply, reactor=self.clock)
+
+        self.assertRaises(JournalError, journal.append, 1, "{}")
+
+
+    def test_group_commit(self):
+        """
+        Writes appended before a commit are committed together, and are
+        applied once committed.
+        """
+        journal = self.journal()
+
+        results = []
+        journal.append(1, "one").addCallback(results.append)
+        journal.append(2, "two").addCallback(results.append)
+
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.assertEquals(results, [])
+        self.assertEquals(self.applied, [])
+
+        self.clock.advance(0)
+
+        self.assertEquals(results, [1, 2])
+        self.assertEquals(self.applied, [(1, "one"), (2, "two")])
+
+
+    def test_pending_text(self):
+        """
+        L{ims.journal.Journal.pending_text} returns the latest text of
+        writes which have not yet been applied.
+        """
+        journal = self.journal()
+
+        journal.append(1, "one")
+        journal.append(1, "uno")
+
+        self.assertEquals(journal.pending_text(1), "uno")
+        self.assertIdentical(journal.pending_text(2), None)
+
+        self.clock.advance(0)
+
+        self.assertIdentical(journal.pending_text(1), None)
+
+
+    def test_replay(self):
+        """
+        Writes which were committed but not applied are replayed when
+        the journal is next opened.
+        """
+        journal = self.journal()
+        journal.append(1, "one")
+        journal.append(2, "two")
+        # Simulate a crash after the journal was written
+        journal._fh.flush()
+
+        journal = self.journal()
+
+        self.assertEquals(self.applied, [(1, "one"), (2, "two")])
+        self.assertEquals(journal.sequence, 2)
+
+
+    def test_replay_torn_record(self):
+        """
+        Replay stops at a torn record.
+        """
+        journal = self.journal()
+        journal.append(1, "one")
+        journal._fh.write("2 2 0000")
+        journal._fh.flush()
+
+        self.journal()
+
+        self.assertEquals(self.applied, [(1, "one")])
+
+
+    def test_replay_corrupt_record(self):
+        """
+        Replay stops at a record which fails its checksum.
+        """
+        journal = self.journal()
+        journal._fh.write("1 1 00000000 one\n")
+        journal._fh.flush()
+
+        self.journal()
+
+        self.assertEquals(self.applied, [])
+
+
+    def test_checkpoint(self):
+        """
+        Closing the journal truncates it, retaining the sequence number.
+        """
+        journal = self.journal()
+        journal.append(1, "one")
+        journal.close()
+
+        del self.applied[:]
+        journal = self.journal()
+
+        self.assertEquals(self.applied, [])
+        self.assertEquals(journal.sequence, 1)
+
+
+    def test_checkpoint_keeps_pending(self):
+        """
+        A checkpoint removes the writes which have been applied from the
+        journal, keeping those which are yet to be committed.
+        """
+        journal = self.journal()
+        journal.append(1, "one")
+        self.clock.advance(0)
+        journal.append(2, "two")
+
+        journal.checkpoint()
+
+        self.assertFalse(journal._old_fp().exists())
+
+        del self.applied[:]
+        journal._fh.flush()
+        journal = self.journal()
+
+        self.assertEquals(self.applied, [(2, "two")])
+        self.assertEquals(journal.sequence, 2)
+
+
+    def test_replay_interrupted_checkpoint(self):
+        """
+        Writes in the old journal file of an interrupted checkpoint are
+        replayed before those in the new one, after which the old file
+        is removed.
+        """
+        journal = Journal(
+            self.root.child("journal"), self.apply, reactor=self.clock
+        )
+        old = journal._old_fp()
+
+        old.setContent(record(1, 1, "one"))
+        journal.fp.setContent(record(1, "-", "") + record(2, 2, "two"))
+
+        journal = self.journal()
+
+        self.assertEquals(self.applied, [(1, "one"), (2, "two")])
+        self.assertFalse(old.exists())
+
+
+    def test_apply_retried(self):
+        """
+        A write which fails to be applied is kept, and is tried again,
+        before later writes to the same incident, with the next commit.
+        """
+        failures = []
+
+        def apply(number, text):
+            if failures:
+                failures.pop()
+                raise IOError("Disk full")
+            return self.apply(number, text)
+
+        journal = Journal(self.root.child("journal"), apply, reactor=self.clock)
+        journal.open()
+
+        failures.append(True)
+        journal.append(1, "one")
+        self.clock.advance(0)
+
+        self.assertEquals(self.applied, [])
+        self.assertEquals(journal.pending_text(1), "one")
+
+        journal.checkpoint()
+        self.flushLoggedErrors()
+        self.assertIn(record(1, 1, "one"), journal.fp.getContent())
+
+        failures.append(True)
+        journal.append(1, "uno")
+        journal.append(2, "two")
+        self.clock.advance(0)
+
+        self.assertEquals(self.applied, [(2, "two")])
+        self.assertEquals(journal.pending_text(1), "uno")
+
+        journal.append(3, "three")
+        self.clock.advance(0)
+
+        self.assertEquals(
+            self.applied, [(2, "two"), (1, "one"), (1, "uno"), (3, "three")]
+        )
+        self.assertIdentical(journal.pending_text(1), None)
+        self.flushLoggedErrors()
+
+
+
+class FakeThreadPool(object):
+    """
+    Thread pool which runs nothing until told to.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.running = False
+
+
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        self.calls.append((onResult, f, args, kwargs))
+
+
+    def run(self):
+        onResult, f, args, kwargs = self.calls.pop(0)
+        self.running = True
+        try:
+            result = (True, f(*args, **kwargs))
+        except Exception:
+            result = (False, Failure())
+        self.running = False
+        onResult(*result)
+
+
+
+class ThreadedClock(Clock):
+    """
+    L{Clock} which also runs calls from other threads.
+    """
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+
+class ThreadedJournalTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.journal.Journal} syncing in a thread pool.
+    """
+
+    def setUp(self):
+        self.clock = ThreadedClock()
+        self.threadpool = FakeThreadPool()
+        self.applied = []
+        self.root = FilePath(self.mktemp())
+        self.root.createDirectory()
+
+        self.journal = Journal(
+            self.root.child("journal"), self.apply, reactor=self.clock
+        )
+        self.journal.open()
+        self.journal.threadpool = self.threadpool
+
+
+    def apply(self, number, text):
+        self.applied.append((number, text))
+        fp = self.root.child(str(number))
+        fp.setContent(text)
+        return fp
+
+
+    def test_sync_in_thread(self):
+        """
+        Writes are applied once the journal has been synced in the thread
+        pool, and writes appended meanwhile wait for the next sync.
+        """
+        results = []
+        self.journal.append(1, "one").addCallback(results.append)
+        self.clock.advance(0)
+
+        self.assertEquals(len(self.threadpool.calls), 1)
+        self.assertEquals(self.applied, [])
+
+        self.journal.append(2, "two").addCallback(results.append)
+        self.clock.advance(0)
+
+        self.assertEquals(len(self.threadpool.calls), 1)
+
+        self.threadpool.run()
+
+        self.assertEquals(self.applied, [(1, "one")])
+        self.assertEquals(results, [1])
+        self.assertEquals(len(self.threadpool.calls), 1)
+
+        self.threadpool.run()
+
+        self.assertEquals(self.applied, [(1, "one"), (2, "two")])
+        self.assertEquals(results, [1, 2])
+
+
+    def test_close_while_syncing(self):
+        """
+        Closing the journal while it is being synced in a thread applies
+        the writes being synced without waiting for the thread.
+        """
+        results = []
+        self.journal.append(1, "one").addCallback(results.append)
+        self.clock.advance(0)
+        self.journal.close()
+
+        self.assertEquals(self.applied, [(1, "one")])
+        self.assertEquals(results, [1])
+
+        self.threadpool.run()
+
+        self.assertEquals(self.applied, [(1, "one")])
+
+
+    def test_apply_in_thread(self):
+        """
+        Writes are applied in the thread pool, and C{applied} is then
+        called on the reactor.
+        """
+        threaded = []
+        def apply(number, text):
+            threaded.append(self.threadpool.running)
+            return self.apply(number, text)
+        self.journal.apply = apply
+
+        applied = []
+        def note(number, text, error):
+            applied.append((number, text, error, self.threadpool.running))
+        self.journal.applied = note
+
+        self.journal.append(1, "one")
+        self.clock.advance(0)
+        self.threadpool.run()
+
+        self.assertEquals(threaded, [True])
+        self.assertEquals(applied, [(1, "one", None, False)])
+
+
+    def test_close_after_apply_in_thread(self):
+        """
+        Closing the journal after a thread has applied writes, but before
+        the reactor has heard so, doesn't apply them again.
+        """
+        results = []
+        self.journal.append(1, "one").addCallback(results.append)
+        self.clock.advance(0)
+
+        onResult, f, args, kwargs = self.threadpool.calls.pop(0)
+        f(*args, **kwargs)
+
+        self.assertEquals(self.applied, [(1, "one")])
+        self.assertEquals(results, [])
+
+        self.journal.close()
+
+        self.assertEquals(self.applied, [(1, "one")])
+        self.assertEquals(results, [1])
+
+
+    def test_checkpoint_in_thread(self):
+        """
+        A checkpoint started once the journal grows is finished in the
+        thread pool, while writes go on being committed to the new
+        journal file.
+        """
+        self.journal.checkpoint_size = 0
+
+        self.journal.append(1, "one")
+        self.clock.advance(0)
+        self.threadpool.run()
+
+        self.assertEquals(self.applied, [(1, "one")])
+        self.assertTrue(self.journal._old_fp().exists())
+        self.assertEquals(len(self.threadpool.calls), 1)
+
+        results = []
+        self.journal.append(2, "two").addCallback(results.append)
+        self.clock.advance(0)
+
+        self.threadpool.run()
+
+        self.assertFalse(self.journal._old_fp().exists())
+
+        self.threadpool.run()
+
+        self.assertEquals(results, [2])
+        self.assertEquals(self.applied, [(1, "one"), (2, "two")])
+
+
+
+class JournaledStorageTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage} with a journal.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = Storage(
+            FilePath(self.mktemp()), journal=True, reactor=self.clock
+        )
+        self.storage.provision()
+
+
+    def test_read_pending(self):
+        """
+        Writes are visible to readers before they are committed.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        self.storage.write_incident(incident)
+        self.storage.incident_cache.clear()
+
+        self.assertFalse(self.storage.path.child("1").exists())
+        self.assertEquals(self.storage.read_incident_with_number(1), incident)
+
+
+    def test_write_committed(self):
+        """
+        The L{Deferred} returned by L{ims.store.Storage.write_incident}
+        fires once the write is committed, after which the incident's
+        file has been written.
+        """
+        incident = Incident.from_json_text(incident2_text, 2)
+        d = self.storage.write_incident(incident)
+
+        self.clock.advance(0)
+
+        self.successResultOf(d)
+        json = incident.to_json_text()
+        self.assertEquals(
+            self.storage.path.child("2").getContent(),
+            self.storage._stamp(json) + json
+        )
+
+
+    def test_recover(self):
+        """
+        A new store recovers writes from the journal of a store which
+        did not apply them.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        self.storage.write_incident(incident)
+        self.storage.journal._fh.flush()
+
+        storage = Storage(self.storage.path, journal=True, reactor=self.clock)
+        storage.provision()
+
+        self.assertEquals(
+            [number for number, etag in storage.list_incidents()], [1]
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
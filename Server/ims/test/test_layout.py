@@ -0,0 +1,243 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.layout}.
+"""
+
+import os
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.layout import DirectoryCache, FlatLayout, ShardedLayout
+from ims.store import Storage
+from ims.test.test_data import incident1_text
+from ims.test import test_store
+
+
+
+class DirectoryCacheTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.layout.DirectoryCache}
+    """
+
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+        self.path.createDirectory()
+        self.path.child("1").setContent("")
+
+        self.listdir_calls = []
+        def listdir(path):
+            self.listdir_calls.append(path)
+            return real_listdir(path)
+        real_listdir = os.listdir
+        self.patch(os, "listdir", listdir)
+
+
+    def age(self, seconds=10):
+        mtime = self.path.getModificationTime() - seconds
+        os.utime(self.path.path, (mtime, mtime))
+
+
+    def test_unchanged(self):
+        """
+        A directory is listed once while its modification time is
+        unchanged.
+        """
+        self.age()
+        cache = DirectoryCache()
+
+        self.assertEquals(cache.listdir(self.path.path), ["1"])
+        self.assertEquals(cache.listdir(self.path.path), ["1"])
+        self.assertEquals(len(self.listdir_calls), 1)
+
+
+    def test_changed(self):
+        """
+        A directory is listed again once its modification time changes.
+        """
+        self.age(20)
+        cache = DirectoryCache()
+        cache.listdir(self.path.path)
+
+        self.path.child("2").setContent("")
+        self.age()
+
+        self.assertEquals(sorted(cache.listdir(self.path.path)), ["1", "2"])
+        self.assertEquals(len(self.listdir_calls), 2)
+
+
+    def test_recently_modified(self):
+        """
+        A directory modified within the cache's granularity is not
+        cached.
+        """
+        cache = DirectoryCache()
+        cache.listdir(self.path.path)
+        cache.listdir(self.path.path)
+
+        self.assertEquals(len(self.listdir_calls), 2)
+
+
+    def test_missing(self):
+        """
+        A missing directory has no entries.
+        """
+        cache = DirectoryCache()
+
+        self.assertEquals(cache.listdir(self.path.child("x").path), [])
+
+
+
+class LayoutTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.layout.FlatLayout} and L{ims.layout.ShardedLayout}
+    """
+
+    def test_flat_fp(self):
+        """
+        L{FlatLayout.fp} names files in the store's directory.
+        """
+        path = FilePath("/data")
+        layout = FlatLayout(path, DirectoryCache())
+
+        self.assertEquals(layout.fp(1234), path.child("1234"))
+        self.assertEquals(layout.fp(1234, "tmp"), path.child(".1234.tmp"))
+
+
+    def test_sharded_fp(self):
+        """
+        L{ShardedLayout.fp} names files in subdirectories for the
+        preceding pairs of digits.
+        """
+        path = FilePath("/data")
+        layout = ShardedLayout(path, DirectoryCache())
+
+        self.assertEquals(
+            layout.fp(1234), path.child("00").child("12").child("1234")
+        )
+        self.assertEquals(
+            layout.fp(567890, "tmp"),
+            path.child("56").child("78").child(".567890.tmp")
+        )
+        self.assertEquals(
+            layout.fp(7), path.child("00").child("00").child("7")
+        )
+
+
+    def test_sharded_numbers(self):
+        """
+        L{ShardedLayout.numbers} finds incidents in subdirectories,
+        ignoring dotfiles.
+        """
+        path = FilePath(self.mktemp())
+        layout = ShardedLayout(path, DirectoryCache())
+
+        for number in (1, 1234, 567890):
+            fp = layout.fp(number)
+            fp.parent().makedirs()
+            fp.setContent("")
+        layout.fp(1, "tmp").setContent("")
+        path.child(".etags").setContent("")
+
+        self.assertEquals(sorted(layout.numbers()), [1, 1234, 567890])
+
+
+
+class ShardedStorageTests(test_store.StorageTests):
+    """
+    Tests for L{ims.store.Storage} with the sharded layout.
+    """
+
+    def storage(self, **kwargs):
+        kwargs.setdefault("layout", "sharded")
+        return test_store.StorageTests.storage(self, **kwargs)
+
+
+    def test_layout_file(self):
+        """
+        The layout of a new store is recorded, and is used when the store
+        is reopened, regardless of the layout asked for.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.close()
+
+        self.assertTrue(storage.path.child("00").child("00").child("1").exists())
+
+        storage = Storage(storage.path, layout="flat")
+        storage.provision()
+
+        self.assertEquals(storage.layout.name, "sharded")
+        self.assertEquals(
+            storage.read_incident_with_number(1).number, 1
+        )
+
+
+    def test_legacy_flat(self):
+        """
+        A store with incident files and no layout file is flat.
+        """
+        path = FilePath(self.mktemp())
+        path.createDirectory()
+        path.child("1").setContent(incident1_text)
+
+        storage = Storage(path, layout="sharded")
+        storage.provision()
+
+        self.assertEquals(storage.layout.name, "flat")
+        self.assertEquals(list(storage._list_incidents()), [1])
+
+
+    def test_migrate(self):
+        """
+        L{ims.store.Storage.migrate_layout} moves incidents between
+        layouts, including incidents whose numbers are also the names of
+        sharded subdirectories.
+        """
+        numbers = (1, 12, 1234, 120000)
+
+        storage = test_store.StorageTests.storage(self)
+        for number in numbers:
+            incident = Incident.from_json_text(incident1_text, 1)
+            incident.number = number
+            storage.write_incident(incident)
+
+        self.assertEquals(storage.migrate_layout("sharded"), len(numbers))
+        self.assertEquals(storage.layout.name, "sharded")
+        self.assertEquals(
+            sorted(storage.path.listdir()),
+            [".etags", ".incident_number", ".layout", "00", "12"]
+        )
+        self.assertEquals(
+            sorted(n for n, etag in storage.list_incidents()), list(numbers)
+        )
+
+        self.assertEquals(storage.migrate_layout("flat"), len(numbers))
+        self.assertEquals(
+            sorted(storage.path.listdir()),
+            [".etags", ".incident_number", ".layout"] +
+            sorted(str(n) for n in numbers)
+        )
+
+        storage = Storage(storage.path)
+        storage.provision()
+        for number in numbers:
+            self.assertEquals(
+                storage.read_incident_with_number(number).number, number
+            )
@@ -0,0 +1,272 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.locks}.
+"""
+
+import os
+from threading import Thread
+
+from twisted.python.filepath import FilePath
+from twisted.internet.task import Clock
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.locks import IncidentLocks
+from ims.store import Storage
+from ims.asyncstore import AsyncStorage
+from ims.test.test_data import incident1_text
+
+
+
+def locked_elsewhere(fp, number):
+    """
+    @return: whether another process would find an incident locked.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            locks = IncidentLocks(fp)
+            os._exit(0 if locks.acquire(number, blocking=False) else 1)
+        finally:
+            os._exit(2)
+
+    pid, status = os.waitpid(pid, 0)
+    return os.WEXITSTATUS(status) == 1
+
+
+def in_thread(f, *args, **kwargs):
+    """
+    Call a function in another thread and wait for it to return.
+
+    @return: what the function returned.
+    """
+    results = []
+    thread = Thread(target=lambda: results.append(f(*args, **kwargs)))
+    thread.start()
+    thread.join()
+    return results[0]
+
+
+def lock_elsewhere(fp, number):
+    """
+    Lock an incident in another process.
+
+    @return: a function which releases the lock.
+    """
+    locked_r, locked_w = os.pipe()
+    release_r, release_w = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(locked_r)
+            os.close(release_w)
+            IncidentLocks(fp).acquire(number)
+            os.write(locked_w, "x")
+            os.read(release_r, 1)
+        finally:
+            os._exit(0)
+
+    os.close(locked_w)
+    os.close(release_r)
+    os.read(locked_r, 1)
+    os.close(locked_r)
+
+    def release():
+        os.close(release_w)
+        os.waitpid(pid, 0)
+
+    return release
+
+
+
+class IncidentLocksTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.locks.IncidentLocks}
+    """
+
+    def setUp(self):
+        self.fp = FilePath(self.mktemp())
+        self.locks = IncidentLocks(self.fp)
+        self.addCleanup(self.locks.close)
+
+
+    def test_exclusive(self):
+        """
+        An incident locked by one process can't be locked by another, but
+        other incidents can.
+        """
+        self.assertTrue(self.locks.acquire(1))
+
+        self.assertTrue(locked_elsewhere(self.fp, 1))
+        self.assertFalse(locked_elsewhere(self.fp, 2))
+
+
+    def test_counted(self):
+        """
+        An incident stays locked until released as many times as it was
+        acquired.
+        """
+        self.locks.acquire(1)
+        self.locks.acquire(1)
+
+        self.locks.release(1)
+        self.assertTrue(self.locks.held(1))
+        self.assertTrue(locked_elsewhere(self.fp, 1))
+
+        self.locks.release(1)
+        self.assertFalse(self.locks.held(1))
+        self.assertFalse(locked_elsewhere(self.fp, 1))
+
+
+    def test_nonblocking(self):
+        """
+        Acquiring a lock held by another process without blocking fails.
+        """
+        release = lock_elsewhere(self.fp, 1)
+        try:
+            self.assertFalse(self.locks.acquire(1, blocking=False))
+            self.assertFalse(self.locks.held(1))
+        finally:
+            release()
+
+        self.assertTrue(self.locks.acquire(1, blocking=False))
+
+
+    def test_threads(self):
+        """
+        An incident locked by one thread can't be locked by another thread
+        of the same process until it is released.
+        """
+        self.locks.acquire(1)
+
+        self.assertFalse(in_thread(self.locks.held, 1))
+        self.assertFalse(in_thread(self.locks.acquire, 1, blocking=False))
+        self.assertFalse(
+            in_thread(self.locks.acquire, 1, wait_for_threads=False)
+        )
+
+        self.locks.release(1)
+
+        def lock_unlock():
+            if not self.locks.acquire(1, blocking=False):
+                return False
+            self.locks.release(1)
+            return True
+
+        self.assertTrue(in_thread(lock_unlock))
+        self.assertFalse(locked_elsewhere(self.fp, 1))
+
+
+
+class SharedStorageTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage} shared with other processes.
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = Storage(
+            FilePath(self.mktemp()), shared=True,
+            journal=True, journal_name=".journal-1", reactor=self.clock,
+        )
+        self.storage.provision()
+        self.addCleanup(self.storage.close)
+
+
+    def test_journal_name(self):
+        """
+        The store's journal has the name given.
+        """
+        self.assertTrue(self.storage.path.child(".journal-1").exists())
+        self.assertFalse(self.storage.path.child(".journal").exists())
+
+
+    def test_write_locked(self):
+        """
+        An incident is locked from when it is written until the write is
+        applied.
+        """
+        self.storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        self.assertTrue(locked_elsewhere(self.storage.locks.fp, 1))
+
+        self.clock.advance(0)
+
+        self.assertFalse(locked_elsewhere(self.storage.locks.fp, 1))
+
+
+    def test_no_local_cache(self):
+        """
+        A shared store doesn't keep its own cache of parsed incidents.
+        """
+        self.storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        self.clock.advance(0)
+        self.storage.read_incident_with_number(1)
+
+        self.assertEquals(len(self.storage.incident_cache), 0)
+
+
+    def test_async_write_waits(self):
+        """
+        L{ims.asyncstore.AsyncStorage} waits without blocking for other
+        processes to release an incident before writing it.
+        """
+        storage = AsyncStorage(self.storage, pool_size=0, reactor=self.clock)
+
+        release = lock_elsewhere(self.storage.locks.fp, 1)
+        try:
+            results = []
+            storage.write_incident(
+                Incident.from_json_text(incident1_text, 1)
+            ).addCallback(results.append)
+
+            self.clock.advance(storage.lock_interval)
+            self.assertEquals(results, [])
+            self.assertFalse(self.storage.path.child("1").exists())
+        finally:
+            release()
+
+        self.clock.advance(storage.lock_interval)
+        self.clock.advance(0)
+
+        self.assertEquals(len(results), 1)
+        self.assertTrue(self.storage.path.child("1").exists())
+
+
+    def test_read_while_writing(self):
+        """
+        Reading an incident in another thread while this one has it locked
+        reads it without caching it.
+        """
+        self.storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        self.clock.advance(0)
+        self.storage.shared_cache.discard(1)
+
+        self.storage.lock_incident(1)
+        try:
+            self.assertEquals(
+                in_thread(self.storage.read_incident_with_number_raw, 1),
+                Incident.from_json_text(incident1_text, 1).to_json_text()
+            )
+            self.assertIdentical(self.storage.shared_cache.get(1), None)
+        finally:
+            self.storage.unlock_incident(1)
+
+        in_thread(self.storage.read_incident_with_number_raw, 1)
+        self.assertNotIdentical(self.storage.shared_cache.get(1), None)
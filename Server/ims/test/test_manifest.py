@@ -0,0 +1,169 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.manifest}.
+"""
+
+from hashlib import sha1
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.manifest import EtagManifest
+from ims.store import Storage
+from ims.test.test_data import incident1_text
+
+
+
+class EtagManifestTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.manifest.EtagManifest}
+    """
+
+    def setUp(self):
+        self.fp = FilePath(self.mktemp())
+
+
+    def manifest(self, **kwargs):
+        manifest = EtagManifest(self.fp, **kwargs)
+        manifest.load()
+        self.addCleanup(manifest.close)
+        return manifest
+
+
+    def test_persistent(self):
+        """
+        Recorded etags are loaded by a new manifest, the last recorded
+        etag for an incident winning.
+        """
+        manifest = self.manifest()
+        manifest.record(1, "a")
+        manifest.record(2, "b")
+        manifest.record(1, "c")
+        manifest.close()
+
+        manifest = self.manifest()
+
+        self.assertEquals(manifest.get(1), "c")
+        self.assertEquals(manifest.get(2), "b")
+        self.assertIdentical(manifest.get(3), None)
+        self.assertEquals(sorted(manifest.numbers()), [1, 2])
+        self.assertEquals(sorted(manifest.items()), [(1, "c"), (2, "b")])
+
+
+    def test_update_not_persistent(self):
+        """
+        Etags changed with L{ims.manifest.EtagManifest.update} are not
+        written to the manifest file.
+        """
+        manifest = self.manifest()
+        manifest.update(1, "a")
+        self.assertEquals(manifest.get(1), "a")
+        manifest.close()
+
+        self.assertIdentical(self.manifest().get(1), None)
+
+
+    def test_compact(self):
+        """
+        The manifest file is rewritten when mostly superseded.
+        """
+        manifest = self.manifest(compact_slack=0)
+        for etag in "abcde":
+            manifest.record(1, etag)
+
+        self.assertEquals(self.fp.getContent(), "1 e\n")
+
+
+    def test_torn_line(self):
+        """
+        An incomplete last line is ignored.
+        """
+        self.fp.setContent("1 a\n2 b")
+
+        manifest = self.manifest()
+
+        self.assertEquals(manifest.get(1), "a")
+        self.assertIdentical(manifest.get(2), None)
+
+
+
+class StorageEtagTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for etags in L{ims.store.Storage}.
+    """
+
+    def test_etag_updated(self):
+        """
+        An incident's etag changes when it is written, without creating
+        etag files.
+        """
+        storage = Storage(FilePath(self.mktemp()))
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+        etag1 = storage.etag_for_incident_with_number(1)
+
+        incident.summary = u"Changed"
+        storage.write_incident(incident)
+        etag2 = storage.etag_for_incident_with_number("1")
+
+        self.assertNotEquals(etag1, etag2)
+        self.assertEquals(etag2, sha1(incident.to_json_text()).hexdigest())
+        self.assertEquals(
+            [
+                child.basename() for child in storage.path.children()
+                if child.basename().endswith(".etag")
+            ],
+            []
+        )
+
+
+    def test_loaded(self):
+        """
+        A new store gets etags from the manifest without reading
+        incidents.
+        """
+        path = FilePath(self.mktemp())
+        storage = Storage(path)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        etag = storage.etag_for_incident_with_number(1)
+        storage.close()
+
+        storage = Storage(path)
+        storage.provision()
+        storage.read_incident_with_number_raw = lambda number: self.fail("Read incident")
+
+        self.assertEquals(list(storage.list_incidents()), [(1, etag)])
+
+
+    def test_legacy(self):
+        """
+        Etags for incidents missing from the manifest are computed from
+        the incident.
+        """
+        path = FilePath(self.mktemp())
+        path.createDirectory()
+        path.child("1").setContent(incident1_text)
+
+        storage = Storage(path)
+        storage.provision()
+
+        self.assertEquals(
+            storage.etag_for_incident_with_number(1),
+            sha1(incident1_text).hexdigest()
+        )
@@ -0,0 +1,331 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.replication}.
+"""
+
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.protocol import Factory
+from twisted.internet.task import Clock, deferLater
+from twisted.test.proto_helpers import StringTransport
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.store import Storage
+from ims.asyncstore import AsyncStorage
+from ims.replication import WriteStream, ReplicationSource, Follower
+from ims.replication import SourceProtocol
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+class WriteStreamTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.replication.WriteStream}
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = Storage(
+            FilePath(self.mktemp()), journal=True, reactor=self.clock
+        )
+        self.storage.provision()
+        self.addCleanup(self.storage.close)
+
+
+    def write(self, text, number):
+        self.storage.write_incident(Incident.from_json_text(text, number))
+
+
+    def test_durable(self):
+        """
+        Writes are added to the stream once they are durable.
+        """
+        stream = WriteStream(self.storage, reactor=self.clock)
+
+        self.write(incident1_text, 1)
+        self.assertEquals(stream.sequence, 0)
+
+        self.clock.advance(1)
+
+        self.assertEquals(stream.sequence, 1)
+        [(sequence, time, number, json)] = stream.since(0)
+        self.assertEquals((sequence, time, number), (1, 1, 1))
+        self.assertEquals(json, self.storage.read_incident_with_number_raw(1))
+
+
+    def test_since(self):
+        """
+        The writes since a given one can be looked up while they are in
+        the backlog.
+        """
+        stream = WriteStream(self.storage, backlog=2, reactor=self.clock)
+
+        for _ in xrange(3):
+            self.write(incident1_text, 1)
+            self.clock.advance(0)
+
+        self.assertEquals(stream.since(0), None)
+        self.assertEquals([r[0] for r in stream.since(1)], [2, 3])
+        self.assertEquals(stream.since(3), [])
+        self.assertEquals(stream.since(4), None)
+
+
+
+class ReplicationSourceTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.replication.ReplicationSource}
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = Storage(FilePath(self.mktemp()))
+        self.storage.provision()
+        self.source = ReplicationSource(
+            WriteStream(self.storage, reactor=self.clock),
+            FilePath("primary.sock"), reactor=self.clock,
+        )
+        # Followers are connected by hand, without listening.
+        self.source.stream.observers.append(self.source._wrote)
+
+
+    def write(self, text, number):
+        self.storage.write_incident(Incident.from_json_text(text, number))
+
+
+    def follow(self, epoch, sequence):
+        factory = Factory()
+        factory.protocol = SourceProtocol
+        factory.source = self.source
+
+        transport = StringTransport()
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(transport)
+        protocol.dataReceived("follow {0} {1}\n".format(epoch, sequence))
+        return transport
+
+
+    def test_snapshot(self):
+        """
+        A snapshot is sent as the follower's connection takes it, followed
+        by the writes made meanwhile.
+        """
+        self.write(incident1_text, 1)
+        self.write(incident2_text, 2)
+
+        transport = self.follow("-", 0)
+        epoch = self.source.stream.epoch
+
+        self.assertEquals(transport.value(), "snapshot {0} 2\n".format(epoch))
+        self.assertTrue(transport.streaming)
+
+        transport.producer.pauseProducing()
+        self.write(incident2_text, 2)
+        self.clock.advance(1)
+
+        self.assertEquals(transport.value(), "snapshot {0} 2\n".format(epoch))
+
+        transport.producer.resumeProducing()
+        for _ in xrange(10):
+            self.clock.advance(0)
+
+        self.assertEquals(
+            [line.split(" ")[:2] for line in transport.value().splitlines()],
+            [
+                ["snapshot", epoch],
+                ["incident", "1"],
+                ["incident", "2"],
+                ["end", "2"],
+                ["write", "3"],
+            ]
+        )
+        self.assertIdentical(transport.producer, None)
+
+
+
+class FollowerTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.replication.Follower}
+    """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.storage = Storage(FilePath(self.mktemp()))
+        self.storage.provision()
+        self.follower = Follower(
+            AsyncStorage(self.storage, pool_size=0, reactor=self.clock),
+            FilePath("primary.sock"), reactor=self.clock,
+        )
+
+
+    def receive(self, *lines):
+        for line in lines:
+            self.follower.received(line)
+
+
+    def incident_text(self, text, number):
+        return Incident.from_json_text(text, number).to_json_text()
+
+
+    def test_snapshot(self):
+        """
+        A follower applies a snapshot, after which it is at the snapshot's
+        epoch and sequence.
+        """
+        self.receive(
+            "snapshot e1 5",
+            "incident 1 " + self.incident_text(incident1_text, 1),
+            "incident 2 " + self.incident_text(incident2_text, 2),
+            "end 5",
+        )
+
+        self.assertEquals(
+            self.storage.read_incident_with_number(2),
+            Incident.from_json_text(incident2_text, 2),
+        )
+        self.assertEquals(self.follower.epoch, "e1")
+        self.assertEquals(self.follower.sequence, 5)
+
+
+    def test_writes(self):
+        """
+        A follower applies writes, keeping track of how far behind it is.
+        """
+        self.receive("snapshot e1 0", "end 0", "sequence 2 10.0")
+        self.assertEquals(self.follower.lag(), (2, None))
+
+        self.receive(
+            "write 1 11.0 1 " + self.incident_text(incident1_text, 1),
+            "write 2 12.0 2 " + self.incident_text(incident2_text, 2),
+        )
+        self.clock.advance(13)
+
+        self.assertEquals(self.follower.sequence, 2)
+        self.assertEquals(self.follower.lag(), (0, 1.0))
+        self.assertEquals(
+            self.storage.read_incident_with_number(1),
+            Incident.from_json_text(incident1_text, 1),
+        )
+
+        self.receive("sequence 3 14.0")
+        self.clock.advance(2)
+
+        self.assertEquals(self.follower.lag(), (1, 3.0))
+
+
+    def test_new_epoch(self):
+        """
+        A follower starts counting writes again when it is sent a snapshot
+        of a new stream.
+        """
+        self.receive("snapshot e1 0", "end 0", "sequence 7 1.0")
+        self.receive("snapshot e2 3", "end 3")
+
+        self.assertEquals(self.follower.epoch, "e2")
+        self.assertEquals(self.follower.lag()[0], 0)
+
+
+    def test_invalid(self):
+        """
+        Invalid lines are disregarded.
+        """
+        self.receive("write x", "incident 1 {}", "bogus")
+
+        self.assertEquals(self.follower.sequence, 0)
+        self.assertEquals(list(self.storage.list_incidents()), [])
+
+
+
+class ReplicationTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for replication from a L{ims.replication.ReplicationSource} to a
+    L{ims.replication.Follower} over a UNIX socket.
+    """
+
+    def setUp(self):
+        # Socket paths must be short.
+        self.temp = mkdtemp()
+        self.socket = FilePath(self.temp).child("primary.sock")
+
+        self.primary = Storage(FilePath(self.mktemp()))
+        self.primary.provision()
+        self.source = ReplicationSource(
+            WriteStream(self.primary), self.socket
+        )
+
+        self.secondary = Storage(FilePath(self.mktemp()))
+        self.secondary.provision()
+        self.follower = Follower(
+            AsyncStorage(self.secondary, pool_size=0), self.socket
+        )
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        self.follower.stop()
+        yield self.source.stop()
+        yield self.wait_for(
+            lambda: not self.follower.connected and not self.source.followers
+        )
+        rmtree(self.temp)
+
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        for _ in xrange(100):
+            if condition():
+                return
+            yield deferLater(reactor, 0.02, lambda: None)
+        self.fail("Timed out")
+
+
+    @inlineCallbacks
+    def test_replicate(self):
+        """
+        A follower is sent the incidents in the primary's store, then
+        each write to it.
+        """
+        self.primary.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        self.source.start()
+        self.follower.start()
+
+        yield self.wait_for(lambda: self.follower.epoch is not None)
+
+        self.assertEquals(
+            self.secondary.read_incident_with_number(1),
+            self.primary.read_incident_with_number(1),
+        )
+
+        self.primary.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        yield self.wait_for(lambda: self.follower.sequence == 2)
+
+        self.assertEquals(
+            self.secondary.read_incident_with_number(2),
+            self.primary.read_incident_with_number(2),
+        )
+        self.assertEquals(
+            self.secondary.etag_for_incident_with_number(2),
+            self.primary.etag_for_incident_with_number(2),
+        )
+        self.assertEquals(self.source.status()["followers"], 1)
@@ -0,0 +1,262 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.search}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import JSON, Incident
+from ims.search import TrigramIndex, IncidentIndexes
+from ims.search import incident_matches_terms, incident_state
+from ims.store import Storage
+from ims.test.test_data import incident1_text, incident2_text
+from ims.test.test_store import StorageTests
+
+
+
+class TrigramIndexTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.search.TrigramIndex}
+    """
+
+    def setUp(self):
+        self.incidents = [
+            Incident.from_json_text(incident1_text, 1),
+            Incident.from_json_text(incident2_text, 2),
+        ]
+        self.index = TrigramIndex()
+        for incident in self.incidents:
+            self.index.add(incident)
+
+
+    def test_matches_brute_force(self):
+        """
+        L{ims.search.TrigramIndex.search} finds the same incidents as
+        L{ims.search.incident_matches_terms}.
+        """
+        for terms in (
+            (u"spire",), (u"SPIRE",), (u"man",), (u"ma",), (u"",),
+            (u"man", u"lefty"), (u"tulsa", u"code 4"), (u"no such thing",),
+            (u"vehicle",), (u"near the man",), (u"e",), (u"nt:",),
+        ):
+            self.assertEquals(
+                self.index.search(terms),
+                set(
+                    incident.number for incident in self.incidents
+                    if incident_matches_terms(incident, terms)
+                ),
+                terms
+            )
+
+
+    def test_within_one_string(self):
+        """
+        A term does not match across the boundary between two strings.
+        """
+        # The summary of incident 2 ends with "Man" and its location name
+        # starts with "The".
+        self.assertEquals(self.index.search((u"manthe",)), set())
+
+
+    def test_replace(self):
+        """
+        Adding an incident again replaces its prior index entries.
+        """
+        incident = self.incidents[0]
+        incident.summary = u"Replaced"
+        self.index.add(incident)
+
+        self.assertEquals(self.index.search((u"out spire",)), set())
+        self.assertEquals(self.index.search((u"replaced",)), set((1,)))
+
+
+    def test_remove(self):
+        """
+        Removed incidents are not found, and leave no trigrams behind.
+        """
+        for incident in self.incidents:
+            self.index.remove(incident.number)
+
+        self.assertEquals(self.index.search((u"man",)), set())
+        self.assertEquals(self.index._postings, {})
+
+
+    def test_missing_fields(self):
+        """
+        Incidents without incident types, location or report entries are
+        indexed by the strings they have.
+        """
+        incident = Incident.from_json_text(
+            u'{"number": 3, "summary": "Lost keys", "ranger_handles": []}', 3
+        )
+        incident.validate()
+        self.assertEquals(incident.incident_types, None)
+
+        self.index.add(incident)
+
+        self.assertEquals(self.index.search((u"keys",)), set((3,)))
+        self.assertTrue(incident_matches_terms(incident, (u"lost",)))
+
+
+
+class IncidentIndexesTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.search.IncidentIndexes}
+    """
+
+    def setUp(self):
+        self.incident1 = Incident.from_json_text(incident1_text, 1)
+        self.incident2 = Incident.from_json_text(incident2_text, 2)
+        self.incident2.closed = None
+        self.incident3 = Incident(number=3, rangers=())
+
+        self.indexes = IncidentIndexes()
+        for incident in (self.incident1, self.incident2, self.incident3):
+            self.indexes.add(incident)
+
+
+    def test_query_state(self):
+        """
+        Incidents are indexed by state.
+        """
+        self.assertEquals(self.indexes.query(states=(JSON.closed,)), set((1,)))
+        self.assertEquals(self.indexes.query(states=(JSON.on_scene,)), set((2,)))
+        self.assertEquals(self.indexes.query(states=(JSON.created,)), set((3,)))
+        self.assertEquals(self.indexes.open_incidents(), set((2, 3)))
+
+
+    def test_query_ranger(self):
+        """
+        Incidents are indexed by Ranger handle.
+        """
+        self.assertEquals(self.indexes.query(ranger_handle=u"Tulsa"), set((1,)))
+        self.assertEquals(self.indexes.query(ranger_handle=u"Nobody"), set())
+
+
+    def test_query_incident_type(self):
+        """
+        Incidents are indexed by incident type.
+        """
+        self.assertEquals(self.indexes.query(incident_type=u"Admin"), set((2,)))
+
+
+    def test_query_location(self):
+        """
+        Incidents are indexed by location name.
+        """
+        self.assertEquals(self.indexes.query(location_name=u"The Man"), set((2,)))
+
+
+    def test_query_combined(self):
+        """
+        Queries with several criteria find incidents matching all of
+        them.
+        """
+        self.assertEquals(
+            self.indexes.query(
+                states=(JSON.closed, JSON.on_scene), incident_type=u"Vehicle"
+            ),
+            set((1,))
+        )
+        self.assertEquals(self.indexes.query(), set((1, 2, 3)))
+
+
+    def test_update(self):
+        """
+        Adding an incident again replaces its prior index entries.
+        """
+        self.incident1.closed = None
+        self.incident1.rangers = []
+        self.indexes.add(self.incident1)
+
+        self.assertEquals(self.indexes.query(states=(JSON.closed,)), set())
+        self.assertEquals(self.indexes.query(ranger_handle=u"Tulsa"), set())
+
+
+    def test_incident_state(self):
+        """
+        L{ims.search.incident_state} is the latest state with a time.
+        """
+        self.assertIdentical(incident_state(self.incident1), JSON.closed)
+        self.assertIdentical(incident_state(self.incident2), JSON.on_scene)
+        self.assertIdentical(incident_state(self.incident3), JSON.created)
+
+
+
+class IndexedStorageTests(StorageTests):
+    """
+    Tests for L{ims.store.Storage} with search and secondary indexes.
+    """
+
+    def storage(self, **kwargs):
+        return StorageTests.storage(
+            self, search_index=True, secondary_indexes=True, **kwargs
+        )
+
+
+    def test_search_skips_closed(self):
+        """
+        L{ims.store.Storage.search_incidents} does not read closed
+        incidents when they are not wanted.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        incident = Incident.from_json_text(incident2_text, 2)
+        incident.closed = None
+        storage.write_incident(incident)
+
+        read = []
+        storage.read_incident_with_number = read.append
+
+        self.assertEquals(
+            [number for number, etag in storage.search_incidents((u"man",))],
+            [2]
+        )
+        self.assertEquals(read, [])
+
+
+    def test_query_incidents(self):
+        """
+        L{ims.store.Storage.query_incidents} finds incidents using the
+        secondary indexes.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        self.assertEquals(
+            [number for number, etag in storage.query_incidents(ranger_handle=u"Lefty")],
+            [2]
+        )
+
+
+    def test_index_at_provision(self):
+        """
+        Incidents already in the store are indexed when it is
+        provisioned.
+        """
+        path = FilePath(self.mktemp())
+        storage = Storage(path)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        storage = Storage(path, search_index=True, secondary_indexes=True)
+        storage.provision()
+
+        self.assertIn(1, storage.search_index)
+        self.assertIn(1, storage.indexes)
@@ -0,0 +1,243 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.sharedcache}.
+"""
+
+import os
+import struct
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.store import Storage, NoSuchIncidentError
+from ims.sharedcache import SharedIncidentCache
+from ims.test.test_data import incident1_text
+
+
+
+class SharedIncidentCacheTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.sharedcache.SharedIncidentCache}
+    """
+
+    def setUp(self):
+        self.fp = FilePath(self.mktemp())
+        self.cache = self.open()
+
+
+    def open(self):
+        cache = SharedIncidentCache(self.fp, slots=4, slot_size=256)
+        cache.open()
+        self.addCleanup(cache.close)
+        return cache
+
+
+    def test_get(self):
+        """
+        A cached incident's generation, etag and text can be looked up.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+
+        self.assertEquals(self.cache.get(1), (7, "etag1", "text1"))
+        self.assertEquals(self.cache.get(2), None)
+
+
+    def test_empty(self):
+        """
+        Empty and discarded slots don't hold incident 0.
+        """
+        for number in xrange(4):
+            self.assertEquals(self.cache.get(number), None)
+
+        self.cache.put(0, 7, "etag0", "text0")
+        self.assertEquals(self.cache.get(0), (7, "etag0", "text0"))
+        self.assertEquals(self.cache.get(4), None)
+
+        self.cache.put(4, 7, "etag4", "text4")
+        self.cache.discard(4)
+        self.assertEquals(self.cache.get(0), None)
+        self.assertEquals(self.cache.get(4), None)
+
+
+    def test_slot_taken(self):
+        """
+        An incident is evicted by the next incident cached in its slot.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+        self.cache.put(5, 7, "etag5", "text5")
+
+        self.assertEquals(self.cache.get(1), None)
+        self.assertEquals(self.cache.get(5), (7, "etag5", "text5"))
+
+
+    def test_too_long(self):
+        """
+        Incidents too long for a slot are not cached, and evict what was
+        cached for them.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+
+        self.assertFalse(self.cache.put(1, 8, "etag1", "x" * 256))
+        self.assertEquals(self.cache.get(1), None)
+
+
+    def test_discard(self):
+        """
+        Incidents are discarded unless they have the generation to keep.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+
+        self.cache.discard(1, keep_generation=7)
+        self.assertNotEquals(self.cache.get(1), None)
+
+        self.cache.discard(1, keep_generation=8)
+        self.assertEquals(self.cache.get(1), None)
+
+
+    def test_being_written(self):
+        """
+        A slot which is being written is not read.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+
+        offset = self.cache._slot_offset(1)
+        sequence = struct.unpack_from("<I", self.cache._map, offset)[0]
+
+        struct.pack_into("<I", self.cache._map, offset, sequence + 1)
+        self.assertEquals(self.cache.get(1), None)
+
+        struct.pack_into("<I", self.cache._map, offset, sequence + 2)
+        self.assertEquals(self.cache.get(1), (7, "etag1", "text1"))
+
+
+    def test_first_clears(self):
+        """
+        The first process to open the cache clears it.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+        self.cache.close()
+
+        self.assertEquals(self.open().get(1), None)
+
+
+    def test_shared(self):
+        """
+        Incidents cached by one process can be read by another.
+        """
+        self.cache.put(1, 7, "etag1", "text1")
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache = SharedIncidentCache(self.fp, slots=4, slot_size=256)
+                cache.open()
+                os._exit(0 if cache.get(1) == (7, "etag1", "text1") else 1)
+            finally:
+                os._exit(2)
+
+        pid, status = os.waitpid(pid, 0)
+        self.assertEquals(os.WEXITSTATUS(status), 0)
+
+
+
+class SharedStorageCacheTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage} with a shared cache.
+    """
+
+    def setUp(self):
+        path = FilePath(self.mktemp())
+        self.writer = self.storage(path)
+        self.reader = self.storage(path)
+
+
+    def storage(self, path):
+        storage = Storage(path, shared=True)
+        storage.provision()
+        storage.track_writes()
+        self.addCleanup(storage.close)
+        return storage
+
+
+    def no_reads(self, number):
+        self.fail("Read incident {0} from disk".format(number))
+
+
+    def test_write_visible(self):
+        """
+        An incident written by one process can be read by another from
+        the shared cache.
+        """
+        self.writer.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        self.reader.read_stored_incident_raw = self.no_reads
+
+        self.assertEquals(
+            self.reader.read_incident_with_number(1),
+            self.writer.read_incident_with_number(1),
+        )
+        self.assertEquals(
+            self.reader.etag_for_incident_with_number(1),
+            self.writer.etag_for_incident_with_number(1),
+        )
+
+
+    def test_no_incident_0(self):
+        """
+        Incident 0, which is never cached, doesn't exist.
+        """
+        self.assertRaises(
+            NoSuchIncidentError, self.reader.read_incident_with_number_raw, 0
+        )
+        self.assertRaises(
+            NoSuchIncidentError,
+            self.reader.etag_for_incident_with_number, 0
+        )
+        self.assertIdentical(self.reader.incident_etags.get(0), None)
+
+
+    def test_write_noticed(self):
+        """
+        When a process notices another's write, the incident stays in the
+        shared cache.
+        """
+        self.writer.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        self.reader.read_stored_incident_raw = self.no_reads
+
+        self.assertEquals(
+            self.reader.file_changed(self.reader.path.child("1")), 1
+        )
+        self.assertNotEquals(self.reader.shared_cache.get(1), None)
+
+
+    def test_external_change(self):
+        """
+        An incident changed by another program is dropped from the shared
+        cache and re-read.
+        """
+        self.writer.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        fp = self.reader.path.child("1")
+        fp.setContent(fp.getContent().replace("Knocked out spire", "Fixed"))
+
+        self.assertEquals(self.reader.file_changed(fp), 1)
+        self.assertEquals(
+            self.writer.read_incident_with_number(1).summary, "Fixed"
+        )
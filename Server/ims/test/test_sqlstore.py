@@ -0,0 +1,161 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.sqlstore}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident, InvalidDataError
+from ims.store import Storage, NoSuchIncidentError
+from ims.sqlstore import SQLiteStorage
+from ims.test.test_store import StorageAPITestsMixin
+from ims.test.test_data import incident1_text, incident2_text
+from ims.test.test_journal import FakeThreadPool, ThreadedClock
+
+
+
+class SQLiteStorageTests(StorageAPITestsMixin, twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.sqlstore.SQLiteStorage}
+    """
+
+    def storage(self, **kwargs):
+        storage = SQLiteStorage(
+            FilePath(self.mktemp()).child("incidents.sqlite"), **kwargs
+        )
+        storage.provision()
+        self.addCleanup(storage.close)
+        return storage
+
+
+    def test_reopen(self):
+        """
+        Incidents and incident number allocation persist when the
+        database is reopened.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+        self.assertEquals(storage.next_incident_number(), 2)
+        storage.close()
+
+        storage = SQLiteStorage(storage.path)
+        self.addCleanup(storage.close)
+
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+        self.assertEquals(storage.next_incident_number(), 3)
+
+
+    def test_write_rolled_back(self):
+        """
+        Incidents in a batch which fails to be written aren't cached.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+        storage.read_incident_with_number(1)
+
+        changed = Incident.from_json_text(incident1_text, 1)
+        changed.summary = u"Changed"
+        invalid = Incident.from_json_text(incident2_text, 2)
+        invalid.priority = 9
+
+        self.assertRaises(
+            InvalidDataError, storage.write_incidents, (changed, invalid)
+        )
+
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+        self.assertRaises(
+            NoSuchIncidentError, storage.read_incident_with_number, 2
+        )
+
+
+    def test_write_in_thread(self):
+        """
+        With a thread pool, incidents are written in one of its threads,
+        and cached once they are.
+        """
+        storage = self.storage(reactor=ThreadedClock())
+        storage.threadpool = threadpool = FakeThreadPool()
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        results = []
+        storage.write_incident(incident).addCallback(results.append)
+
+        self.assertEquals(results, [])
+        self.assertRaises(
+            NoSuchIncidentError, storage.read_incident_with_number_raw, 1
+        )
+
+        threadpool.run()
+
+        self.assertEquals(len(results), 1)
+        self.assertIn(1, storage.incident_cache)
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_wal(self):
+        """
+        The database uses write-ahead logging.
+        """
+        storage = self.storage()
+
+        (mode,) = storage.db.execute("pragma journal_mode").fetchone()
+
+        self.assertEquals(mode, "wal")
+
+
+    def test_search_open_only(self):
+        """
+        L{ims.sqlstore.SQLiteStorage.search_incidents} omits closed
+        incidents unless asked not to.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.closed = None
+        storage.write_incident(incident)
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        self.assertEquals(
+            [number for number, etag in storage.search_incidents()],
+            [1]
+        )
+
+
+    def test_import_files(self):
+        """
+        L{ims.sqlstore.SQLiteStorage.import_incidents} rebuilds the
+        database from a directory of incident files.
+        """
+        source = Storage(FilePath(self.mktemp()))
+        source.write_incident(Incident.from_json_text(incident1_text, 1))
+        source.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        storage = self.storage()
+        storage.import_incidents(source)
+
+        for number in (1, 2):
+            self.assertEquals(
+                storage.read_incident_with_number(number),
+                source.read_incident_with_number(number)
+            )
+            self.assertEquals(
+                storage.etag_for_incident_with_number(number),
+                source.etag_for_incident_with_number(number)
+            )
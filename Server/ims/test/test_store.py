@@ -0,0 +1,788 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.store}.
+"""
+
+import os
+import zlib
+from hashlib import sha1 as etag_hash
+from datetime import datetime
+
+from twisted.python.filepath import FilePath
+from twisted.internet.task import Clock
+import twisted.trial.unittest
+
+from ims.data import Incident, ReportEntry, Location, InvalidDataError
+from ims.store import Storage, IncidentCache
+from ims.store import StorageError, NoSuchIncidentError
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+def unstamped(data):
+    """
+    @return: the contents of an incident file without its stamp, which
+        it must have.
+    """
+    assert data.startswith(Storage.stamp_header), data
+    return data[data.index("\x00") + 1:]
+
+
+
+class StorageAPITestsMixin(object):
+    """
+    Tests for the storage API, shared by all storage back-ends.
+
+    Subclasses must implement C{storage(**kwargs)} to return a new,
+    provisioned, empty store.
+    """
+
+
+    def test_write_read(self):
+        """
+        L{ims.store.Storage.read_incident_with_number} returns an
+        incident written with L{ims.store.Storage.write_incident}.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_read_string_number(self):
+        """
+        L{ims.store.Storage.read_incident_with_number} accepts incident
+        numbers as strings, as they come from URLs.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+
+        self.assertEquals(storage.read_incident_with_number("1"), incident)
+
+
+    def test_read_no_such_incident(self):
+        """
+        L{ims.store.Storage.read_incident_with_number} raises
+        L{NoSuchIncidentError} for unknown incidents.
+        """
+        storage = self.storage()
+
+        self.assertRaises(NoSuchIncidentError, storage.read_incident_with_number, 1)
+        self.assertRaises(NoSuchIncidentError, storage.read_incident_with_number, "x")
+
+
+    def test_next_incident_number(self):
+        """
+        L{ims.store.Storage.next_incident_number} allocates numbers past
+        existing incidents.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        self.assertEquals(storage.next_incident_number(), 3)
+        self.assertEquals(storage.next_incident_number(), 4)
+
+
+    def test_list_incidents(self):
+        """
+        L{ims.store.Storage.list_incidents} yields the number of each
+        stored incident.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        self.assertEquals(
+            sorted(number for number, etag in storage.list_incidents()),
+            [1, 2]
+        )
+
+
+    def test_search_incidents(self):
+        """
+        L{ims.store.Storage.search_incidents} matches terms case
+        insensitively.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        def search(*terms):
+            return sorted(
+                number for number, etag
+                in storage.search_incidents(terms, show_closed=True)
+            )
+
+        self.assertEquals(search(u"spire"), [1])
+        self.assertEquals(search(u"MAN"), [1, 2])
+        self.assertEquals(search(u"man", u"lefty"), [2])
+        self.assertEquals(search(u"nothing"), [])
+
+
+    def test_cache_hit(self):
+        """
+        Reading an incident a second time is served from the cache.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.incident_cache.clear()
+
+        storage.read_incident_with_number(1)
+        storage.read_incident_with_number(1)
+
+        self.assertEquals(storage.incident_cache.misses, 1)
+        self.assertEquals(storage.incident_cache.hits, 1)
+
+
+    def test_cache_write_through(self):
+        """
+        Writing an incident populates the cache.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+        self.assertEquals(storage.incident_cache.hits, 1)
+        self.assertEquals(storage.incident_cache.misses, 0)
+
+
+    def test_cache_isolation(self):
+        """
+        Modifying an incident returned from the store does not modify
+        the cached copy.
+        """
+        storage = self.storage()
+        incident = Incident.from_json_text(incident1_text, 1)
+        storage.write_incident(incident)
+
+        read = storage.read_incident_with_number(1)
+        read.summary = u"Changed"
+        read.location.name = u"Elsewhere"
+        read.report_entries.append(ReportEntry(author=u"Tool", text=u"More"))
+
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_cache_as_stored(self):
+        """
+        The cache holds incidents as they are read back from the store,
+        not as they were given to L{write_incident}.
+        """
+        storage = self.storage()
+        incident = Incident(number=1, rangers=(), incident_types=None)
+        incident.location = Location()
+        incident.report_entries = [ReportEntry(author=u"Tool", text=u"Hi")]
+        storage.write_incident(incident)
+
+        cached = storage.read_incident_with_number(1)
+        storage.incident_cache.clear()
+
+        self.assertEquals(storage.read_incident_with_number(1), cached)
+
+
+    def test_cache_disabled(self):
+        """
+        A cache size of C{0} disables caching.
+        """
+        storage = self.storage(cache_size=0)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        storage.read_incident_with_number(1)
+        storage.read_incident_with_number(1)
+
+        self.assertEquals(len(storage.incident_cache), 0)
+        self.assertEquals(storage.incident_cache.hits, 0)
+
+
+
+class StorageTests(StorageAPITestsMixin, twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage}
+    """
+
+    def storage(self, **kwargs):
+        storage = Storage(FilePath(self.mktemp()), **kwargs)
+        storage.provision()
+        return storage
+
+
+    def test_import_incidents(self):
+        """
+        L{ims.store.Storage.import_incidents} copies incidents from
+        another store.
+        """
+        source = self.storage()
+        source.write_incident(Incident.from_json_text(incident1_text, 1))
+        source.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        storage = self.storage()
+        storage.import_incidents(source)
+
+        self.assertEquals(
+            storage.read_incident_with_number(2),
+            source.read_incident_with_number(2)
+        )
+        self.assertEquals(storage.next_incident_number(), 3)
+
+
+    def test_stamped(self):
+        """
+        Incidents are stamped as current as they are written, and read
+        without being validated.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        json, current = storage.read_incident_with_number_stamped_raw(1)
+        self.assertTrue(current)
+        self.assertEquals(
+            json, Incident.from_json_text(incident1_text, 1).to_json_text()
+        )
+
+        # Trusted, so not validated
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.priority = 9
+        storage.layout.fp(1).setContent(
+            storage._encode(incident.to_json_text(), stamp=True)
+        )
+        storage.incident_cache.clear()
+        self.assertEquals(storage.read_incident_with_number(1).priority, 9)
+
+
+    def test_not_stamped(self):
+        """
+        Incidents which aren't stamped, are stamped with other versions or
+        don't match their stamps aren't current, and are validated.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.priority = 9
+        json = incident.to_json_text()
+        changed = json.replace("Tool", "Hammer")
+
+        for data in (
+            json,
+            storage._stamp(json).replace(storage.version_stamp, "0.1") + json,
+            storage._stamp(json) + changed,
+        ):
+            storage.layout.fp(1).setContent(data)
+            storage.incident_cache.clear()
+            self.assertFalse(storage.read_incident_with_number_stamped_raw(1)[1])
+            self.assertRaises(
+                InvalidDataError, storage.read_incident_with_number, 1
+            )
+
+
+    def test_upgrade(self, processes=0):
+        """
+        L{ims.store.Storage.upgrade_incidents} rewrites valid incidents
+        which aren't current, stamped.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+        storage.layout.fp(1).setContent(incident1_text)
+        storage.layout.fp(3).setContent('{"priority": 9}')
+
+        upgraded, errors = storage.upgrade_incidents(processes)
+        self.assertEquals((upgraded, errors.keys()), (1, [3]))
+
+        self.assertEquals(
+            storage.read_incident_with_number_stamped_raw(1),
+            (Incident.from_json_text(incident1_text, 1).to_json_text(), True)
+        )
+        self.assertEquals(storage.upgrade_incidents(processes)[0], 0)
+
+
+    def test_upgrade_parallel(self):
+        """
+        L{ims.store.Storage.upgrade_incidents} reads incidents in a pool of
+        processes if asked to.
+        """
+        return self.test_upgrade(processes=2)
+
+
+
+class EntryLogStorageTests(StorageTests):
+    """
+    Tests for L{ims.store.Storage} with report entry logs.
+    """
+
+    def storage(self, **kwargs):
+        kwargs.setdefault("entry_log", True)
+        return StorageTests.storage(self, **kwargs)
+
+
+    def add_entry(self, storage, number, text):
+        incident = storage.read_incident_with_number(number)
+        incident.report_entries.append(
+            ReportEntry(u"Tool", text, created=datetime(2013, 3, 22))
+        )
+        storage.write_incident(incident)
+        return incident
+
+
+    def test_write_split(self):
+        """
+        An incident's header fields and report entries are written to
+        separate files.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        header = Incident.from_json_text(
+            unstamped(storage.path.child("1").getContent()), 1
+        )
+        self.assertEquals(header.report_entries, [])
+        self.assertEquals(
+            len(storage.path.child(".1.entries").getContent().splitlines()), 4
+        )
+
+
+    def test_append(self):
+        """
+        Adding a report entry appends it to the incident's entry log and
+        leaves its header alone.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        header_fp = storage.path.child("1")
+        header_fp.setContent(header_fp.getContent() + " ")
+        log = storage.path.child(".1.entries").getContent()
+
+        incident = self.add_entry(storage, 1, u"More")
+
+        self.assertTrue(header_fp.getContent().endswith(" "))
+        self.assertTrue(
+            storage.path.child(".1.entries").getContent().startswith(log)
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_append_header_changed(self):
+        """
+        Changing an incident's header fields along with adding a report
+        entry replaces its header and appends to its entry log.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        log = storage.path.child(".1.entries").getContent()
+
+        incident = storage.read_incident_with_number(1)
+        incident.summary = u"Spire down"
+        incident.report_entries.append(
+            ReportEntry(u"Tool", u"More", created=datetime(2013, 3, 22))
+        )
+        storage.write_incident(incident)
+
+        self.assertEquals(
+            Incident.from_json_text(
+                unstamped(storage.path.child("1").getContent()), 1
+            ).summary,
+            u"Spire down"
+        )
+        self.assertTrue(
+            storage.path.child(".1.entries").getContent().startswith(log)
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_rewrite(self):
+        """
+        Removing a report entry rewrites the incident's entry log.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        incident = storage.read_incident_with_number(1)
+        del incident.report_entries[0]
+        storage.write_incident(incident)
+
+        self.assertEquals(
+            len(storage.path.child(".1.entries").getContent().splitlines()), 3
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_convert(self):
+        """
+        An incident file written without an entry log is read as is, and
+        converted when the incident is next written.
+        """
+        storage = self.storage()
+        storage.layout.fp(1).setContent(incident1_text)
+
+        incident = storage.read_incident_with_number(1)
+        self.assertEquals(len(incident.report_entries), 4)
+
+        incident = self.add_entry(storage, 1, u"More")
+
+        self.assertEquals(
+            len(storage.path.child(".1.entries").getContent().splitlines()), 5
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_disabled(self):
+        """
+        Incidents written with an entry log are read, and merged when
+        written, by a store without one.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        incident = self.add_entry(storage, 1, u"More")
+        storage.close()
+
+        storage = Storage(storage.path)
+        storage.provision()
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+        storage.write_incident(incident)
+        self.assertFalse(storage.path.child(".1.entries").exists())
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+    def test_torn_entry(self):
+        """
+        An incomplete last line in an entry log is ignored.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        log_fp = storage.path.child(".1.entries")
+        log_fp.setContent(log_fp.getContent() + '{"author": "To')
+
+        self.assertEquals(
+            storage.read_incident_with_number(1),
+            Incident.from_json_text(incident1_text, 1),
+        )
+
+
+    def test_replay(self):
+        """
+        Replaying journaled appends doesn't duplicate report entries.
+        """
+        storage = self.storage(journal=True)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        incident = self.add_entry(storage, 1, u"More")
+        storage.journal.commit(threaded=False)
+
+        # Simulate a crash before the journal was checkpointed.
+        journal = storage.journal.fp.getContent()
+        storage.close()
+        storage.journal.fp.setContent(journal)
+
+        storage = Storage(storage.path, journal=True, entry_log=True)
+        storage.provision()
+
+        self.assertEquals(
+            len(storage.path.child(".1.entries").getContent().splitlines()), 5
+        )
+        self.assertEquals(storage.read_incident_with_number(1), incident)
+
+
+
+class CompressedStorageTests(StorageTests):
+    """
+    Tests for L{ims.store.Storage} with compression.
+    """
+
+    def storage(self, **kwargs):
+        kwargs.setdefault("compress", True)
+        return StorageTests.storage(self, **kwargs)
+
+
+    def test_write_compressed(self):
+        """
+        Incident files are written compressed.
+        """
+        storage = self.storage()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        data = unstamped(storage.path.child("1").getContent())
+
+        self.assertTrue(data.startswith(Storage.compressed_header))
+        self.assertEquals(
+            Incident.from_json_text(
+                zlib.decompress(data[len(Storage.compressed_header):]), 1
+            ),
+            Incident.from_json_text(incident1_text, 1),
+        )
+
+
+    def test_read_uncompressed(self):
+        """
+        Incident files which are not compressed are read.
+        """
+        storage = self.storage()
+        storage.layout.fp(1).setContent(incident1_text)
+
+        self.assertEquals(storage.read_incident_with_number_raw(1), incident1_text)
+
+
+    def test_read_corrupt(self):
+        """
+        Reading a compressed incident file which can't be decompressed
+        fails with L{StorageError}.
+        """
+        storage = self.storage()
+        storage.layout.fp(1).setContent(Storage.compressed_header + "{}")
+
+        self.assertRaises(StorageError, storage.read_incident_with_number, 1)
+
+
+    def test_entry_log(self):
+        """
+        An incident's header is compressed and its entry log is not.
+        """
+        storage = self.storage(entry_log=True)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        self.assertTrue(
+            unstamped(storage.path.child("1").getContent())
+            .startswith(Storage.compressed_header)
+        )
+        self.assertTrue(
+            storage.path.child(".1.entries").getContent().startswith("{")
+        )
+        self.assertEquals(
+            storage.read_incident_with_number(1),
+            Incident.from_json_text(incident1_text, 1),
+        )
+
+
+    def test_recompress(self):
+        """
+        L{ims.store.Storage.recompress_incidents} rewrites incident files
+        which aren't compressed as asked.
+        """
+        storage = self.storage(compress=False)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+
+        storage.compress = True
+        self.assertEquals(storage.recompress_incidents(), 2)
+        self.assertEquals(storage.recompress_incidents(), 0)
+        self.assertTrue(
+            unstamped(storage.path.child("2").getContent())
+            .startswith(Storage.compressed_header)
+        )
+
+        self.assertEquals(storage.recompress_incidents(compress=False), 2)
+        self.assertEquals(
+            storage.read_incident_with_number_stamped_raw(2),
+            (unstamped(storage.path.child("2").getContent()), True)
+        )
+
+
+
+class HistoryStorageTests(StorageTests):
+    """
+    Tests for L{ims.store.Storage} with incident history.
+    """
+
+    def storage(self, **kwargs):
+        self.clock = Clock()
+        self.clock.advance(1377691200) # 2013-08-28T12:00:00Z
+        kwargs.setdefault("history", True)
+        kwargs.setdefault("history_keyframe_interval", 3)
+        kwargs.setdefault("reactor", self.clock)
+        return StorageTests.storage(self, **kwargs)
+
+
+    def revise(self, storage, count):
+        """
+        Write an incident, then add a report entry and change its summary
+        C{count - 1} times, a minute apart.
+
+        @return: the revisions written.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        revisions = []
+        for n in xrange(count):
+            if n:
+                self.clock.advance(60)
+                incident = incident.copy()
+                incident.summary = u"Revision {0}".format(n + 1)
+                incident.report_entries.append(
+                    ReportEntry(u"Tool", u"Entry {0}".format(n), created=datetime(2013, 8, 28, 12, n))
+                )
+            storage.write_incident(incident)
+            revisions.append(storage.read_incident_with_number(1))
+        return revisions
+
+
+    def as_of(self, storage, minute):
+        return Incident.from_json_text(
+            storage.read_incident_as_of_raw(1, datetime(2013, 8, 28, 12, minute)), 1
+        )
+
+
+    def test_history(self):
+        """
+        Each revision of an incident is listed in its history, with the
+        time it was written.
+        """
+        storage = self.storage()
+        revisions = self.revise(storage, 3)
+
+        self.assertEquals(
+            storage.incident_history(1),
+            [
+                (n + 1, datetime(2013, 8, 28, 12, n), etag_hash(r.to_json_text()).hexdigest())
+                for n, r in enumerate(revisions)
+            ],
+        )
+
+
+    def test_as_of(self):
+        """
+        The revision of an incident current at a given time is rebuilt
+        from its history, including revisions kept in full.
+        """
+        storage = self.storage()
+        revisions = self.revise(storage, 8)
+
+        for n, revision in enumerate(revisions):
+            self.assertEquals(self.as_of(storage, n), revision)
+
+        self.assertRaises(
+            NoSuchIncidentError, storage.read_incident_as_of_raw,
+            1, datetime(2013, 8, 28, 11, 59),
+        )
+
+
+    def test_as_of_no_time(self):
+        """
+        Asking for an incident as of no time at all, as an empty C{as_of}
+        is parsed, is an error rather than finding no revision.
+        """
+        storage = self.storage()
+        self.revise(storage, 2)
+
+        self.assertRaises(
+            InvalidDataError, storage.read_incident_as_of_raw, 1, None
+        )
+
+
+    def test_keyframes(self):
+        """
+        Every C{history_keyframe_interval}th revision is kept in full, and
+        the others as deltas.
+        """
+        storage = self.storage()
+        self.revise(storage, 8)
+
+        records = storage._history(1).records()
+        self.assertEquals(
+            [sorted(set(r) & set(("delta", "keyframe"))) for r in records],
+            [[]] + [
+                ["keyframe"] if n % 3 == 0 else ["delta"]
+                for n in xrange(1, 8)
+            ],
+        )
+
+
+    def test_entry_log(self):
+        """
+        Writes to incidents with entry logs are recorded too.
+        """
+        storage = self.storage(entry_log=True)
+        revisions = self.revise(storage, 5)
+
+        for n, revision in enumerate(revisions):
+            self.assertEquals(self.as_of(storage, n), revision)
+
+
+    def test_replayed(self):
+        """
+        A write replayed from the journal which was already recorded is
+        not recorded again.
+        """
+        storage = self.storage()
+        self.revise(storage, 3)
+        json = storage.read_incident_with_number_raw(1)
+
+        storage._replaying = True
+        storage._apply_write(1, json)
+
+        self.assertEquals(len(storage.incident_history(1)), 3)
+
+
+    def test_unrecorded(self):
+        """
+        An incident written without keeping history is recorded as the
+        first revision when next written.
+        """
+        storage = self.storage(history=False)
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        os.utime(storage.path.child("1").path, (self.clock.seconds(),) * 2)
+
+        storage.history = True
+        self.clock.advance(60)
+        incident = storage.read_incident_with_number(1).copy()
+        incident.summary = u"Revised"
+        storage.write_incident(incident)
+
+        [(first, written, etag), second] = storage.incident_history(1)
+        self.assertEquals((first, written), (1, datetime(2013, 8, 28, 12, 0)))
+        self.assertEquals(self.as_of(storage, 1).summary, u"Revised")
+        self.assertEquals(
+            Incident.from_json_text(
+                storage.read_incident_as_of_raw(1, written), 1
+            ),
+            Incident.from_json_text(incident1_text, 1),
+        )
+
+
+
+class IncidentCacheTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.IncidentCache}
+    """
+
+    def test_evict_least_recently_used(self):
+        """
+        When full, the least recently used incident is evicted.
+        """
+        cache = IncidentCache(2)
+        cache.put(Incident.from_json_text(incident1_text, 1))
+        cache.put(Incident.from_json_text(incident2_text, 2))
+
+        cache.get(1)
+        cache.put(Incident(number=3))
+
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertIn(3, cache)
+
+
+    def test_get_miss(self):
+        """
+        L{ims.store.IncidentCache.get} returns C{None} and counts a miss
+        for uncached incidents.
+        """
+        cache = IncidentCache(2)
+
+        self.assertIdentical(cache.get(1), None)
+        self.assertEquals(cache.misses, 1)
@@ -0,0 +1,226 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.sync}.
+"""
+
+from datetime import datetime
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident, ReportEntry, Location
+from ims.store import Storage
+from ims.asyncstore import AsyncStorage
+from ims.sync import SyncEngine, SyncError, merge_incidents
+
+
+
+def entry(author, minute, text):
+    return ReportEntry(author, text, datetime(2013, 8, 28, 12, minute))
+
+
+def incident(number, summary, *entries):
+    return Incident(
+        number, summary=summary, report_entries=entries,
+        location=Location(u"Camp", u"9:00 & C"),
+        created=datetime(2013, 8, 28, 12, 0),
+    )
+
+
+
+class MergeTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.sync.merge_incidents}
+    """
+
+    def test_entries(self):
+        """
+        The merged incident has every report entry in either copy, once,
+        in order of creation.
+        """
+        base = entry(u"Tool", 1, u"Reported")
+        ours = incident(1, u"Ours", base, entry(u"Tool", 3, u"Here"))
+        theirs = incident(1, u"Theirs", base, entry(u"Splinter", 2, u"There"))
+
+        merged = merge_incidents(ours, theirs, 0, 1)
+
+        self.assertEquals(
+            [e.text for e in merged.report_entries],
+            [u"Reported", u"There", u"Here"],
+        )
+        self.assertEquals(merged, merge_incidents(theirs, ours, 1, 0))
+
+
+    def test_last_writer(self):
+        """
+        Other fields are taken from the copy with the newest report entry
+        the other copy lacks.
+        """
+        base = entry(u"Tool", 1, u"Reported")
+        ours = incident(1, u"Ours", base, entry(u"Tool", 2, u"Here"))
+        theirs = incident(1, u"Theirs", base, entry(u"Splinter", 3, u"There"))
+
+        self.assertEquals(merge_incidents(ours, theirs, 1, 0).summary, u"Theirs")
+        self.assertEquals(merge_incidents(theirs, ours, 0, 1).summary, u"Theirs")
+
+
+    def test_tie(self):
+        """
+        If neither copy was edited after the other, the copy from the
+        higher-numbered site wins.
+        """
+        base = entry(u"Tool", 1, u"Reported")
+        ours = incident(1, u"Ours", base)
+        theirs = incident(1, u"Theirs", base)
+
+        self.assertEquals(merge_incidents(ours, theirs, 0, 1).summary, u"Theirs")
+        self.assertEquals(merge_incidents(ours, theirs, 1, 0).summary, u"Ours")
+
+
+
+class SyncEngineTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.sync.SyncEngine}
+    """
+
+    def setUp(self):
+        self.engines = [self.engine(site) for site in (0, 1)]
+
+
+    def engine(self, site):
+        storage = Storage(FilePath(self.mktemp()), site=site, sites=2)
+        storage.provision()
+        self.addCleanup(storage.close)
+
+        engine = SyncEngine(AsyncStorage(storage, pool_size=0), site)
+        engine.start()
+        self.addCleanup(engine.close)
+
+        return engine
+
+
+    def write(self, site, incident):
+        self.engines[site].storage.storage.write_incident(incident)
+
+
+    def read(self, site, number):
+        return self.engines[site].storage.storage.read_incident_with_number(number)
+
+
+    def sync(self, site, other):
+        """
+        Sync one site with another, as L{ims.sync.SyncClient} does.
+
+        @return: the numbers of incidents sent each way.
+        """
+        engine, other = self.engines[site], self.engines[other]
+
+        sent = engine.bundle(other.state()["vector"])
+        self.successResultOf(other.merge_bundle(sent))
+
+        received = other.bundle(sent["vector"])
+        self.successResultOf(engine.merge_bundle(received))
+
+        return (
+            [i["number"] for i in sent["incidents"]],
+            [i["number"] for i in received["incidents"]],
+        )
+
+
+    def test_versions(self):
+        """
+        Each write is given a new version at the writing site.
+        """
+        engine = self.engines[0]
+
+        self.write(0, incident(2, u"One", entry(u"Tool", 1, u"Reported")))
+        self.write(0, incident(4, u"Two", entry(u"Tool", 1, u"Reported")))
+        self.write(0, incident(2, u"Three", entry(u"Tool", 1, u"Reported")))
+
+        self.assertEquals(engine.version(2), (0, 3))
+        self.assertEquals(engine.version(4), (0, 2))
+        self.assertEquals(engine.vector, {0: 3})
+
+
+    def test_bundle(self):
+        """
+        A bundle holds the incidents changed since a sync vector.
+        """
+        engine = self.engines[0]
+
+        self.write(0, incident(2, u"One", entry(u"Tool", 1, u"Reported")))
+        self.write(0, incident(4, u"Two", entry(u"Tool", 1, u"Reported")))
+
+        self.assertEquals(
+            [i["number"] for i in engine.bundle({})["incidents"]], [2, 4]
+        )
+        self.assertEquals(
+            [i["number"] for i in engine.bundle({"0": 1})["incidents"]], [4]
+        )
+        self.assertEquals(engine.bundle({"0": 2})["incidents"], [])
+
+
+    def test_sync(self):
+        """
+        Syncing exchanges the incidents written at each site.
+        """
+        self.write(0, incident(2, u"HQ", entry(u"Tool", 1, u"Reported")))
+        self.write(1, incident(3, u"Outpost", entry(u"Splinter", 1, u"Reported")))
+
+        self.assertEquals(self.sync(1, 0), ([3], [2]))
+
+        for site in (0, 1):
+            self.assertEquals(self.read(site, 2).summary, u"HQ")
+            self.assertEquals(self.read(site, 3).summary, u"Outpost")
+
+        # Nothing is sent back.
+        self.assertEquals(self.sync(1, 0), ([], []))
+        self.assertEquals(self.sync(0, 1), ([], []))
+
+
+    def test_sync_conflict(self):
+        """
+        Incidents edited at both sites are merged, and converge.
+        """
+        base = entry(u"Tool", 1, u"Reported")
+        self.write(0, incident(2, u"Reported", base))
+        self.sync(1, 0)
+
+        self.write(0, incident(2, u"HQ", base, entry(u"Tool", 3, u"HQ")))
+        self.write(1, incident(2, u"Outpost", base, entry(u"Splinter", 2, u"Outpost")))
+
+        self.assertEquals(self.sync(1, 0), ([2], [2]))
+
+        for site in (0, 1):
+            merged = self.read(site, 2)
+            self.assertEquals(merged.summary, u"HQ")
+            self.assertEquals(
+                [e.text for e in merged.report_entries],
+                [u"Reported", u"Outpost", u"HQ"],
+            )
+
+        self.assertEquals(self.sync(1, 0), ([], []))
+        self.assertEquals(self.sync(0, 1), ([], []))
+
+
+    def test_own_bundle(self):
+        """
+        A site won't merge its own bundle.
+        """
+        engine = self.engines[0]
+        self.assertRaises(SyncError, engine.merge_bundle, engine.bundle({}))
@@ -0,0 +1,157 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.warmup}.
+"""
+
+from twisted.python.filepath import FilePath
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.store import Storage
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+class WarmUpTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for warming up L{ims.store.Storage} with L{ims.warmup}.
+    """
+
+    def setUp(self):
+        self.path = FilePath(self.mktemp())
+
+        storage = Storage(self.path, entry_log=True, compress=True)
+        storage.provision()
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.write_incident(Incident.from_json_text(incident2_text, 2))
+        storage.close()
+
+        self.path.child(".etags").remove()
+
+
+    def storage(self, **kwargs):
+        kwargs.setdefault("warm_up_processes", 2)
+        storage = Storage(self.path, **kwargs)
+        storage.provision()
+        return storage
+
+
+    def test_etags(self):
+        """
+        Etags are computed for incidents without them.
+        """
+        storage = self.storage()
+        etags = dict(storage.incident_etags.items())
+
+        self.assertEquals(
+            etags,
+            dict(Storage(self.path).list_incidents()),
+        )
+        self.assertEquals(sorted(etags), [1, 2])
+
+
+    def test_indexes(self):
+        """
+        Incidents are indexed as if read in this process.
+        """
+        storage = self.storage(search_index=True, secondary_indexes=True)
+
+        self.assertEquals(storage.search_index.search([u"spire"]), set([1]))
+        self.assertEquals(
+            storage.indexes.query(ranger_handle=u"Tulsa"), set([1])
+        )
+        self.assertEquals(storage.warm_up_errors, {})
+
+
+    def test_cache(self):
+        """
+        Incidents are cached.
+        """
+        storage = self.storage(cache_size=1)
+
+        self.assertEquals(
+            storage.read_incident_with_number(2),
+            Incident.from_json_text(incident2_text, 2),
+        )
+        self.assertEquals(storage.incident_cache.hits, 1)
+        self.assertEquals(storage.incident_cache.misses, 0)
+
+
+    def test_errors(self):
+        """
+        Incidents which can't be read are reported and left out of the
+        indexes.
+        """
+        self.path.child("3").setContent("{")
+
+        storage = self.storage(search_index=True, secondary_indexes=True)
+
+        self.assertEquals(sorted(storage.warm_up_errors), [3])
+        self.assertNotIn(3, storage.search_index)
+        self.assertNotIn(3, storage.indexes)
+
+
+    def invalid_entry(self):
+        """
+        Write an incident with an invalid report entry.
+        """
+        incident = Incident.from_json_text(incident1_text, 1)
+        incident.number = 3
+        self.path.child("3").setContent(
+            incident.to_json_text().replace(
+                '"Art car knocked out a spire at couple of posts toward '
+                'temple from the Man."',
+                '17'
+            )
+        )
+
+
+    def test_invalid_entry(self):
+        """
+        Incidents with invalid report entries are reported and left out of
+        the indexes.
+        """
+        self.invalid_entry()
+
+        for search_index in (True, False):
+            storage = self.storage(
+                search_index=search_index, secondary_indexes=True
+            )
+
+            self.assertEquals(sorted(storage.warm_up_errors), [3])
+            self.assertNotIn(3, storage.indexes)
+            self.assertEquals(
+                storage.indexes.query(ranger_handle=u"Tulsa"), set([1])
+            )
+            storage.close()
+
+
+    def test_invalid_entry_serial(self):
+        """
+        Incidents with invalid report entries are left out of indexes built
+        without warming up.
+        """
+        self.invalid_entry()
+
+        storage = self.storage(
+            warm_up_processes=0, search_index=True, secondary_indexes=True
+        )
+
+        self.assertNotIn(3, storage.search_index)
+        self.assertNotIn(3, storage.indexes)
+        self.assertEquals(storage.search_index.search([u"spire"]), set([1]))
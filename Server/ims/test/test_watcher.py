@@ -0,0 +1,172 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{ims.watcher}.
+"""
+
+from twisted.python.filepath import FilePath
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+import twisted.trial.unittest
+
+from ims.data import Incident
+from ims.store import Storage
+from ims.watcher import StorageWatcher, inotify
+from ims.test.test_data import incident1_text, incident2_text
+
+
+
+class FileChangedTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.store.Storage.file_changed}.
+    """
+
+    def setUp(self):
+        self.storage = Storage(
+            FilePath(self.mktemp()), search_index=True, secondary_indexes=True
+        )
+        self.storage.provision()
+        self.storage.track_writes()
+        self.storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        list(self.storage.list_incidents())
+
+
+    def test_own_write(self):
+        """
+        Changes made by the store itself are disregarded.
+        """
+        self.assertEquals(
+            self.storage.file_changed(self.storage.path.child("1")), None
+        )
+        self.assertIn(1, self.storage.incident_cache)
+
+
+    def test_other_files(self):
+        """
+        Changes to files which aren't incident files are disregarded.
+        """
+        for name in (".1.tmp", ".etags", "1.txt"):
+            self.storage.path.child(name).setContent("")
+            self.assertEquals(
+                self.storage.file_changed(self.storage.path.child(name)), None
+            )
+
+
+    def test_modified(self):
+        """
+        An incident changed by another process is re-read.
+        """
+        etag = self.storage.etag_for_incident_with_number(1)
+
+        fp = self.storage.path.child("1")
+        fp.setContent(fp.getContent().replace("Knocked out spire", "Fixed"))
+
+        self.assertEquals(self.storage.file_changed(fp), 1)
+        self.assertEquals(
+            self.storage.read_incident_with_number(1).summary, u"Fixed"
+        )
+        self.assertNotEquals(
+            self.storage.etag_for_incident_with_number(1), etag
+        )
+        self.assertEquals(self.storage.search_index.search([u"fixed"]), set([1]))
+        self.assertEquals(
+            self.storage.search_index.search([u"knocked out spire"]), set()
+        )
+
+
+    def test_created(self):
+        """
+        An incident created by another process is listed and indexed, and
+        its number isn't allocated.
+        """
+        fp = self.storage.path.child("2")
+        fp.setContent(incident2_text)
+
+        self.assertEquals(self.storage.file_changed(fp), 2)
+        self.assertIn(2, dict(self.storage.list_incidents()))
+        self.assertIn(2, self.storage.indexes)
+        self.assertEquals(self.storage.next_incident_number(), 3)
+
+
+    def test_removed(self):
+        """
+        An incident removed by another process is forgotten.
+        """
+        fp = self.storage.path.child("1")
+        fp.remove()
+
+        self.assertEquals(self.storage.file_changed(fp), 1)
+        self.assertEquals(dict(self.storage.list_incidents()), {})
+        self.assertNotIn(1, self.storage.incident_cache)
+        self.assertNotIn(1, self.storage.search_index)
+        self.assertNotIn(1, self.storage.indexes)
+
+
+    def test_unreadable(self):
+        """
+        An incident which another process has left unreadable is dropped
+        from the indexes.
+        """
+        fp = self.storage.path.child("1")
+        fp.setContent("{")
+
+        self.assertEquals(self.storage.file_changed(fp), 1)
+        self.assertNotIn(1, self.storage.search_index)
+        self.assertNotIn(1, self.storage.incident_cache)
+
+
+
+class StorageWatcherTests(twisted.trial.unittest.TestCase):
+    """
+    Tests for L{ims.watcher.StorageWatcher}.
+    """
+
+    if inotify is None:
+        skip = "inotify is not available"
+
+
+    @inlineCallbacks
+    def test_external_write(self):
+        """
+        The store re-reads incidents written by other processes.
+        """
+        storage = Storage(FilePath(self.mktemp()))
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+
+        watcher = StorageWatcher(storage)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+
+        changed = []
+        real_file_changed = storage.file_changed
+        def file_changed(fp):
+            number = real_file_changed(fp)
+            changed.append(number)
+            return number
+        storage.file_changed = file_changed
+
+        storage.write_incident(Incident.from_json_text(incident1_text, 1))
+        storage.path.child("2").setContent(incident2_text)
+
+        for i in xrange(50):
+            if 2 in changed:
+                break
+            yield deferLater(reactor, 0.1, lambda: None)
+
+        self.assertEquals([n for n in changed if n is not None], [2])
+        self.assertIn(2, dict(storage.list_incidents()))
@@ -0,0 +1,167 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Parallel incident warm-up and upgrade
+"""
+
+__all__ = [
+    "warm_up",
+    "upgrade",
+]
+
+from multiprocessing import Pool
+from hashlib import sha1 as etag_hash
+
+from twisted.python.filepath import FilePath
+
+from ims.data import Incident
+from ims.search import TrigramIndex
+
+
+
+def warm_up(storage, numbers, processes, keep=None):
+    """
+    Read, parse and validate incidents in a pool of processes.
+
+    @param storage: a provisioned L{ims.store.Storage}.
+
+    @param numbers: the numbers of the incidents to read.
+
+    @param processes: the number of processes to use.
+
+    @param keep: the numbers of the incidents to hand back whole, or
+        C{None} for all of them.
+
+    @return: an iterator of C{(number, etag, incident, strings, error)}
+        tuples, in no particular order.  C{incident} is C{None} unless the
+        incident's number is in C{keep}.  C{strings} are the strings to
+        index the incident under in the store's L{TrigramIndex}, or
+        C{None} if it has none.  If the incident couldn't be read,
+        C{error} is a description of the problem and the other values are
+        C{None}.
+    """
+    if keep is not None:
+        keep = frozenset(keep)
+
+    return _map(
+        storage, processes, _read,
+        [(number, keep is None or number in keep) for number in numbers],
+    )
+
+
+def upgrade(storage, numbers, processes):
+    """
+    Read incidents in a pool of processes, validating and rendering again
+    those which aren't stamped as written under the current schema and
+    validation rules (see L{ims.store.Storage}).
+
+    @param storage: a provisioned L{ims.store.Storage}.
+
+    @param numbers: the numbers of the incidents to read.
+
+    @param processes: the number of processes to use.
+
+    @return: an iterator of C{(number, json, error)} tuples, in no
+        particular order.  C{json} is the text to write for the incident,
+        or C{None} if it is current.  If the incident couldn't be read or
+        isn't valid, C{error} is a description of the problem and C{json}
+        is C{None}.
+    """
+    return _map(storage, processes, _upgrade, numbers)
+
+
+def _map(storage, processes, function, args):
+    """
+    Call a function with each of C{args} in a pool of processes, each
+    reading C{storage}.
+
+    @return: an iterator of the results, in no particular order.
+    """
+    pool = Pool(
+        processes, initializer=_initialize,
+        initargs=(
+            storage.path.path, storage.layout.name,
+            storage.search_index is not None,
+        ),
+    )
+
+    try:
+        chunk_size = max(1, min(100, len(args) // (processes * 4)))
+
+        for result in pool.imap_unordered(function, args, chunk_size):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+
+# The store read by a worker process, and whether to produce strings to
+# index
+_storage = None
+_index_strings = False
+
+
+def _initialize(path, layout, index_strings):
+    global _storage, _index_strings
+
+    from ims.store import Storage
+    from ims.layout import layouts
+
+    _storage = Storage(FilePath(path), cache_size=0, layout=layout)
+    _storage.layout = layouts[layout](_storage.path, _storage.directories)
+    _storage.archive.open()
+    _index_strings = index_strings
+
+
+def _read(args):
+    number, keep = args
+
+    try:
+        text, current = _storage.read_stored_incident_stamped_raw(number)
+        incident = Incident.from_json_text(
+            text, number=number, validate=not current
+        )
+        if not current:
+            # Validate report entries now rather than when first used.
+            incident.report_entries
+
+        if _index_strings:
+            strings = TrigramIndex.strings(incident)
+        else:
+            strings = None
+    except Exception as e:
+        return (number, None, None, None, "{0}".format(e))
+
+    return (
+        number,
+        etag_hash(text).hexdigest(),
+        incident if keep else None,
+        strings,
+        None,
+    )
+
+
+def _upgrade(number):
+    try:
+        return (number, _storage.upgraded_incident_raw(number), None)
+    except Exception as e:
+        return (number, None, "{0}".format(e))
@@ -0,0 +1,123 @@
+##
+# See the file COPYRIGHT for copyright information.
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#     http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Data store change notification
+"""
+
+__all__ = [
+    "StorageWatcher",
+    "WatcherError",
+]
+
+from twisted.python import log
+
+try:
+    from twisted.internet import inotify
+except ImportError:
+    inotify = None
+
+
+
+class WatcherError(RuntimeError):
+    """
+    Watcher error.
+    """
+
+
+
+class StorageWatcher(object):
+    """
+    Watches the directory of a L{ims.store.Storage} with Linux inotify,
+    and tells the store about changes to incident files made by other
+    processes, so that it doesn't go on serving what it had cached.
+    """
+
+    mask = 0
+
+    if inotify is not None:
+        mask = (
+            inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+            inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_CREATE
+        )
+
+
+    def __init__(self, storage, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.storage = storage
+        self.reactor = reactor
+
+        self._notifier = None
+
+
+    def __repr__(self):
+        return (
+            "{self.__class__.__name__}({self.storage})"
+            .format(self=self)
+        )
+
+
+    def start(self):
+        """
+        Start watching.
+        """
+        if self._notifier is not None:
+            return
+
+        if inotify is None:
+            raise WatcherError("inotify is not available on this platform")
+
+        log.msg("Starting {0}".format(self))
+
+        self.storage.provision()
+        self.storage.track_writes()
+
+        try:
+            notifier = inotify.INotify(self.reactor)
+            notifier.startReading()
+            notifier.watch(
+                self.storage.path, mask=self.mask, autoAdd=True,
+                callbacks=[self._changed], recursive=True,
+            )
+        except inotify.INotifyError as e:
+            raise WatcherError(
+                "Unable to watch {0}: {1}".format(self.storage.path, e)
+            )
+
+        self._notifier = notifier
+
+
+    def stop(self):
+        """
+        Stop watching.
+        """
+        if self._notifier is None:
+            return
+
+        self._notifier.loseConnection()
+        self._notifier = None
+
+
+    def _changed(self, ignored, fp, mask):
+        if mask & inotify.IN_ISDIR:
+            return
+
+        try:
+            self.storage.file_changed(fp)
+        except Exception:
+            log.err(None, "Unable to handle change to {0}".format(fp.path))